@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+META_SUFFIX = '.meta'
+
+
+def cache_key(filepath, filename, settings, extension='.zip'):
+    st = os.stat(filepath)
+    raw = f"{os.path.abspath(filepath)}|{st.st_size}|{st.st_mtime_ns}|{settings}"
+    digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+    return f"{filename}_{digest}{extension}"
+
+
+class ArchiveCache:
+    # keep_versions: archives of at most that many versions of one input
+    # file (by the 'name' and 'source' in their meta) are kept; archives of
+    # a replaced version can't be hit again anyway. on_remove(path) is
+    # called for every archive deleted.
+    def __init__(self, cache_dir, max_bytes, max_age, keep_versions=None, on_remove=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep_versions = keep_versions
+        self.on_remove = on_remove
+
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.waiters = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load()
+
+    def load(self):
+        # Archives left over from a previous run are adopted oldest first,
+        # so they are the first to go when the cache is over its limits.
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(META_SUFFIX):
+                if not os.path.exists(path[:-len(META_SUFFIX)]):
+                    os.remove(path)
+                continue
+            if name.endswith('.tmp'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if os.path.isfile(path):
+                st = os.stat(path)
+                found.append((st.st_mtime, name, st.st_size))
+
+        with self.lock:
+            for created, name, size in sorted(found):
+                path = os.path.join(self.cache_dir, name)
+                self.entries[name] = {'path': path, 'size': size, 'created': created,
+                                      'meta': self.read_meta(path)}
+                self.total_bytes += size
+            self.evict()
+
+    def read_meta(self, path):
+        try:
+            with open(path + META_SUFFIX, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_meta(self, path, meta):
+        # Kept next to the archive so details like its hash survive a restart.
+        tmp_path = f"{path}{META_SUFFIX}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path + META_SUFFIX)
+
+    def update_meta(self, key, **fields):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['meta'] = dict(entry['meta'], **fields)
+            self.write_meta(entry['path'], entry['meta'])
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['created'] > self.max_age or not os.path.exists(entry['path']):
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self.lookup(key)
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def get_or_create(self, key, build):
+        # Only one thread compresses a given key; the others wait for it
+        # and are then served from the cache.
+        while True:
+            with self.lock:
+                entry = self.lookup(key)
+                if entry:
+                    self.hits += 1
+                    return entry, True
+                event = self.inflight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.inflight[key] = event
+                    self.misses += 1
+                    break
+            self.wait_for(key, event)
+
+        try:
+            tmp_path = os.path.join(self.cache_dir, f"{key}.{threading.get_ident()}.tmp")
+            try:
+                meta = build(tmp_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            return self.put(key, tmp_path, meta), False
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+
+    def claim(self, key):
+        # For a caller that builds key itself, e.g. while streaming it out:
+        # True if it is now that caller's to build, until release(key); False
+        # if it is cached or another thread is already building it.
+        with self.lock:
+            if key in self.inflight or self.lookup(key):
+                return False
+            self.inflight[key] = threading.Event()
+            return True
+
+    def release(self, key):
+        with self.lock:
+            event = self.inflight.pop(key)
+        event.set()
+
+    def wait(self, key):
+        # Blocks while another thread is building key.
+        with self.lock:
+            event = self.inflight.get(key)
+        if event:
+            self.wait_for(key, event)
+
+    def wait_for(self, key, event):
+        with self.lock:
+            self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            event.wait()
+        finally:
+            with self.lock:
+                self.waiters[key] -= 1
+                if not self.waiters[key]:
+                    del self.waiters[key]
+
+    def wanted(self, key):
+        # Whether anyone is waiting for the build of key, e.g. a request
+        # that came in while warm-up was compressing it at its own pace.
+        with self.lock:
+            return key in self.waiters
+
+    def put(self, key, tmp_path, meta):
+        # Sized and described before it is moved into place: once there, a
+        # concurrent put may already evict it.
+        path = os.path.join(self.cache_dir, key)
+        size = os.path.getsize(tmp_path)
+        self.write_meta(path, meta)
+        os.replace(tmp_path, path)
+        entry = {'path': path, 'size': size, 'created': time.time(), 'meta': meta}
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)['size']
+            self.entries[key] = entry
+            self.total_bytes += size
+            self.trim_versions(meta)
+            self.evict(keep=key)
+        return entry
+
+    def trim_versions(self, meta):
+        name = meta.get('name')
+        if self.keep_versions is None or name is None:
+            return
+        versions = [(e['created'], e['meta']['source'], k) for k, e in self.entries.items()
+                    if e['meta'].get('name') == name and 'source' in e['meta']]
+        kept = set()
+        for created, source, key in sorted(versions, reverse=True):
+            if source not in kept and len(kept) >= self.keep_versions:
+                self.remove(key)
+                self.evictions += 1
+            else:
+                kept.add(source)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry['size']
+        for path in (entry['path'], entry['path'] + META_SUFFIX):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if self.on_remove:
+            self.on_remove(entry['path'])
+
+    def evict(self, keep=None):
+        now = time.time()
+        for key in [k for k, e in self.entries.items() if now - e['created'] > self.max_age]:
+            self.remove(key)
+            self.evictions += 1
+
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
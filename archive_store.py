@@ -0,0 +1,250 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+import metrics
+import protocol
+
+# Archives kept as `name_YYYYmmdd_HHMMSS.ext`, as the server used to save
+# one per download.
+VERSION_NAME = re.compile(r'(?P<name>.+)_(?P<time>\d{8}_\d{6})(?P<extension>\.[^_]+)$')
+LINK_SUFFIX = '.link.tmp'
+
+log = logging.getLogger('archive_store')
+
+
+class ArchiveStore:
+    # Keeps a directory of saved archives bounded. Every `interval` seconds
+    # a background pass replaces identical copies with hardlinks to one
+    # file, then deletes versions older than max_age, all but the newest
+    # keep_versions of each name and, oldest first, whatever is over
+    # max_bytes (counting hardlinked copies once). None turns a limit off.
+    # Deleted paths are passed to on_remove so download_log can follow.
+    # The ArchiveCache directory underneath has limits of its own.
+    # Only archives the server wrote are touched: those whose path is a
+    # save_path in download_log. Clients may save into the same directory,
+    # and their downloads and extracted files are theirs to keep. Without a
+    # db_path nothing is.
+    def __init__(self, root, max_bytes=None, max_age=None, keep_versions=None, interval=600.0,
+                 on_remove=None, db_path=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep_versions = keep_versions
+        self.interval = interval
+        self.on_remove = on_remove
+        self.db_path = db_path
+
+        self.hashes = {}
+        self.files = 0
+        self.total_bytes = 0
+        self.removed = 0
+        self.linked = 0
+        self.passes = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        # Rows left pointing at files deleted while the server was down are
+        # cleared once, on the first pass.
+        self.reconcile()
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                log.error(f"[STORE] {e}")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def trigger(self):
+        self.wake.set()
+
+    def logged_paths(self):
+        # The save_paths in download_log; None if it can't be read.
+        if not self.db_path:
+            return []
+        try:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                paths = [row[0] for row in conn.execute(
+                    'SELECT DISTINCT save_path FROM download_log WHERE save_path IS NOT NULL')]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            log.error(f"[STORE] {e}")
+            return None
+        return paths
+
+    def scan(self):
+        paths = self.logged_paths()
+        if paths is None:
+            return []
+        owned = {os.path.normcase(os.path.abspath(path)) for path in paths}
+        versions = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                match = VERSION_NAME.match(entry.name)
+                if not match or entry.name.endswith(('.part', '.tmp')) or not entry.is_file(follow_symlinks=False):
+                    continue
+                if os.path.normcase(os.path.abspath(entry.path)) not in owned:
+                    continue
+                try:
+                    saved = datetime.strptime(match['time'], '%Y%m%d_%H%M%S').timestamp()
+                    st = entry.stat(follow_symlinks=False)
+                except (ValueError, OSError):
+                    continue
+                versions.append({'path': entry.path, 'name': match['name'], 'saved': saved, 'size': st.st_size,
+                                 'inode': (st.st_dev, st.st_ino), 'mtime_ns': st.st_mtime_ns})
+        versions.sort(key=lambda v: (v['saved'], v['path']))
+        return versions
+
+    def collect(self):
+        with self.lock:
+            started = time.monotonic()
+            versions = self.scan()
+            linked = self.deduplicate(versions)
+            removed = self.expire(versions)
+            self.passes += 1
+            metrics.observe('store_gc', time.monotonic() - started)
+            if linked or removed:
+                log.info(f"[STORE] {linked} copies hardlinked, {removed} archives removed, "
+                         f"{self.files} left ({self.total_bytes} bytes)")
+            return linked, removed
+
+    def file_hash(self, version):
+        key = version['inode'] + (version['size'], version['mtime_ns'])
+        digest = self.hashes.get(key)
+        if digest is None:
+            digest = self.hashes[key] = protocol.hash_file(version['path']).hexdigest()
+        return digest
+
+    def deduplicate(self, versions):
+        # Only files of the same size are hashed; hashes are remembered per
+        # inode and mtime, so a pass over an unchanged directory reads nothing.
+        by_size = {}
+        for version in versions:
+            by_size.setdefault(version['size'], []).append(version)
+        linked = 0
+        for same_size in by_size.values():
+            if len({v['inode'] for v in same_size}) < 2:
+                continue
+            first = {}
+            for version in same_size:
+                try:
+                    digest = self.file_hash(version)
+                except OSError:
+                    continue
+                kept = first.setdefault(digest, version)
+                if kept['inode'] == version['inode'] or not self.link(kept, version):
+                    continue
+                linked += 1
+        inodes = {v['inode'] for v in versions}
+        self.hashes = {key: digest for key, digest in self.hashes.items() if key[:2] in inodes}
+        self.linked += linked
+        if linked:
+            metrics.inc('store_linked', linked)
+        return linked
+
+    def link(self, kept, version):
+        # The duplicate keeps its path (and its download_log rows); only its
+        # bytes go. Filesystems without hardlinks simply keep both copies.
+        tmp_path = version['path'] + LINK_SUFFIX
+        try:
+            os.link(kept['path'], tmp_path)
+            os.replace(tmp_path, version['path'])
+        except OSError as e:
+            log.debug(f"[STORE] Can't hardlink {version['path']}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        version['inode'] = kept['inode']
+        version['mtime_ns'] = kept['mtime_ns']
+        return True
+
+    def expire(self, versions):
+        now = time.time()
+        doomed = set()
+        if self.max_age is not None:
+            doomed.update(v['path'] for v in versions if now - v['saved'] > self.max_age)
+        if self.keep_versions is not None:
+            by_name = {}
+            for version in versions:
+                by_name.setdefault(version['name'], []).append(version)
+            for same_name in by_name.values():
+                doomed.update(v['path'] for v in same_name[:max(len(same_name) - self.keep_versions, 0)])
+
+        links = {}
+        for version in versions:
+            links[version['inode']] = links.get(version['inode'], 0) + 1
+        sizes = {v['inode']: v['size'] for v in versions}
+        removed = 0
+        kept = []
+        for version in versions:
+            if version['path'] in doomed and self.remove(version):
+                links[version['inode']] -= 1
+                removed += 1
+            else:
+                kept.append(version)
+
+        total = sum(sizes[inode] for inode, n in links.items() if n)
+        if self.max_bytes is not None:
+            for version in list(kept):
+                if total <= self.max_bytes:
+                    break
+                if self.remove(version):
+                    links[version['inode']] -= 1
+                    if not links[version['inode']]:
+                        total -= version['size']
+                    kept.remove(version)
+                    removed += 1
+
+        self.files = len(kept)
+        self.total_bytes = total
+        self.removed += removed
+        if removed:
+            metrics.inc('store_removed', removed)
+        return removed
+
+    def remove(self, version):
+        # An archive still open elsewhere can't be deleted on Windows; the
+        # next pass tries again.
+        try:
+            os.remove(version['path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.debug(f"[STORE] Can't remove {version['path']}: {e}")
+            return False
+        if self.on_remove:
+            self.on_remove(version['path'])
+        return True
+
+    def reconcile(self):
+        if not self.db_path or not self.on_remove:
+            return
+        root = os.path.join(os.path.abspath(self.root), '')
+        paths = self.logged_paths()
+        if paths is None:
+            return
+        missing = [path for path in paths
+                   if os.path.abspath(path).startswith(root) and not os.path.exists(path)]
+        for path in missing:
+            self.on_remove(path)
+        if missing:
+            log.info(f"[STORE] {len(missing)} download_log paths no longer exist")
+
+    def stats(self):
+        return {'files': self.files, 'bytes': self.total_bytes, 'removed': self.removed,
+                'linked': self.linked, 'passes': self.passes}
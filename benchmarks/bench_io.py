@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compressors
+import fileio
+
+WORDS = [b'server', b'client', b'archive', b'download', b'ratio', b'socket', b'thread',
+         b'compress', b'input', b'output', b'0', b'1', b'42', b'\n']
+
+
+def make_input(path, size_mb):
+    # A quarter random, the rest text, so deflate has real work to do.
+    rnd = random.Random(1)
+    text = b' '.join(rnd.choice(WORDS) for _ in range(400000))
+    with open(path, 'wb') as f:
+        for i in range(size_mb):
+            cut = rnd.randrange(len(text) - 768 * 1024)
+            f.write(os.urandom(256 * 1024) + text[cut:cut + 768 * 1024])
+
+
+class Sink:
+    # Write-only like FrameWriter, so zipfile streams with data descriptors.
+    def __init__(self):
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def read_blocks(path, block_size):
+    # How the parallel path read its input before fileio: a new bytes
+    # object per block.
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            yield block
+
+
+def run_child(mode, spec, path, workers):
+    engine, level = compressors.parse_spec(spec)
+    compressors.PARALLEL_WORKERS = workers
+    sink = Sink()
+    with open(path, 'rb') as f:
+        # Cold page cache, so every mode reads from disk.
+        fileio.advise(f.fileno(), 0, 0, 'POSIX_FADV_DONTNEED')
+    start = time.perf_counter()
+    if mode == 'before':
+        if workers > 1 and engine.name == 'deflate':
+            chunks = fileio.chunks
+            fileio.chunks = lambda p, block, buffers=1, mode=None: read_blocks(p, block)
+            compressors.write_parallel_zip(path, 'input.bin', sink, level, workers)
+            fileio.chunks = chunks
+        else:
+            with zipfile.ZipFile(sink, 'w', engine.method, compresslevel=level) as zipf:
+                zipf.write(path, 'input.bin')
+    else:
+        fileio.READ_MODE = mode
+        engine.write(path, 'input.bin', sink, level)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'seconds': elapsed, 'peak_rss': peak_rss(), 'output': sink.total}))
+
+
+def peak_rss():
+    # VmHWM belongs to this process image; ru_maxrss carries over from the
+    # parent across fork/exec, so it can't be lower than the parent's.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS and throughput of compressing one huge input")
+    parser.add_argument('--size', type=int, default=4096, help="input size in MB")
+    parser.add_argument('--input', help="existing input file (default: generated next to --output)")
+    parser.add_argument('--codecs', nargs='+', default=['stored', 'deflate:1'])
+    parser.add_argument('--modes', nargs='+', default=['before', 'read', 'mmap'], choices=['before', 'read', 'mmap'])
+    parser.add_argument('--workers', type=int, default=compressors.PARALLEL_WORKERS)
+    parser.add_argument('--output', default='bench_io_results.json', help="JSON results file")
+    parser.add_argument('--child', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, spec, path, workers = args.child
+        run_child(mode, spec, path, int(workers))
+        return
+
+    path = args.input
+    generated = path is None
+    if generated:
+        path = os.path.join(os.path.dirname(os.path.abspath(args.output)), 'bench_io_input.bin')
+        print(f"Generating {args.size} MB input...")
+        make_input(path, args.size)
+    size = os.path.getsize(path)
+
+    results = []
+    try:
+        print(f"{'codec':>10} {'mode':>7} {'seconds':>8} {'MB/s':>8} {'peak RSS MB':>12}")
+        for spec in args.codecs:
+            for mode in args.modes:
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, spec, path,
+                                      str(args.workers)], capture_output=True, text=True, check=True).stdout
+                result = dict(json.loads(out), codec=spec, mode=mode, input=size, workers=args.workers)
+                results.append(result)
+                print(f"{spec:>10} {mode:>7} {result['seconds']:>8.2f} "
+                      f"{size / result['seconds'] / 1024 ** 2:>8.1f} {result['peak_rss'] / 1024 ** 2:>12.1f}")
+    finally:
+        if generated:
+            os.remove(path)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
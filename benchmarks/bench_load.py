@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from transfer import ServerBusyError, Session
+
+WORDS = ['server', 'client', 'archive', 'download', 'ratio', 'socket', 'thread',
+         'compress', 'input', 'output', 'list', 'cache', '0', '1', '42', '\n']
+KINDS = ('random', 'text', 'repeated')
+
+# The server runs as a separate process so its CPU time and RSS can be
+# measured on their own; it is configured through its module constants.
+SERVER_BOOT = '''
+import sys
+import server
+server.INPUT_DIR, server.OUTPUT_DIR, server.CACHE_DIR, server.DB_PATH = sys.argv[1:5]
+server.HOST = '127.0.0.1'
+server.PORT = int(sys.argv[5])
+server.WARMUP_WORKERS = int(sys.argv[6])
+server.CACHE_MAX_BYTES = int(sys.argv[7])
+server.start_server()
+'''
+
+
+def make_inputs(input_dir, sizes_kb, seed=12345):
+    rnd = random.Random(seed)
+    text = ' '.join(rnd.choice(WORDS) for _ in range(256 * 1024)).encode('ascii')
+    pattern = bytes(rnd.randrange(256) for _ in range(4096))
+    names = []
+    for size_kb in sizes_kb:
+        size = size_kb * 1024
+        for kind in KINDS:
+            name = f"{kind}_{size_kb}k.bin"
+            with open(os.path.join(input_dir, name), 'wb') as f:
+                written = 0
+                while written < size:
+                    n = min(1024 * 1024, size - written)
+                    if kind == 'random':
+                        block = os.urandom(n)
+                    elif kind == 'text':
+                        cut = rnd.randrange(len(text) - n) if len(text) > n else 0
+                        block = (text[cut:cut + n] * (n // len(text) + 1))[:n]
+                    else:
+                        block = (pattern * (n // len(pattern) + 1))[:n]
+                    f.write(block)
+                    written += n
+            names.append(name)
+    return names
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(work_dir, port, warmup, cache_bytes, log_path):
+    dirs = [os.path.join(work_dir, name) for name in ('input', 'output', os.path.join('output', 'cache'))]
+    args = [sys.executable, '-c', SERVER_BOOT, *dirs, os.path.join(work_dir, 'download_log.db'),
+            str(port), str(warmup), str(cache_bytes)]
+    log = open(log_path, 'w')
+    proc = subprocess.Popen(args, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT,
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise Exception(f"Server exited, see {log_path}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, log
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise Exception("Server did not start")
+
+
+def process_stats(pid):
+    # CPU seconds and RSS of another process, from /proc (Linux) or psutil.
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        memory = {}
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    memory[key] = int(value.split()[0]) * 1024
+        return {'cpu_seconds': cpu, 'rss': memory.get('VmRSS'), 'peak_rss': memory.get('VmHWM')}
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        p = psutil.Process(pid)
+        times = p.cpu_times()
+        return {'cpu_seconds': times.user + times.system, 'rss': p.memory_info().rss, 'peak_rss': None}
+    except Exception:
+        return {'cpu_seconds': None, 'rss': None, 'peak_rss': None}
+
+
+def legacy_download(host, port, name, codec):
+    # The old lock-step text protocol: DOWNLOAD, READY, size, SIZE_RECEIVED.
+    with socket.create_connection((host, port), timeout=60) as sock:
+        start = time.perf_counter()
+        sock.sendall(f"DOWNLOAD|{name}|{codec}".encode('utf-8'))
+        reply = sock.recv(1024).decode('utf-8')
+        if reply.startswith('BUSY'):
+            raise ServerBusyError(reply)
+        if not reply.startswith('SUCCESS'):
+            raise Exception(reply)
+        sock.sendall(b"READY")
+        size = int(sock.recv(1024).decode('utf-8'))
+        sock.sendall(b"SIZE_RECEIVED")
+        buf = memoryview(bytearray(1024 * 1024))
+        received = 0
+        ttfb = None
+        while received < size:
+            n = sock.recv_into(buf, min(len(buf), size - received))
+            if not n:
+                raise ConnectionError("Connection closed")
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            received += n
+        sock.sendall(b"EXIT")
+        return received, ttfb, None, None
+
+
+class Client(threading.Thread):
+    def __init__(self, index, args, port, names, save_dir, deadline):
+        super().__init__(daemon=True)
+        self.args = args
+        self.port = port
+        self.names = names
+        self.save_dir = save_dir
+        self.deadline = deadline
+        self.rnd = random.Random(index)
+        self.results = []
+        # Own directory, so clients never share a .part file or resume journal.
+        os.makedirs(save_dir)
+
+    def run(self):
+        session = None
+        done = 0
+        while time.monotonic() < self.deadline and (not self.args.requests or done < self.args.requests):
+            done += 1
+            op = 'list' if self.rnd.random() < self.args.list_ratio else 'download'
+            name = self.rnd.choice(self.names)
+            record = {'op': op, 'ok': False, 'busy': False, 'bytes': 0}
+            start = time.perf_counter()
+            try:
+                if self.args.protocol == 'legacy':
+                    if op == 'list':
+                        with socket.create_connection(('127.0.0.1', self.port), timeout=60) as sock:
+                            sock.sendall(b"LIST")
+                            record['bytes'] = len(sock.recv(1024 * 1024))
+                            sock.sendall(b"EXIT")
+                    else:
+                        size, ttfb, _, _ = legacy_download('127.0.0.1', self.port, name, self.args.codec)
+                        record.update(bytes=size, ttfb=ttfb)
+                else:
+                    if session is None or session.closed:
+                        session = Session('127.0.0.1', self.port, streams=1)
+                    if op == 'list':
+                        files, total = session.list_files(limit=1000)
+                        record['bytes'] = len(files)
+                    else:
+                        record.update(self.download(session, name, start))
+                record['ok'] = True
+            except ServerBusyError:
+                record['busy'] = True
+            except Exception as e:
+                record['error'] = str(e)
+            record['latency'] = time.perf_counter() - start
+            self.results.append(record)
+        if session:
+            session.close()
+
+    def download(self, session, name, start):
+        first = []
+
+        def on_progress(transfer):
+            if not first:
+                first.append(time.perf_counter() - start)
+
+        transfer = session.download(name, self.args.codec, self.save_dir, on_progress=on_progress)
+        ok = transfer.wait()
+        if transfer.save_path and os.path.exists(transfer.save_path):
+            os.remove(transfer.save_path)
+        if not ok:
+            if 'busy' in (transfer.error or '').lower():
+                raise ServerBusyError(transfer.error)
+            raise Exception(transfer.error)
+        return {'bytes': transfer.end['compressed_size'], 'ttfb': first[0] if first else None,
+                'cached': transfer.end.get('cached'), 'compress_time': transfer.end.get('compress_time', 0.0)}
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {'p50': at(50), 'p95': at(95), 'p99': at(99), 'max': values[-1], 'count': len(values)}
+
+
+def summarize(records, elapsed):
+    ok = [r for r in records if r['ok']]
+    downloads = [r for r in ok if r['op'] == 'download']
+    lists = [r for r in ok if r['op'] == 'list']
+    received = sum(r['bytes'] for r in downloads)
+    return {
+        'requests': len(records),
+        'ok': len(ok),
+        'busy': sum(1 for r in records if r['busy']),
+        'errors': sum(1 for r in records if not r['ok'] and not r['busy']),
+        'requests_per_sec': len(ok) / elapsed,
+        'mb_per_sec': received / elapsed / (1024 * 1024),
+        'download_latency': percentiles([r['latency'] for r in downloads]),
+        'download_ttfb': percentiles([r['ttfb'] for r in downloads if r.get('ttfb') is not None]),
+        'list_latency': percentiles([r['latency'] for r in lists]),
+        'cache_hits': sum(1 for r in downloads if r.get('cached')),
+        'compress_seconds': sum(r.get('compress_time') or 0.0 for r in downloads),
+    }
+
+
+def print_report(result, baseline=None):
+    s = result['summary']
+    server = result['server']
+    print(f"requests {s['requests']}  ok {s['ok']}  busy {s['busy']}  errors {s['errors']}")
+    print(f"{s['requests_per_sec']:.1f} req/s  {s['mb_per_sec']:.1f} MB/s  "
+          f"cache hits {s['cache_hits']}  compression {s['compress_seconds']:.2f} s")
+    for key in ('download_latency', 'download_ttfb', 'list_latency'):
+        p = s[key]
+        if p:
+            print(f"{key:>17}: p50 {p['p50'] * 1000:8.1f} ms  p95 {p['p95'] * 1000:8.1f} ms  "
+                  f"p99 {p['p99'] * 1000:8.1f} ms  (n={p['count']})")
+    if server['cpu_seconds'] is not None:
+        print(f"server CPU {server['cpu_seconds']:.2f} s  RSS {(server['rss'] or 0) / 1024 / 1024:.1f} MB  "
+              f"peak {(server['peak_rss'] or 0) / 1024 / 1024:.1f} MB")
+    for phase, p in sorted((server.get('phases') or {}).items()):
+        # Server-side timings from its STATS reply.
+        print(f"{'server ' + phase:>22}: n {p['count']:6}  mean {p['mean'] * 1000:8.2f} ms  "
+              f"p99 {p['p99'] * 1000:8.2f} ms  total {p['sum']:7.2f} s")
+    for item in (server.get('profile') or [])[:15]:
+        print(f"  {item['own'] * 100:5.1f}% own {item['total'] * 100:5.1f}% total  {item['function']}")
+
+    if baseline:
+        # Positive is better for throughput, negative is better for latency.
+        b = baseline['summary']
+        print("vs baseline:")
+        for key in ('requests_per_sec', 'mb_per_sec'):
+            if b[key]:
+                print(f"{key:>17}: {(s[key] / b[key] - 1) * 100:+.1f}%")
+        for key in ('download_latency', 'download_ttfb', 'list_latency'):
+            if s[key] and b[key]:
+                print(f"{key:>17}: p50 {(s[key]['p50'] / b[key]['p50'] - 1) * 100:+.1f}%  "
+                      f"p99 {(s[key]['p99'] / b[key]['p99'] - 1) * 100:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load test of server.py with synthetic inputs")
+    parser.add_argument('--clients', type=int, default=16, help="concurrent simulated clients")
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds to run")
+    parser.add_argument('--requests', type=int, default=0, help="stop each client after this many requests")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 1024, 16384], help="input sizes in KB")
+    parser.add_argument('--codec', default='auto')
+    parser.add_argument('--list-ratio', type=float, default=0.1, help="share of requests that are LIST")
+    parser.add_argument('--protocol', choices=['framed', 'legacy'], default='framed')
+    parser.add_argument('--cache-mb', type=int, default=2048, help="server cache size, 0 compresses every time")
+    parser.add_argument('--warmup', type=int, default=0, help="server precompression workers")
+    parser.add_argument('--profile', action='store_true', help="sample the server's stacks during the run")
+    parser.add_argument('--server-log', help="keep the server's output in this file")
+    parser.add_argument('--output', default='bench_load_results.json', help="JSON results file")
+    parser.add_argument('--compare', help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_dir = os.path.join(work_dir, 'input')
+        save_dir = os.path.join(work_dir, 'downloads')
+        os.makedirs(input_dir)
+        os.makedirs(save_dir)
+        print(f"Generating inputs: {len(args.sizes)} sizes x {len(KINDS)} kinds...")
+        names = make_inputs(input_dir, args.sizes)
+
+        port = free_port()
+        proc, log = start_server(work_dir, port, args.warmup, args.cache_mb * 1024 * 1024,
+                                 args.server_log or os.path.join(work_dir, 'server.log'))
+        try:
+            admin = Session('127.0.0.1', port, streams=1)
+            if args.profile:
+                admin.profile('start')
+            before = process_stats(proc.pid)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            print(f"Running {args.clients} clients for {args.duration:.0f} s ({args.protocol})...")
+            start = time.monotonic()
+            clients = [Client(i, args, port, names, os.path.join(save_dir, str(i)), start + args.duration) for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.monotonic() - start
+            after = process_stats(proc.pid)
+            stats = admin.stats()
+            profile = admin.profile('stop')['top'] if args.profile else None
+            admin.close()
+            client_usage = resource.getrusage(resource.RUSAGE_SELF)
+        finally:
+            proc.terminate()
+            proc.wait()
+            log.close()
+
+    records = [r for client in clients for r in client.results]
+    server = dict(after, phases=stats['phases'], counters=stats['counters'], profile=profile)
+    if after['cpu_seconds'] is not None and before['cpu_seconds'] is not None:
+        server['cpu_seconds'] = after['cpu_seconds'] - before['cpu_seconds']
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'elapsed': elapsed,
+        'summary': summarize(records, elapsed),
+        'server': server,
+        'client_cpu_seconds': (client_usage.ru_utime + client_usage.ru_stime) - (usage.ru_utime + usage.ru_stime),
+        'errors': sorted({r['error'] for r in records if 'error' in r})[:20],
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
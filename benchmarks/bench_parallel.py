@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compressors
+
+WORDS = [b'server', b'client', b'archive', b'download', b'ratio', b'socket',
+         b'thread', b'compress', b'input', b'output', b'0', b'1', b'42', b'\n']
+
+
+def make_input(path, size_mb):
+    # Text-like data: random words, so deflate gets a realistic ratio
+    # instead of the near-free ratio of repeated or zero bytes.
+    rnd = random.Random(12345)
+    corpus = b' '.join(rnd.choice(WORDS) for _ in range(1024 * 1024))[:4 * 1024 * 1024]
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size_mb * 1024 * 1024:
+            cut = rnd.randrange(len(corpus))
+            block = corpus[cut:] + corpus[:cut]
+            f.write(block)
+            written += len(block)
+
+
+def run(path, level, workers, verify):
+    out_path = path + f'.{workers}.zip'
+    start = time.perf_counter()
+    with open(out_path, 'wb') as f:
+        compressors.write_parallel_zip(path, os.path.basename(path), f, level, workers=workers)
+    elapsed = time.perf_counter() - start
+    compressed = os.path.getsize(out_path)
+    if verify:
+        with zipfile.ZipFile(out_path) as z:
+            bad = z.testzip()
+            if bad:
+                raise Exception(f"Corrupt archive: {bad}")
+    os.remove(out_path)
+    return elapsed, compressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel deflate speedup vs worker count")
+    parser.add_argument('--size', type=int, default=1024, help="input size in MB")
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, 8, os.cpu_count() or 1}))
+    parser.add_argument('--verify', action='store_true', help="check every archive with zipfile")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'input.txt')
+        print(f"Generating {args.size} MB input...")
+        make_input(path, args.size)
+        size = os.path.getsize(path)
+
+        print(f"{'workers':>8} {'seconds':>9} {'MB/s':>9} {'speedup':>8} {'ratio':>8}")
+        base = None
+        for workers in args.workers:
+            elapsed, compressed = run(path, args.level, workers, args.verify)
+            base = base or elapsed
+            print(f"{workers:>8} {elapsed:>9.2f} {size / elapsed / 1024 / 1024:>9.1f} "
+                  f"{base / elapsed:>7.2f}x {compressors.ratio(size, compressed):>7.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+from protocol import FrameConnection, tune_socket
+
+
+def make_input(path, size_mb):
+    with open(path, 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def serve(listener, path, mode, chunk, repeat):
+    conn, _ = listener.accept()
+    fc = FrameConnection(conn)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        for _ in range(repeat):
+            if mode == 'sendfile':
+                fc.send_file(1, f, 0, size, chunk)
+            else:
+                # Stream path: DATA frames from a buffer, like FrameWriter.
+                f.seek(0)
+                buf = memoryview(bytearray(chunk))
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    fc.send_frame(protocol.DATA, 1, buf[:n])
+    fc.send_frame(protocol.END, 1)
+    conn.close()
+
+
+def receive(fc, sink, recv):
+    total = 0
+    while True:
+        ftype, _, size = fc.recv_header()
+        if ftype == protocol.END:
+            return total
+        while size > 0:
+            if recv == 'recv_into':
+                data = fc.recv_view(size)
+            else:
+                # What the client used to do: a new bytes object per chunk.
+                data = fc.sock.recv(min(size, fc.recv_chunk))
+                if not data:
+                    raise ConnectionError("Connection closed")
+            sink.write(data)
+            total += len(data)
+            size -= len(data)
+
+
+def run(path, mode, recv, chunk, repeat, sndbuf, rcvbuf, output):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(listener, sndbuf, rcvbuf)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = threading.Thread(target=serve, args=(listener, path, mode, chunk, repeat), daemon=True)
+    server.start()
+
+    sock = socket.create_connection(listener.getsockname())
+    tune_socket(sock, sndbuf, rcvbuf)
+    fc = FrameConnection(sock, chunk)
+    with open(output, 'wb') as sink:
+        start = time.perf_counter()
+        total = receive(fc, sink, recv)
+        elapsed = time.perf_counter() - start
+    sock.close()
+    listener.close()
+    server.join()
+    return total, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback transfer throughput vs chunk size")
+    parser.add_argument('--size', type=int, default=256, help="input size in MB")
+    parser.add_argument('--repeat', type=int, default=4, help="times the input is sent per run")
+    parser.add_argument('--chunks', type=int, nargs='+', default=[8, 64, 256, 1024, 4096], help="chunk sizes in KB")
+    parser.add_argument('--modes', nargs='+', default=['sendfile', 'send'], choices=['sendfile', 'send'])
+    parser.add_argument('--recv', nargs='+', default=['recv_into', 'recv'], choices=['recv_into', 'recv'])
+    parser.add_argument('--sndbuf', type=int, default=None, help="SO_SNDBUF in bytes (default: OS)")
+    parser.add_argument('--rcvbuf', type=int, default=None, help="SO_RCVBUF in bytes (default: OS)")
+    parser.add_argument('--output', default=os.devnull, help="where received data is written")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'input.bin')
+        print(f"Generating {args.size} MB input...")
+        make_input(path, args.size)
+
+        print(f"{'send':>9} {'receive':>10} {'chunk KB':>9} {'seconds':>9} {'GB/s':>7}")
+        for mode in args.modes:
+            for recv in args.recv:
+                for chunk_kb in args.chunks:
+                    total, elapsed = run(path, mode, recv, chunk_kb * 1024, args.repeat,
+                                         args.sndbuf, args.rcvbuf, args.output)
+                    print(f"{mode:>9} {recv:>10} {chunk_kb:>9} {elapsed:>9.2f} "
+                          f"{total / elapsed / 1024 ** 3:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import os
+import glob
+import lzma
+import tarfile
+import zipfile
+
+import compressors
+from compressors import PARALLEL_WORKERS, ZipEngine, zstandard
+
+MAX_ENTRIES = 100000
+XZ_DEFAULT_PRESET = 6
+
+
+class BundleError(Exception):
+    pass
+
+
+def safe_path(root, relative):
+    # Requested names are relative to root and must stay inside it, also
+    # after following symlinks.
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, relative))
+    if os.path.commonpath([root, path]) != root:
+        raise BundleError(f"Outside the input directory: {relative}")
+    return path
+
+
+def select(root, files=None, pattern=None, directory=None):
+    # Returns [(path, arcname, size)] for everything the request names.
+    # Named files must exist; files found by pattern or directory that
+    # aren't regular files inside root are skipped.
+    found = {}
+
+    def add(relative, strict=False):
+        try:
+            path = safe_path(root, relative)
+        except BundleError:
+            if strict:
+                raise
+            return
+        if path.endswith('.zip') or not os.path.isfile(path):
+            if strict:
+                raise BundleError(f"No such file: {relative}")
+            return
+        arcname = os.path.normpath(relative).replace(os.sep, '/')
+        found[arcname] = (path, arcname, os.path.getsize(path))
+        if len(found) > MAX_ENTRIES:
+            raise BundleError(f"Too many files (more than {MAX_ENTRIES})")
+
+    for name in files or []:
+        add(name, strict=True)
+
+    if pattern:
+        for name in glob.glob(pattern, root_dir=root, recursive=True):
+            add(name)
+
+    if directory:
+        if not os.path.isdir(safe_path(root, directory)):
+            raise BundleError(f"No such directory: {directory}")
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, directory)):
+            dirnames.sort()
+            for name in sorted(filenames):
+                add(os.path.relpath(os.path.join(dirpath, name), root))
+
+    if not found:
+        raise BundleError("No files matched")
+    return [found[arcname] for arcname in sorted(found)]
+
+
+def describe(files=None, pattern=None, directory=None):
+    # Short name for the bundle, used for the saved file and the log.
+    if directory:
+        return directory.rstrip('/\\') + '/'
+    if pattern:
+        return pattern
+    if files and len(files) == 1:
+        return files[0]
+    return f"{len(files or [])} files"
+
+
+def resolve(mode, spec):
+    # Returns (codec label, level, extension). In zip mode each entry gets
+    # its own codec from spec ('auto' picks one per file).
+    name, _, level = (spec or 'auto').partition(':')
+    if mode == 'solid':
+        if name == 'zstd':
+            if zstandard is None:
+                raise BundleError("zstd is not available on this server")
+            engine, level = compressors.parse_spec(spec)
+            return 'tar+zstd', level, '.tar.zst'
+        if name in ('lzma', 'xz') and level:
+            if not level.isdigit() or not 0 <= int(level) <= 9:
+                raise BundleError(f"Invalid level for xz: {level}")
+            return 'tar+xz', int(level), '.tar.xz'
+        # Anything else gets the best ratio available.
+        return 'tar+xz', XZ_DEFAULT_PRESET, '.tar.xz'
+    if mode == 'zip':
+        if name != 'auto':
+            engine, level = compressors.parse_spec(spec)
+            if not isinstance(engine, ZipEngine):
+                raise BundleError(f"{engine.name} can't be used in a zip, use solid mode")
+        return f"zip+{spec or 'auto'}", None, '.zip'
+    raise BundleError(f"Unknown bundle mode: {mode}")
+
+
+def write_zip(entries, fileobj, spec, on_entry):
+    with zipfile.ZipFile(fileobj, 'w', allowZip64=True) as zipf:
+        for index, (path, arcname, size) in enumerate(entries):
+            on_entry(index, arcname, size)
+            if spec == 'auto':
+                engine, level = compressors.choose_auto(path, zip_only=True)
+            else:
+                engine, level = compressors.parse_spec(spec)
+            compressors.write_member(zipf, path, arcname, engine.method, level)
+
+
+def write_solid(entries, fileobj, codec, level, on_entry):
+    # One compressed tar stream, so redundancy across files is shared.
+    # Similar files compress better next to each other, hence the order.
+    entries = sorted(entries, key=lambda e: (os.path.splitext(e[1])[1].lower(), e[1]))
+    if codec == 'tar+zstd':
+        threads = PARALLEL_WORKERS if PARALLEL_WORKERS > 1 else 0
+        stream = zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(fileobj, closefd=False)
+    else:
+        stream = lzma.LZMAFile(fileobj, 'wb', preset=level)
+    with stream:
+        with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for index, (path, arcname, size) in enumerate(entries):
+                on_entry(index, arcname, size)
+                tar.add(path, arcname, recursive=False)
+
+
+def write(entries, fileobj, mode, spec, codec, level, on_entry):
+    if mode == 'solid':
+        write_solid(entries, fileobj, codec, level, on_entry)
+    else:
+        write_zip(entries, fileobj, spec or 'auto', on_entry)
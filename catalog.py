@@ -0,0 +1,129 @@
+import os
+import time
+import bisect
+import fnmatch
+import logging
+import threading
+
+PAGE_SIZE = 1000
+FILES_PER_FRAME = 500
+SORT_KEYS = ('name', 'size', 'mtime')
+
+log = logging.getLogger('catalog')
+
+
+class Catalog:
+    # Index of the files in INPUT_DIR. A background thread rescans the
+    # directory every poll_interval seconds and only touches entries whose
+    # size or mtime changed, so LIST never has to stat the whole directory.
+    def __init__(self, input_dir, poll_interval=2.0):
+        self.input_dir = input_dir
+        self.poll_interval = poll_interval
+
+        self.entries = {}
+        self.names = []
+        self.orders = {}
+        self.version = 0
+        self.scanned = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.listeners = []
+
+    def subscribe(self, callback):
+        # callback(entries) is called from the scanning thread with copies of
+        # the entries that are new or changed, the first scan included.
+        self.listeners.append(callback)
+
+    def start(self):
+        if self.thread is None:
+            self.refresh()
+            self.thread = threading.Thread(target=self.poll, daemon=True)
+            self.thread.start()
+
+    def poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"[CATALOG] {e}")
+
+    def refresh(self):
+        found = {}
+        with os.scandir(self.input_dir) as it:
+            for item in it:
+                if item.name.endswith('.zip') or not item.is_file():
+                    continue
+                st = item.stat()
+                found[item.name] = (st.st_size, st.st_mtime_ns)
+
+        updated = []
+        with self.lock:
+            changed = False
+            for name in [n for n in self.entries if n not in found]:
+                del self.entries[name]
+                changed = True
+            for name, (size, mtime_ns) in found.items():
+                entry = self.entries.get(name)
+                if entry and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+                    continue
+                self.entries[name] = {'name': name, 'size': size, 'mtime_ns': mtime_ns}
+                updated.append(dict(self.entries[name]))
+                changed = True
+            if changed or not self.scanned:
+                self.names = sorted(self.entries)
+                self.orders = {}
+                self.version += 1
+            self.scanned = True
+
+        if updated:
+            for callback in self.listeners:
+                callback(updated)
+
+    def record_archive(self, name, size, mtime_ns, codec, level, compressed_size, ratio):
+        # Archive sizes are remembered for the exact file version they were
+        # built from; a changed file loses them on the next refresh.
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+                entry['archive'] = {'codec': codec, 'level': level,
+                                    'compressed_size': compressed_size, 'ratio': ratio}
+
+    def ordered(self, sort):
+        # Orders other than by name are built lazily and kept until the
+        # next change to the directory.
+        if sort == 'name':
+            return self.names
+        if sort not in self.orders:
+            field = 'size' if sort == 'size' else 'mtime_ns'
+            self.orders[sort] = sorted(self.names, key=lambda n: self.entries[n][field])
+        return self.orders[sort]
+
+    def query(self, prefix='', pattern=None, sort='name', reverse=False, offset=0, limit=PAGE_SIZE):
+        if not self.scanned:
+            self.refresh()
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+
+        with self.lock:
+            if sort == 'name' and prefix:
+                lo = bisect.bisect_left(self.names, prefix)
+                hi = bisect.bisect_left(self.names, prefix + '\U0010ffff')
+                names = self.names[lo:hi]
+            else:
+                names = self.ordered(sort)
+                if prefix:
+                    names = [n for n in names if n.startswith(prefix)]
+            if pattern:
+                names = [n for n in names if fnmatch.fnmatchcase(n, pattern)]
+            if reverse:
+                names = names[::-1]
+
+            total = len(names)
+            page = [dict(self.entries[n]) for n in names[offset:offset + limit]]
+        return total, page
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            return dict(entry) if entry else None
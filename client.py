@@ -1,26 +1,54 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 import socket
 import os
 import threading
 import sqlite3
-from datetime import datetime
+
+from log_query import DB_PATH, LOG_PAGE_SIZE, LogQuery
+from transfer import BatchProgress, BundleTransfer, ServerBusyError, Session
 
 SERVER_HOST = 'localhost'
 SERVER_PORT = 12345
 OUTPUT_DIR = 'D:\\repos\\Save_files\\output'
+DEFAULT_CODEC = 'auto'
+PARALLEL_DOWNLOADS = 4
+LIST_PAGE_SIZE = 1000
+PROGRESS_POLL_MS = 100
+# None keeps the OS default receive buffer (and its auto-tuning).
+SOCKET_RCVBUF = None
+BUNDLE_MODES = ['off', 'zip', 'solid']
+# Unpack archives while they download instead of saving them (see extract.py).
+EXTRACT = False
+CODECS = ['auto', 'stored', 'deflate:1', 'deflate:6', 'deflate:9', 'bz2', 'lzma', 'zstd:3', 'zstd:19', 'adaptive', 'raw', 'delta']
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+def fmt_size(size):
+    if not isinstance(size, (int, float)):
+        size = 0
+    if size >= 1024*1024:
+        return f"{size/1024/1024:.2f} MB"
+    elif size >= 1024:
+        return f"{size/1024:.2f} KB"
+    else:
+        return f"{size} bytes"
+
 class FileDownloaderClient:
     def __init__(self, root):
         self.root = root
         self.root.title("File Downloader Client")
         self.root.geometry("800x600")
         
-        self.socket = None
+        self.session = None
+        self.items = {}
+        self.sort = 'name'
+        self.reverse = False
+        self.loaded = 0
         self.thread = None
         self.stop = False
+        self.batch = None
+        self.batch_count = 0
         
         self.create_gui()
         self.connect()
@@ -34,12 +62,26 @@ class FileDownloaderClient:
         
         files_frame = ttk.LabelFrame(main, text="Files on server:", padding="10")
         files_frame.pack(fill='both', expand=True, pady=5)
+        
+        filter_row = ttk.Frame(files_frame)
+        filter_row.pack(fill='x', side='top', pady=(0, 5))
+        ttk.Label(filter_row, text="Filter (prefix or glob):").pack(side='left')
+        self.filter_text = tk.StringVar()
+        filter_entry = ttk.Entry(filter_row, textvariable=self.filter_text)
+        filter_entry.pack(side='left', fill='x', expand=True, padx=5)
+        filter_entry.bind('<Return>', lambda e: self.get_files())
+        self.btn_more = ttk.Button(filter_row, text="Load more", command=self.load_more, state='disabled')
+        self.btn_more.pack(side='right')
 
-        self.tree = ttk.Treeview(files_frame, columns=('name', 'size'), show='headings', height=6)
-        self.tree.heading('name', text='File name')
-        self.tree.heading('size', text='Size (bytes)')
-        self.tree.column('name', width=400)
-        self.tree.column('size', width=150)
+        self.tree = ttk.Treeview(files_frame, columns=('name', 'size', 'archive', 'status'), show='headings', height=6)
+        self.tree.heading('name', text='File name', command=lambda: self.sort_by('name'))
+        self.tree.heading('size', text='Size (bytes)', command=lambda: self.sort_by('size'))
+        self.tree.heading('archive', text='Archive')
+        self.tree.heading('status', text='Status')
+        self.tree.column('name', width=300)
+        self.tree.column('size', width=100)
+        self.tree.column('archive', width=120)
+        self.tree.column('status', width=120)
 
         scroll = ttk.Scrollbar(files_frame, orient="vertical", command=self.tree.yview)
         self.tree.configure(yscrollcommand=scroll.set)
@@ -59,13 +101,31 @@ class FileDownloaderClient:
         self.btn_cancel = ttk.Button(buttons, text="Cancel", command=self.cancel_download, state='disabled')
         self.btn_cancel.pack(side='left', padx=5)
         
+        self.btn_verify = ttk.Button(buttons, text="Verify file", command=self.start_verify)
+        self.btn_verify.pack(side='left', padx=5)
+        
         self.btn_logs = ttk.Button(buttons, text="Show logs", command=self.show_logs)
         self.btn_logs.pack(side='left', padx=5)
         
         self.btn_open = ttk.Button(buttons, text="Open output", command=self.open_output)
         self.btn_open.pack(side='left', padx=5)
+        
+        self.codec = tk.StringVar(value=DEFAULT_CODEC)
+        codec_box = ttk.Combobox(buttons, textvariable=self.codec, values=CODECS, width=10)
+        codec_box.pack(side='right', padx=5)
+        ttk.Label(buttons, text="Codec:").pack(side='right')
+
+        # 'zip' or 'solid' fetch the selection (or, with nothing selected,
+        # everything the filter matches; "dir/" means a directory) as one archive.
+        self.bundle_mode = tk.StringVar(value='off')
+        bundle_box = ttk.Combobox(buttons, textvariable=self.bundle_mode, values=BUNDLE_MODES, width=6, state='readonly')
+        bundle_box.pack(side='right', padx=5)
+        ttk.Label(buttons, text="One archive:").pack(side='right')
+
+        self.extract = tk.BooleanVar(value=EXTRACT)
+        ttk.Checkbutton(buttons, text="Extract", variable=self.extract).pack(side='right', padx=5)
 
-        self.progress = ttk.Progressbar(main, mode='indeterminate')
+        self.progress = ttk.Progressbar(main, mode='determinate', maximum=100)
         self.progress.pack(fill='x', pady=5)
 
         info_frame = ttk.LabelFrame(main, text="Compression info:", padding="10")
@@ -90,6 +150,14 @@ class FileDownloaderClient:
         self.lbl_save = ttk.Label(grid, text="0 bytes")
         self.lbl_save.grid(row=3, column=1, sticky='w', padx=5, pady=2)
         
+        ttk.Label(grid, text="Codec:").grid(row=4, column=0, sticky='w', padx=5, pady=2)
+        self.lbl_codec = ttk.Label(grid, text="-")
+        self.lbl_codec.grid(row=4, column=1, sticky='w', padx=5, pady=2)
+        
+        ttk.Label(grid, text="Decompression:").grid(row=5, column=0, sticky='w', padx=5, pady=2)
+        self.lbl_decompress = ttk.Label(grid, text="-")
+        self.lbl_decompress.grid(row=5, column=1, sticky='w', padx=5, pady=2)
+        
         self.lbl_status = ttk.Label(info_frame, text="Select file", wraplength=600, font=('Arial', 10))
         self.lbl_status.pack(pady=5)
 
@@ -98,40 +166,62 @@ class FileDownloaderClient:
         status_bar = ttk.Label(main, textvariable=self.status_text, relief='sunken', anchor='w')
         status_bar.pack(fill='x', side='bottom', pady=(5, 0))
         
+    def open_session(self):
+        if self.session:
+            self.session.close()
+        self.session = None
+        self.session = Session(SERVER_HOST, SERVER_PORT, PARALLEL_DOWNLOADS, rcvbuf=SOCKET_RCVBUF)
+        return self.session
+        
+    def get_session(self):
+        # The server closes connections that stay idle too long.
+        if self.session is None or self.session.closed:
+            return self.open_session()
+        return self.session
+        
     def connect(self):
         try:
             self.status_text.set("Connecting...")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)
-            self.socket.connect((SERVER_HOST, SERVER_PORT))
-            self.socket.settimeout(None)
+            self.open_session()
             self.status_text.set("Connected")
             self.get_files()
         except Exception as e:
             messagebox.showerror("Error", f"Cannot connect: {e}")
             self.status_text.set("Error")
             
-    def get_files(self):
+    def get_files(self, more=False):
         try:
             self.status_text.set("Getting files...")
             self.btn_refresh.config(state='disabled')
-            self.socket.send("LIST".encode('utf-8'))
-            data = self.socket.recv(4096).decode('utf-8')
+            
+            query = {'sort': self.sort, 'reverse': self.reverse,
+                     'offset': self.loaded if more else 0, 'limit': LIST_PAGE_SIZE}
+            text = self.filter_text.get().strip()
+            if any(c in text for c in '*?['):
+                query['pattern'] = text
+            elif text:
+                query['prefix'] = text
+            try:
+                files, total = self.get_session().list_files(**query)
+            except OSError:
+                files, total = self.open_session().list_files(**query)
 
-            for item in self.tree.get_children():
-                self.tree.delete(item)
+            if not more:
+                self.loaded = 0
+                for item in self.tree.get_children():
+                    self.tree.delete(item)
                 
-            if data:
-                files = data.split(";")
-                count = 0
-                for file_info in files:
-                    if "|" in file_info:
-                        name, size = file_info.split("|")
-                        self.tree.insert('', 'end', values=(name, size))
-                        count += 1
+            for file_info in files:
+                archive = ""
+                if 'compressed_size' in file_info:
+                    archive = f"{file_info['compressed_size']} ({file_info['ratio']:.1f}%)"
+                self.tree.insert('', 'end', values=(file_info['name'], file_info['size'], archive, ""))
+            self.loaded += len(files)
+            self.btn_more.config(state='normal' if self.loaded < total else 'disabled')
                 
-                self.status_text.set(f"Found {count} files")
-                self.lbl_status.config(text=f"Found {count} files")
+            if total:
+                self.status_text.set(f"Found {total} files (showing {self.loaded})")
+                self.lbl_status.config(text=f"Found {total} files")
             else:
                 self.status_text.set("No files")
                 self.lbl_status.config(text="No files")
@@ -142,29 +232,63 @@ class FileDownloaderClient:
         finally:
             self.btn_refresh.config(state='normal')
             
+    def load_more(self):
+        self.get_files(more=True)
+        
+    def sort_by(self, column):
+        if self.sort == column:
+            self.reverse = not self.reverse
+        else:
+            self.sort = column
+            self.reverse = False
+        self.get_files()
+            
     def start_download(self):
         selected = self.tree.selection()
-        if not selected:
+        bundle = None
+        mode = self.bundle_mode.get()
+        text = self.filter_text.get().strip()
+        if mode != 'off':
+            if selected:
+                bundle = {'files': [str(self.tree.item(item)['values'][0]) for item in selected]}
+            elif text.endswith('/'):
+                bundle = {'directory': text}
+            elif text:
+                bundle = {'pattern': text if any(c in text for c in '*?[') else text + '*'}
+            if bundle:
+                bundle['mode'] = mode
+        if not selected and not bundle:
             messagebox.showwarning("Warning", "Select file")
             return
 
         self.btn_download.config(state='disabled')
         self.btn_refresh.config(state='disabled')
         self.btn_cancel.config(state='normal')
-        self.progress.start()
+        self.progress['value'] = 0
         
-        filename = self.tree.item(selected[0])['values'][0]
+        self.items = {}
+        for item in selected:
+            filename = str(self.tree.item(item)['values'][0])
+            self.items[filename] = item
+            self.tree.set(item, 'status', "Queued")
         self.stop = False
-        self.thread = threading.Thread(target=self.download, args=(filename,))
+        self.batch = BatchProgress()
+        self.batch_count = 1 if bundle else len(self.items)
+        self.thread = threading.Thread(target=self.download, args=(list(self.items), self.codec.get(), bundle,
+                                                                    self.extract.get()))
         self.thread.daemon = True
         self.thread.start()
         self.check_thread()
         
     def check_thread(self):
+        # The download thread never touches widgets for progress; this poll
+        # reads the shared BatchProgress instead, however fast data arrives.
         if self.thread and self.thread.is_alive():
-            self.root.after(100, self.check_thread)
+            if not self.batch.closed:
+                self.show_progress()
+            self.root.after(PROGRESS_POLL_MS, self.check_thread)
         else:
-            self.progress.stop()
+            self.progress['value'] = self.batch.snapshot(self.batch_count)['fraction'] * 100
             self.btn_download.config(state='normal')
             self.btn_refresh.config(state='normal')
             self.btn_cancel.config(state='disabled')
@@ -172,148 +296,176 @@ class FileDownloaderClient:
     def cancel_download(self):
         self.stop = True
         self.status_text.set("Cancelling...")
+        # Closing the connection aborts every transfer still in flight.
+        if self.session:
+            self.session.close()
         
-    def download(self, filename):
+    def start_verify(self):
+        selected = self.tree.selection()
+        if len(selected) != 1:
+            messagebox.showwarning("Warning", "Select one file")
+            return
+        filename = str(self.tree.item(selected[0])['values'][0])
+        path = filedialog.askopenfilename(title=f"Local copy of {filename}", initialdir=OUTPUT_DIR)
+        if not path:
+            return
+
+        spec = self.codec.get()
+        self.status_text.set(f"Verifying {os.path.basename(path)}...")
+        self.btn_verify.config(state='disabled')
+        thread = threading.Thread(target=self.verify, args=(path, filename, spec))
+        thread.daemon = True
+        thread.start()
+
+    def verify(self, path, filename, spec):
+        # Hashing a large local file takes a while, so it runs off the Tk thread.
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(30)
-            sock.connect((SERVER_HOST, SERVER_PORT))
-            
-            self.status_text.set(f"Requesting {filename}...")
-            self.lbl_status.config(text=f"Requesting: {filename}")
+            ok, message = self.get_session().verify_file(path, filename, spec)
+            if ok:
+                self.root.after(0, lambda: messagebox.showinfo("Verified", f"{os.path.basename(path)}\n\n{message}"))
+            else:
+                self.root.after(0, lambda: messagebox.showerror("Mismatch", f"{os.path.basename(path)}\n\n{message}"))
+            self.root.after(0, self.status_text.set, "Verified" if ok else "Verification failed")
+        except Exception as e:
+            # e is unbound once the except block ends, before Tk runs the callback.
+            msg = f"Cannot verify: {e}"
+            self.root.after(0, lambda msg=msg: messagebox.showerror("Error", msg))
+            self.root.after(0, self.status_text.set, "Error")
+        finally:
+            self.root.after(0, self.btn_verify.config, {'state': 'normal'})
+
+    def download(self, filenames, spec=DEFAULT_CODEC, bundle=None, extract=False):
+        try:
+            session = self.get_session()
             
-            sock.send(f"DOWNLOAD|{filename}".encode('utf-8'))
-            response = sock.recv(1024).decode('utf-8')
+            transfers = []
+            if bundle:
+                self.root.after(0, self.status_text.set, "Requesting one archive...")
+                transfer = session.download_bundle(OUTPUT_DIR, codec=spec, on_finish=self.on_transfer_finish,
+                                                   extract=extract, **bundle)
+                self.batch.add(transfer)
+                transfers.append(transfer)
+            else:
+                self.root.after(0, self.status_text.set, f"Requesting {len(filenames)} file(s)...")
+            for filename in filenames if not bundle else []:
+                if self.stop:
+                    break
+                transfer = session.download(filename, spec, OUTPUT_DIR, on_finish=self.on_transfer_finish,
+                                            extract=extract)
+                self.batch.add(transfer)
+                transfers.append(transfer)
+            for transfer in transfers:
+                transfer.wait()
+            self.batch.close()
             
             if self.stop:
-                sock.close()
-                self.status_text.set("Cancelled")
+                self.root.after(0, self.status_text.set, "Cancelled")
+                self.root.after(0, self.lbl_status.config, {'text': "Cancelled"})
                 return
-                
-            if response.startswith("SUCCESS"):
-                parts = response.split("|")
-                if len(parts) >= 4:
-                    orig = int(parts[1])
-                    comp = int(parts[2])
-                    ratio = float(parts[3])
-                    saved = orig - comp
-                    
-                    saved_text = f"{saved} bytes"
-                    if saved > 1024:
-                        saved_text = f"{saved/1024:.2f} KB"
-                    if saved > 1024*1024:
-                        saved_text = f"{saved/(1024*1024):.2f} MB"
-                    
-                    self.root.after(0, self.update_info, orig, comp, ratio, saved_text)
-                    
-                else:
-                    orig = 0
-                    comp = 0
-                    ratio = 0.0
-                    saved_text = "0 bytes"
-                
-                time_str = datetime.now().strftime('%Y%m%d_%H%M%S')
-                save_name = f"{filename}_{time_str}.zip"
-                save_path = os.path.join(OUTPUT_DIR, save_name)
-                
-                self.status_text.set("Downloading...")
-                self.lbl_status.config(text=f"Downloading: {filename}\n"
-                                          f"Original: {orig} bytes\n"
-                                          f"Archive: {comp} bytes\n"
-                                          f"Ratio: {ratio:.2f}%\n"
-                                          f"Saved: {saved_text}")
-                
-                sock.send("READY".encode('utf-8'))
-                
-                size_data = sock.recv(1024).decode('utf-8')
-                if not size_data.isdigit():
-                    raise Exception(f"Invalid size: {size_data}")
-                
-                total_size = int(size_data)
-                sock.send("SIZE_RECEIVED".encode('utf-8'))
-                
-                received = 0
-                with open(save_path, 'wb') as f:
-                    while received < total_size:
-                        if self.stop:
-                            break
-                            
-                        remaining = total_size - received
-                        chunk = min(8192, remaining)
-                        
-                        try:
-                            data = sock.recv(chunk)
-                            if not data:
-                                break
-                                
-                            f.write(data)
-                            received += len(data)
-                            
-                            if total_size > 0:
-                                percent = (received / total_size) * 100
-                                self.root.after(0, self.update_progress, 
-                                               filename, orig, comp, ratio, received, total_size, percent, saved_text, save_path)
-                            
-                        except socket.timeout:
-                            continue
-                        except Exception as e:
-                            print(f"Error: {e}")
-                            break
-                
-                try:
-                    end = sock.recv(1024)
-                    if end != b"FILE_END":
-                        print("Warning: no end signal")
-                except:
-                    print("Warning: timeout")
-                
-                if self.stop:
-                    try:
-                        os.remove(save_path)
-                    except:
-                        pass
-                    self.status_text.set("Cancelled")
-                    self.root.after(0, self.lbl_status.config, {'text': "Cancelled"})
-                    return
-                
-                actual = os.path.getsize(save_path)
-                if actual != total_size:
-                    raise Exception(f"Size error: expected {total_size}, got {actual}")
-                
-                info = (f"File downloaded!\n"
-                        f"Original: {orig} bytes\n"
-                        f"Archive: {comp} bytes\n"
-                        f"Ratio: {ratio:.2f}%\n"
-                        f"Saved: {saved_text}\n"
-                        f"Path: {save_path}")
-                
-                self.root.after(0, self.lbl_status.config, {'text': info})
-                self.status_text.set(f"Downloaded: {filename}")
-                
-                message = (f"File downloaded!\n\n"
-                          f"Original: {orig} bytes\n"
-                          f"Archive: {comp} bytes\n"
-                          f"Ratio: {ratio:.2f}%\n"
-                          f"Saved: {saved_text}\n\n"
-                          f"Path:\n{save_path}")
-                
-                self.root.after(0, lambda: messagebox.showinfo("Success", message))
-                
-            else:
-                error = response.replace("ERROR|", "")
+            
+            done = [t for t in transfers if t.error is None]
+            failed = [t for t in transfers if t.error is not None]
+            if not done:
+                error = failed[0].error if failed else "Nothing downloaded"
                 self.root.after(0, lambda: messagebox.showerror("Error", f"Error: {error}"))
-                self.status_text.set("Error")
-                
-            sock.close()
+                self.root.after(0, self.status_text.set, "Error")
+                return
+            
+            orig = sum(t.meta['original_size'] for t in done)
+            comp = sum(t.end['compressed_size'] for t in done)
+            ratio = (1 - comp / orig) * 100 if orig > 0 else 0.0
+            saved = orig - comp
+            compress_time = sum(t.end.get('compress_time', 0.0) for t in done)
+            if compress_time:
+                compress_text = f"{compress_time:.2f} s"
+            else:
+                compress_text = "none (cached)" if any(t.end.get('cached') for t in done) else "none"
+            # Only archives that were unpacked on the way in have a time.
+            extracted = [t.decompress_time for t in done if t.decompress_time is not None]
+            decompress_text = f"{sum(extracted):.2f} s" if extracted else "-"
+            
+            saved_text = f"{saved} bytes"
+            if saved > 1024:
+                saved_text = f"{saved/1024:.2f} KB"
+            if saved > 1024*1024:
+                saved_text = f"{saved/(1024*1024):.2f} MB"
             
+            if len(transfers) == 1:
+                meta = done[0].meta
+                codec_text = meta['codec'] if meta['level'] is None else f"{meta['codec']}:{meta['level']}"
+                if meta['codec'] == 'delta':
+                    # Archive is then what actually crossed the network:
+                    # the signatures sent plus the delta received.
+                    reused = done[0].end['matched'] / orig * 100 if orig > 0 else 0.0
+                    codec_text = f"delta ({reused:.1f}% reused from the previous copy)"
+                path_text = done[0].save_path
+                header = f"Archive of {meta['entries']} files downloaded!" if bundle else "File downloaded!"
+            else:
+                codec_text = ", ".join(sorted({t.meta['codec'] for t in done}))
+                path_text = OUTPUT_DIR
+                header = f"Downloaded {len(done)} of {len(transfers)} files!"
+            
+            self.root.after(0, self.update_info, orig, comp, ratio, saved_text, codec_text, decompress_text)
+            
+            info = (f"{header}\n"
+                    f"Original: {orig} bytes\n"
+                    f"Archive: {comp} bytes\n"
+                    f"Ratio: {ratio:.2f}%\n"
+                    f"Saved: {saved_text}\n"
+                    f"Codec: {codec_text}\n"
+                    f"Compression: {compress_text}\n"
+                    f"Decompression: {decompress_text}\n"
+                    f"Path: {path_text}")
+            
+            self.root.after(0, self.lbl_status.config, {'text': info})
+            self.root.after(0, self.status_text.set, f"Downloaded: {', '.join(t.name for t in done)}")
+            
+            message = (f"{header}\n\n"
+                      f"Original: {orig} bytes\n"
+                      f"Archive: {comp} bytes\n"
+                      f"Ratio: {ratio:.2f}%\n"
+                      f"Saved: {saved_text}\n"
+                      f"Codec: {codec_text}\n"
+                      f"Compression: {compress_text}\n"
+                      f"Decompression: {decompress_text}\n\n"
+                      f"Path:\n{path_text}")
+            if failed:
+                message += "\n\nFailed:\n" + "\n".join(f"{t.name}: {t.error}" for t in failed)
+            
+            self.root.after(0, lambda: messagebox.showinfo("Success", message))
+            
+        except ServerBusyError:
+            self.batch.close()
+            self.root.after(0, lambda: messagebox.showwarning("Busy", "Server is busy, try again later"))
+            self.root.after(0, self.status_text.set, "Server busy")
         except socket.timeout:
+            self.batch.close()
             self.root.after(0, lambda: messagebox.showerror("Error", "Timeout"))
-            self.status_text.set("Timeout")
+            self.root.after(0, self.status_text.set, "Timeout")
         except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Error: {e}"))
-            self.status_text.set("Error")
+            self.batch.close()
+            msg = f"Error: {e}"
+            self.root.after(0, lambda msg=msg: messagebox.showerror("Error", msg))
+            self.root.after(0, self.status_text.set, "Error")
     
-    def update_info(self, orig, comp, ratio, saved_text):
+    def on_transfer_finish(self, transfer):
+        if transfer.error is None:
+            status = f"Done ({transfer.end['ratio']:.1f}%)"
+        else:
+            status = "Cancelled" if self.stop else f"Error: {transfer.error}"
+        self.root.after(0, self.set_item_status, transfer.name, status)
+    
+    def set_item_status(self, filename, status):
+        if filename in self.items:
+            items = [self.items[filename]]
+        else:
+            # A bundle's status is the status of every file in it.
+            items = list(self.items.values()) if self.batch_count == 1 else []
+        for item in items:
+            if item and self.tree.exists(item):
+                self.tree.set(item, 'status', status)
+    
+    def update_info(self, orig, comp, ratio, saved_text, codec_text, decompress_text="-"):
         def fmt(size):
             if size >= 1024*1024:
                 return f"{size:,} bytes ({size/(1024*1024):.2f} MB)"
@@ -326,25 +478,78 @@ class FileDownloaderClient:
         self.lbl_comp.config(text=fmt(comp))
         self.lbl_ratio.config(text=f"{ratio:.2f}%")
         self.lbl_save.config(text=saved_text)
+        self.lbl_codec.config(text=codec_text)
+        self.lbl_decompress.config(text=decompress_text)
     
-    def update_progress(self, filename, orig, comp, ratio, received, total, percent, saved_text, save_path):
+    def show_progress(self):
+        state = self.batch.snapshot(self.batch_count)
+        self.progress['value'] = state['fraction'] * 100
+        names = []
+        for transfer in state['active']:
+            self.set_item_status(transfer.name, f"{transfer.fraction() * 100:.0f}%")
+            if isinstance(transfer, BundleTransfer) and transfer.entry:
+                names.append(f"{transfer.label} [{transfer.entries_started}/{transfer.meta['entries']}: "
+                             f"{transfer.entry['name']}]")
+            else:
+                names.append(transfer.name)
+
+        eta = f"{state['eta']:.0f} s" if state['eta'] is not None else "-"
+        names = ", ".join(names) or "-"
         self.lbl_status.config(
-            text=f"Downloading: {filename}\n"
-                 f"Progress: {received}/{total} bytes ({percent:.1f}%)\n"
-                 f"Original: {orig} bytes\n"
-                 f"Archive: {comp} bytes\n"
-                 f"Ratio: {ratio:.2f}%\n"
-                 f"Saved: {saved_text}\n"
-                 f"Path: {save_path}"
+            text=f"Downloading: {names}\n"
+                 f"Files: {state['finished']} of {state['count']}    Received: {fmt_size(state['received'])}\n"
+                 f"Speed: {state['rate'] / (1024*1024):.2f} MB/s    ETA: {eta}    "
+                 f"Compression: {state['compress_time']:.2f} s"
         )
+        self.status_text.set(f"Downloading... {state['fraction'] * 100:.0f}%")
     
     def show_logs(self):
         try:
             window = tk.Toplevel(self.root)
             window.title("Download Logs")
-            window.geometry("1000x500")
+            window.geometry("1000x650")
+
+            filters = ttk.Frame(window)
+            filters.pack(fill='x', padx=5, pady=5)
+            self.log_filters = {}
+            for key, label, width in (('filename', "File (prefix or glob):", 20), ('ip', "IP (prefix):", 15),
+                                      ('date_from', "From (YYYY-MM-DD):", 11), ('date_to', "To:", 11)):
+                ttk.Label(filters, text=label).pack(side='left')
+                var = tk.StringVar()
+                entry = ttk.Entry(filters, textvariable=var, width=width)
+                entry.pack(side='left', padx=(2, 8))
+                entry.bind('<Return>', lambda e: self.load_logs())
+                self.log_filters[key] = var
+            ttk.Button(filters, text="Apply", command=self.load_logs).pack(side='left')
 
-            tree = ttk.Treeview(window, columns=('id', 'time', 'ip', 'name', 'orig', 'comp', 'ratio', 'path'), show='headings', height=20)
+            summary = ttk.LabelFrame(window, text="Summary", padding="5")
+            summary.pack(side='bottom', fill='x', padx=5, pady=5)
+            self.lbl_log_summary = ttk.Label(summary, text="")
+            self.lbl_log_summary.pack(anchor='w')
+            files = ttk.Treeview(summary, columns=('name', 'count', 'served', 'saved', 'ratio'), show='headings', height=5)
+            files.heading('name', text='File name')
+            files.heading('count', text='Downloads')
+            files.heading('served', text='Served')
+            files.heading('saved', text='Saved')
+            files.heading('ratio', text='Mean ratio')
+            files.column('name', width=300)
+            files.column('count', width=80)
+            files.column('served', width=100)
+            files.column('saved', width=100)
+            files.column('ratio', width=80)
+            files.pack(fill='x')
+            self.log_files = files
+
+            buttons = ttk.Frame(window)
+            buttons.pack(side='bottom', fill='x', pady=5)
+            
+            btn_refresh = ttk.Button(buttons, text="Refresh", command=self.load_logs)
+            btn_refresh.pack(side='left', padx=5)
+            
+            btn_clear = ttk.Button(buttons, text="Clear logs", command=self.clear_logs)
+            btn_clear.pack(side='left', padx=5)
+
+            tree = ttk.Treeview(window, columns=('id', 'time', 'ip', 'name', 'orig', 'comp', 'ratio', 'codec', 'path'), show='headings', height=20)
             
             tree.heading('id', text='ID')
             tree.heading('time', text='Time')
@@ -353,6 +558,7 @@ class FileDownloaderClient:
             tree.heading('orig', text='Original')
             tree.heading('comp', text='Archive')
             tree.heading('ratio', text='Ratio')
+            tree.heading('codec', text='Codec')
             tree.heading('path', text='Path')
             
             tree.column('id', width=50)
@@ -362,88 +568,137 @@ class FileDownloaderClient:
             tree.column('orig', width=100)
             tree.column('comp', width=100)
             tree.column('ratio', width=80)
+            tree.column('codec', width=80)
             tree.column('path', width=250)
             
             scroll = ttk.Scrollbar(window, orient="vertical", command=tree.yview)
-            tree.configure(yscrollcommand=scroll.set)
-            
-            buttons = ttk.Frame(window)
-            buttons.pack(fill='x', pady=5)
-            
-            btn_refresh = ttk.Button(buttons, text="Refresh", command=lambda: self.load_logs(tree))
-            btn_refresh.pack(side='left', padx=5)
-            
-            btn_clear = ttk.Button(buttons, text="Clear logs", command=lambda: self.clear_logs(tree))
-            btn_clear.pack(side='left', padx=5)
+
+            # Rows are fetched a page at a time, whenever the view gets near
+            # the bottom of what has been loaded so far.
+            def on_scroll(first, last):
+                scroll.set(first, last)
+                if float(last) >= 0.9:
+                    self.load_log_page()
+            tree.configure(yscrollcommand=on_scroll)
             
             tree.pack(side='left', fill='both', expand=True, padx=5, pady=5)
             scroll.pack(side='right', fill='y', pady=5)
 
-            self.load_logs(tree)
+            self.log_tree = tree
+            self.log_generation = 0
+            self.load_logs()
             
         except Exception as e:
             messagebox.showerror("Error", f"Cannot load logs: {e}")
+
+    def run_log_query(self, work, done):
+        # sqlite runs in a worker thread; results come back to the Tk thread.
+        # Replies for an older filter are dropped.
+        generation = self.log_generation
+        def worker():
+            try:
+                result, error = work(), None
+            except Exception as e:
+                result, error = None, e
+            def deliver():
+                if generation == self.log_generation:
+                    done(result, error)
+            self.root.after(0, deliver)
+        threading.Thread(target=worker, daemon=True).start()
     
-    def load_logs(self, tree):
+    def load_logs(self):
         try:
-            for item in tree.get_children():
-                tree.delete(item)
-
-            conn = sqlite3.connect('download_log.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM download_log ORDER BY timestamp DESC')
-            rows = cursor.fetchall()
-            conn.close()
-            
-            if not rows:
-                tree.insert('', 'end', values=("", "", "", "No logs found", "", "", "", ""))
-                tree.master.title("Logs (0)")
-            else:
-                for row in rows:
-                    id_num, time, ip, name, orig, comp, ratio, path = row
-                    
-                    def fmt(size):
-                        if not isinstance(size, (int, float)):
-                            size = 0
-                        if size >= 1024*1024:
-                            return f"{size/1024/1024:.2f} MB"
-                        elif size >= 1024:
-                            return f"{size/1024:.2f} KB"
-                        else:
-                            return f"{size} bytes"
-                    
-                    ratio_text = f"{ratio:.2f}%" if ratio else "0.00%"
-                    tree.insert('', 'end', values=(
-                        id_num,
-                        time,
-                        ip,
-                        name,
-                        fmt(orig),
-                        fmt(comp),
-                        ratio_text,
-                        path
-                    ))
-                
-                tree.master.title(f"Logs ({len(rows)})")
-                
-        except Exception as e:
-            messagebox.showerror("Error", f"Error: {e}")
+            query = LogQuery(DB_PATH, **{key: var.get().strip() for key, var in self.log_filters.items()})
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+
+        self.log_generation += 1
+        self.log_query = query
+        self.log_last = None
+        self.log_loading = False
+        self.log_done = False
+        self.log_total = None
+        for item in self.log_tree.get_children():
+            self.log_tree.delete(item)
+        self.lbl_log_summary.config(text="Loading...")
+        self.log_tree.master.title("Logs")
+
+        self.load_log_page()
+        self.run_log_query(query.summary, self.show_log_summary)
+
+    def load_log_page(self):
+        if self.log_loading or self.log_done:
+            return
+        self.log_loading = True
+        query, after = self.log_query, self.log_last
+        self.run_log_query(lambda: query.page(after), self.show_log_page)
+
+    def show_log_page(self, rows, error):
+        self.log_loading = False
+        if error:
+            self.log_done = True
+            messagebox.showerror("Error", f"Error: {error}")
+            return
+
+        if len(rows) < LOG_PAGE_SIZE:
+            self.log_done = True
+        if not rows and self.log_last is None:
+            self.log_tree.insert('', 'end', values=("", "", "", "No logs found", "", "", "", "", ""))
+            return
+
+        for id_num, time, ip, name, orig, comp, ratio, codec, level, path in rows:
+            ratio_text = f"{ratio:.2f}%" if ratio else "0.00%"
+            codec_text = f"{codec}:{level}" if codec and level is not None else (codec or "")
+            self.log_tree.insert('', 'end', values=(
+                id_num,
+                time,
+                ip,
+                name,
+                fmt_size(orig),
+                fmt_size(comp),
+                ratio_text,
+                codec_text,
+                path or ""
+            ))
+        self.log_last = (rows[-1][1], rows[-1][0])
+        self.show_log_count()
+
+    def show_log_summary(self, summary, error):
+        if error:
+            self.lbl_log_summary.config(text=f"Error: {error}")
+            return
+
+        self.log_total = summary['count']
+        self.lbl_log_summary.config(
+            text=f"Downloads: {summary['count']}    Served: {fmt_size(summary['compressed'])}    "
+                 f"Original: {fmt_size(summary['original'])}    Saved: {fmt_size(summary['saved'])}    "
+                 f"Mean ratio: {summary['mean_ratio']:.2f}%"
+        )
+        for item in self.log_files.get_children():
+            self.log_files.delete(item)
+        for name, count, served, saved, ratio in summary['files']:
+            self.log_files.insert('', 'end', values=(name, count, fmt_size(served), fmt_size(saved), f"{ratio or 0:.2f}%"))
+        self.show_log_count()
+
+    def show_log_count(self):
+        shown = len(self.log_tree.get_children())
+        if self.log_total is None:
+            self.log_tree.master.title(f"Logs ({shown})")
+        else:
+            self.log_tree.master.title(f"Logs ({shown} of {self.log_total})")
     
-    def clear_logs(self, tree):
+    def clear_logs(self):
         if messagebox.askyesno("Confirm", "Clear all logs?"):
             try:
-                conn = sqlite3.connect('download_log.db')
+                conn = sqlite3.connect(DB_PATH)
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM download_log')
                 conn.commit()
                 conn.close()
                 
-                for item in tree.get_children():
-                    tree.delete(item)
-                    
-                tree.insert('', 'end', values=("", "", "", "Logs cleared", "", "", "", ""))
+                self.load_logs()
                 messagebox.showinfo("Success", "Logs cleared")
-                tree.master.title("Logs (0)")
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Cannot clear: {e}")
@@ -0,0 +1,424 @@
+import os
+import bz2
+import lzma
+import time
+import zlib
+import struct
+import zipfile
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import fileio
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AUTO_SAMPLE_SIZE = 256 * 1024
+AUTO_TARGET_RATIO = 20.0
+AUTO_MIN_RATIO = 3.0
+
+PARALLEL_WORKERS = os.cpu_count() or 1
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+DEFLATE_WINDOW = 32 * 1024
+
+# 'adaptive' is deflate with its level picked again for every block, for
+# the shortest compress-and-send time over the link the archive is streamed
+# to (see LevelController). Written to a file, it is plain ADAPTIVE_LEVEL.
+ADAPTIVE_LEVELS = range(0, 10)
+ADAPTIVE_LEVEL = 6
+ADAPTIVE_SMOOTHING = 0.3
+
+ZIP64_LIMIT = 0xF0000000
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+DATA_DESCRIPTOR = struct.Struct('<4sL2L')
+DATA_DESCRIPTOR64 = struct.Struct('<4sL2Q')
+CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+
+def compress_block(block, level, zdict, last):
+    # Raw deflate primed with the tail of the previous block, so the blocks
+    # concatenate into one stream with no loss of back-references. Each
+    # block may have a level of its own.
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def timed_block(block, level, zdict, last):
+    started = time.perf_counter()
+    data = compress_block(block, level, zdict, last)
+    return data, time.perf_counter() - started
+
+
+def parallel_deflate(blocks, size, level, workers, controller=None):
+    # pigz-style: blocks are compressed in a thread pool (zlib releases the
+    # GIL) and yielded in order; at most 2 * workers blocks are in flight, so
+    # each block must stay valid while that many more are taken. A
+    # controller picks each block's level and is told how each one went.
+    # Yields (compressed, crc32 of everything read so far, bytes read so far).
+    crc = 0
+    done = 0
+    pending = deque()
+    prev_tail = b''
+    last = False
+
+    def result(item):
+        future, block_crc, block_done, block_level, block_size = item
+        data, seconds = future.result()
+        if controller:
+            controller.observe(block_level, block_size, len(data), seconds)
+        return data, block_crc, block_done
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for block in blocks:
+            done += len(block)
+            last = done >= size
+            crc = zlib.crc32(block, crc)
+            block_level = controller.next_level(len(block)) if controller else level
+            pending.append((pool.submit(timed_block, block, block_level, prev_tail, last), crc, done,
+                            block_level, len(block)))
+            prev_tail = block[-DEFLATE_WINDOW:]
+            if last:
+                break
+            while len(pending) >= 2 * workers:
+                yield result(pending.popleft())
+        if not last:
+            # The file was shorter than size (empty, or it shrank while
+            # being read): the stream still needs its final block.
+            pending.append((pool.submit(timed_block, b'', level, prev_tail, True), crc, done, level, 0))
+        while pending:
+            yield result(pending.popleft())
+
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+def write_parallel_zip(filepath, arcname, fileobj, level, workers=None, controller=None, pace=None):
+    # Single-member zip with a data descriptor, so it can be written to a
+    # socket as well as to a file. zipfile cannot store precompressed data,
+    # which is why the records are written here by hand.
+    workers = workers or PARALLEL_WORKERS
+    st = os.stat(filepath)
+    zip64 = st.st_size > ZIP64_LIMIT
+    name = arcname.encode('utf-8')
+    flags = 0x08 | (0x800 if not arcname.isascii() else 0)
+    version = 45 if zip64 else 20
+    dostime, dosdate = dos_datetime(st.st_mtime)
+
+    extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+    placeholder = 0xFFFFFFFF if zip64 else 0
+    header = LOCAL_HEADER.pack(b'PK\x03\x04', version, 0, flags, zipfile.ZIP_DEFLATED,
+                               dostime, dosdate, 0, placeholder, placeholder, len(name), len(extra))
+    fileobj.write(header + name + extra)
+    offset = len(header) + len(name) + len(extra)
+
+    crc = 0
+    compressed_size = 0
+    file_size = 0
+    blocks = fileio.chunks(filepath, PARALLEL_BLOCK_SIZE, buffers=2 * workers + 1, pace=pace)
+    for data, crc, file_size in parallel_deflate(blocks, st.st_size, level, workers, controller):
+        fileobj.write(data)
+        compressed_size += len(data)
+    offset += compressed_size
+
+    if zip64:
+        descriptor = DATA_DESCRIPTOR64.pack(b'PK\x07\x08', crc, compressed_size, file_size)
+        extra = struct.pack('<2H2Q', 1, 16, file_size, compressed_size)
+        sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+    else:
+        descriptor = DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compressed_size, file_size)
+        extra = b''
+        sizes = (compressed_size, file_size)
+    fileobj.write(descriptor)
+    offset += len(descriptor)
+
+    central = CENTRAL_DIR.pack(b'PK\x01\x02', version, 3, version, 0, flags, zipfile.ZIP_DEFLATED,
+                               dostime, dosdate, crc, sizes[0], sizes[1], len(name), len(extra),
+                               0, 0, 0, (st.st_mode & 0xFFFF) << 16, 0)
+    fileobj.write(central + name + extra)
+    central_size = len(central) + len(name) + len(extra)
+
+    if offset > 0xFFFFFFFF or zip64:
+        fileobj.write(END_RECORD64.pack(b'PK\x06\x06', 44, 45, 45, 0, 0, 1, 1, central_size, offset))
+        fileobj.write(END_LOCATOR64.pack(b'PK\x06\x07', 0, offset + central_size, 1))
+        fileobj.write(END_RECORD.pack(b'PK\x05\x06', 0, 0, 1, 1, central_size, 0xFFFFFFFF, 0))
+    else:
+        fileobj.write(END_RECORD.pack(b'PK\x05\x06', 0, 0, 1, 1, central_size, offset, 0))
+
+
+class ZipEngine:
+    extension = '.zip'
+    # Output that depends on the link it is streamed to, not only on the
+    # file and level, can't be cached or resumed.
+    per_link = False
+
+    def __init__(self, name, method, levels, default_level, sample):
+        self.name = name
+        self.method = method
+        self.levels = levels
+        self.default_level = default_level
+        self.sample = sample
+
+    def write(self, filepath, arcname, fileobj, level, workers=None, pace=None):
+        # workers: threads to compress with (default PARALLEL_WORKERS);
+        # pace: see fileio.chunks.
+        workers = workers or PARALLEL_WORKERS
+        if (self.method == zipfile.ZIP_DEFLATED and workers > 1
+                and os.path.getsize(filepath) >= PARALLEL_MIN_SIZE):
+            write_parallel_zip(filepath, arcname, fileobj, level, workers, pace=pace)
+            return
+        with zipfile.ZipFile(fileobj, 'w', self.method, compresslevel=level) as zipf:
+            write_member(zipf, filepath, arcname, self.method, level, pace)
+
+
+def write_member(zipf, filepath, arcname, method, level, pace=None):
+    # What zipf.write() does, but fed from fileio.chunks instead of 8 KB
+    # reads through a Python buffer.
+    zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+    zinfo.compress_type = method
+    zinfo._compresslevel = level
+    # file_size from the stat tells zipfile whether ZIP64 is needed.
+    with zipf.open(zinfo, 'w') as dest:
+        for chunk in fileio.chunks(filepath, pace=pace):
+            dest.write(chunk)
+
+
+class AdaptiveEngine(ZipEngine):
+    # Always the pigz-style writer, which is what lets the level change from
+    # one block to the next. write() returns what the controller decided.
+    per_link = True
+
+    def __init__(self):
+        super().__init__('adaptive', zipfile.ZIP_DEFLATED, [None], None,
+                         lambda data, level: zlib.compress(data, ADAPTIVE_LEVEL))
+
+    def write(self, filepath, arcname, fileobj, level, workers=None, pace=None):
+        workers = workers or PARALLEL_WORKERS
+        controller = LevelController(filepath, getattr(fileobj, 'link_rate', None), workers)
+        write_parallel_zip(filepath, arcname, fileobj, ADAPTIVE_LEVEL, workers, controller, pace)
+        return controller.summary()
+
+
+class LevelController:
+    # The level for each next block is the one with the least predicted
+    # time for the rest of the file: compressing and sending overlap, so
+    # that is the larger of the two. Speed and ratio per level come from a
+    # probe of the file, scaled by how the blocks so far actually did
+    # against the probe. link() is the send rate in bytes/s (None while
+    # unknown); until it is known, blocks get ADAPTIVE_LEVEL. The predicted
+    # total time is the one made at the first choice with a known link.
+    def __init__(self, filepath, link, workers):
+        self.started = time.perf_counter()
+        self.size = os.path.getsize(filepath)
+        self.link = link
+        self.workers = workers
+        self.speeds, self.ratios = probe_levels(filepath)
+        self.speed_scale = 1.0
+        self.ratio_scale = 1.0
+        self.done = 0
+        self.levels = Counter()
+        self.predicted_time = None
+
+    def choose(self, remaining):
+        rate = self.link() if self.link else None
+        if not rate:
+            return ADAPTIVE_LEVEL, None
+        best = None
+        for level in ADAPTIVE_LEVELS:
+            compress_time = remaining / (self.speeds[level] * self.speed_scale * self.workers)
+            send_time = remaining * self.ratios[level] * self.ratio_scale / rate
+            seconds = max(compress_time, send_time)
+            if best is None or seconds < best[1]:
+                best = (level, seconds)
+        return best
+
+    def next_level(self, size):
+        level, seconds = self.choose(self.size - self.done)
+        if self.predicted_time is None and seconds is not None:
+            self.predicted_time = time.perf_counter() - self.started + seconds
+        self.done += size
+        self.levels[level] += size
+        return level
+
+    def observe(self, level, size, compressed_size, seconds):
+        # Blocks too small to time say nothing useful.
+        if size < 64 * 1024 or seconds <= 0:
+            return
+        a = ADAPTIVE_SMOOTHING
+        self.speed_scale += a * (size / seconds / self.speeds[level] - self.speed_scale)
+        self.ratio_scale += a * (compressed_size / size / self.ratios[level] - self.ratio_scale)
+
+    def summary(self):
+        level = self.levels.most_common(1)[0][0] if self.levels else ADAPTIVE_LEVEL
+        return {'level': level, 'levels': dict(self.levels), 'predicted_time': self.predicted_time}
+
+
+probe_results = {}
+
+
+def probe_levels(filepath):
+    # Input bytes/s and compressed/input size of every level on a sample of
+    # the file, kept per file version like auto mode's choice.
+    st = os.stat(filepath)
+    ident = (os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+    with auto_lock:
+        if ident in probe_results:
+            return probe_results[ident]
+
+    with open(filepath, 'rb') as f:
+        sample = f.read(AUTO_SAMPLE_SIZE)
+    speeds = {}
+    ratios = {}
+    for level in ADAPTIVE_LEVELS:
+        started = time.perf_counter()
+        compressed = compress_block(sample, level, b'', True)
+        speeds[level] = max(len(sample), 1) / max(time.perf_counter() - started, 1e-6)
+        ratios[level] = len(compressed) / len(sample) if sample else 1.0
+
+    with auto_lock:
+        if len(probe_results) > 10000:
+            probe_results.clear()
+        probe_results[ident] = (speeds, ratios)
+    return speeds, ratios
+
+
+class ZstdEngine:
+    name = 'zstd'
+    extension = '.zst'
+    per_link = False
+    levels = range(1, 23)
+    default_level = 3
+
+    def sample(self, data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def write(self, filepath, arcname, fileobj, level, workers=None, pace=None):
+        # zstd has its own multi-threaded mode that still writes one frame.
+        workers = workers or PARALLEL_WORKERS
+        threads = workers if workers > 1 else 0
+        cctx = zstandard.ZstdCompressor(level=level, threads=threads)
+        size = os.path.getsize(filepath)
+        with cctx.stream_writer(fileobj, size=size, closefd=False) as writer:
+            for chunk in fileio.chunks(filepath, pace=pace):
+                writer.write(chunk)
+
+
+ENGINES = {
+    'stored': ZipEngine('stored', zipfile.ZIP_STORED, [None], None,
+                        lambda data, level: data),
+    'deflate': ZipEngine('deflate', zipfile.ZIP_DEFLATED, range(1, 10), 6,
+                         lambda data, level: zlib.compress(data, level)),
+    'bz2': ZipEngine('bz2', zipfile.ZIP_BZIP2, range(1, 10), 9,
+                     lambda data, level: bz2.compress(data, level)),
+    # zipfile has no level setting for LZMA, it always uses the default preset.
+    'lzma': ZipEngine('lzma', zipfile.ZIP_LZMA, [None], None,
+                      lambda data, level: lzma.compress(data)),
+}
+ENGINES['adaptive'] = AdaptiveEngine()
+if zstandard is not None:
+    ENGINES['zstd'] = ZstdEngine()
+
+# Fastest first; auto mode takes the first one that reaches the target ratio.
+AUTO_CANDIDATES = [('zstd', 1), ('deflate', 1), ('zstd', 3), ('deflate', 6),
+                   ('deflate', 9), ('bz2', 9), ('lzma', None)]
+
+auto_choices = {}
+auto_lock = threading.Lock()
+
+
+def parse_spec(spec):
+    if not spec:
+        spec = 'deflate'
+    name, _, level = spec.partition(':')
+    engine = ENGINES.get(name)
+    if engine is None:
+        raise ValueError(f"Unknown codec: {name}")
+    if not level:
+        return engine, engine.default_level
+    if not level.isdigit() or int(level) not in engine.levels:
+        raise ValueError(f"Invalid level for {name}: {level}")
+    return engine, int(level)
+
+
+def per_link(spec):
+    engine = ENGINES.get((spec or '').partition(':')[0])
+    return engine is not None and engine.per_link
+
+
+def ratio(original_size, compressed_size):
+    if original_size > 0:
+        return (1 - compressed_size / original_size) * 100
+    return 0.0
+
+
+def choose_auto(filepath, zip_only=False):
+    # zip_only leaves out codecs that can't be a zip member (zstd).
+    st = os.stat(filepath)
+    ident = (os.path.abspath(filepath), st.st_size, st.st_mtime_ns, zip_only)
+    with auto_lock:
+        if ident in auto_choices:
+            return auto_choices[ident]
+
+    with open(filepath, 'rb') as f:
+        sample = f.read(AUTO_SAMPLE_SIZE)
+
+    choice = None
+    best = None
+    for name, level in AUTO_CANDIDATES:
+        engine = ENGINES.get(name)
+        if engine is None or (zip_only and not isinstance(engine, ZipEngine)):
+            continue
+        saved = ratio(len(sample), len(engine.sample(sample, level)))
+        if best is None:
+            # Nothing compresses better than the fastest codec by enough to
+            # matter on data like JPEG or PDF, so don't bother trying.
+            if saved < AUTO_MIN_RATIO:
+                choice = (ENGINES['stored'], None)
+                break
+        if best is None or saved > best[2]:
+            best = (engine, level, saved)
+        if saved >= AUTO_TARGET_RATIO:
+            choice = (engine, level)
+            break
+    if choice is None:
+        choice = (best[0], best[1]) if best else (ENGINES['stored'], None)
+
+    with auto_lock:
+        if len(auto_choices) > 10000:
+            auto_choices.clear()
+        auto_choices[ident] = choice
+    return choice
+
+
+def estimate_size(engine, level, filepath):
+    # Archive size predicted from a compressed sample, so progress can be
+    # shown while the archive is still being produced.
+    size = os.path.getsize(filepath)
+    if engine.name == 'stored' or size == 0:
+        return size
+    with open(filepath, 'rb') as f:
+        sample = f.read(AUTO_SAMPLE_SIZE)
+    return int(size * len(engine.sample(sample, level)) / len(sample))
+
+
+def resolve(spec, filepath):
+    if spec == 'auto':
+        return choose_auto(filepath)
+    return parse_spec(spec)
+
+
+def level_text(level):
+    return '-' if level is None else str(level)
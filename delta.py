@@ -0,0 +1,252 @@
+import math
+import zlib
+import struct
+import hashlib
+
+import protocol
+
+# rsync-style delta of a new file against an older copy (the basis) that
+# only the client has. The client sends a SIGNATURE per basis block: an
+# Adler-32 that can be rolled along the new file a byte at a time, and a
+# short blake2b to confirm what the Adler-32 only suggests. The server
+# answers with COPY ops for the blocks it found and DATA ops for everything
+# else, all deflated as one stream.
+BLOCK_MIN = 2 * 1024
+BLOCK_MAX = 1024 * 1024
+# Signatures of at most MAX_BLOCKS blocks fit in one control frame even
+# base64-encoded; a basis bigger than MAX_BLOCKS * BLOCK_MAX is only used
+# up to there.
+MAX_BLOCKS = 256 * 1024
+STRONG_SIZE = 16
+SIGNATURE = struct.Struct(f'!I{STRONG_SIZE}s')
+DELTA_LEVEL = 6
+WINDOW = 4 * 1024 * 1024
+LITERAL_MAX = 1024 * 1024
+# Rolling runs in Python, a byte per step. After ROLL_BLOCKS blocks' worth
+# of steps without a match the matcher only probes every block boundary for
+# SKIP_BLOCKS blocks (at C speed) before it rolls again, twice as many after
+# every roll that found nothing, up to SKIP_MAX. A file that shares nothing
+# with the basis doesn't take minutes that way, and edits shorter than
+# ROLL_BLOCKS - 1 blocks are still stepped over exactly.
+ROLL_BLOCKS = 3
+SKIP_BLOCKS = 16
+SKIP_MAX = 1024
+
+OP_COPY = b'C'
+OP_DATA = b'D'
+COPY = struct.Struct('!cII')
+DATA = struct.Struct('!cI')
+ADLER_MOD = 65521
+
+
+class DeltaError(Exception):
+    pass
+
+
+def block_size(size):
+    # sqrt(size) balances signature size against what a changed byte costs.
+    block = max(math.isqrt(size), -(-size // MAX_BLOCKS))
+    return min(max(block - block % 1024, BLOCK_MIN), BLOCK_MAX)
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def signatures(path, block):
+    out = bytearray()
+    buf = memoryview(bytearray(block))
+    with open(path, 'rb') as f:
+        for _ in range(MAX_BLOCKS):
+            n = f.readinto(buf)
+            if not n:
+                break
+            out += SIGNATURE.pack(zlib.adler32(buf[:n]), strong_hash(buf[:n]))
+    return bytes(out)
+
+
+def signature_table(data):
+    # Adler-32 -> {strong hash: block index}; the first of equal blocks wins.
+    if len(data) % SIGNATURE.size or len(data) // SIGNATURE.size > MAX_BLOCKS:
+        raise DeltaError("Malformed signatures")
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(data)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def matches(path, block, table, hasher=None):
+    # Yields (OP_COPY, index, length) for stretches of the file found in the
+    # basis and (OP_DATA, bytes) for the rest, at most LITERAL_MAX at a time.
+    # Reads the file once, through a window, and feeds it to hasher.
+    with open(path, 'rb') as f:
+        if not table:
+            # No basis: all of it is literal.
+            while True:
+                data = f.read(LITERAL_MAX)
+                if not data:
+                    return
+                if hasher:
+                    hasher.update(data)
+                yield OP_DATA, data
+        buf = f.read(WINDOW)
+        if hasher:
+            hasher.update(buf)
+        eof = len(buf) < WINDOW
+        pos = 0
+        literal = 0
+        weak = None
+        missed = 0
+        skipped = 0
+        roll = block * ROLL_BLOCKS
+        skip = SKIP_BLOCKS
+        while True:
+            if not eof and len(buf) - pos <= block:
+                more = f.read(WINDOW)
+                if hasher:
+                    hasher.update(more)
+                eof = len(more) < WINDOW
+                buf = buf[literal:] + more
+                pos -= literal
+                literal = 0
+            end = min(pos + block, len(buf))
+            if end == pos:
+                break
+            if weak is None:
+                weak = zlib.adler32(buf[pos:end])
+            candidates = table.get(weak)
+            if candidates:
+                index = candidates.get(strong_hash(buf[pos:end]))
+                if index is not None:
+                    if pos > literal:
+                        yield OP_DATA, buf[literal:pos]
+                    yield OP_COPY, index, end - pos
+                    pos = literal = end
+                    weak = None
+                    missed = skipped = 0
+                    skip = SKIP_BLOCKS
+                    continue
+            if end == len(buf):
+                # The end of the file: no next byte to roll in.
+                break
+            if missed < roll:
+                out = buf[pos]
+                a = (weak & 0xffff) - out + buf[end]
+                b = ((weak >> 16) - block * out + a - 1) % ADLER_MOD
+                weak = (b << 16) | (a % ADLER_MOD)
+                pos += 1
+                missed += 1
+            else:
+                pos = end
+                weak = None
+                skipped += 1
+                if skipped >= skip:
+                    missed = skipped = 0
+                    skip = min(skip * 2, SKIP_MAX)
+            if pos - literal >= LITERAL_MAX:
+                yield OP_DATA, buf[literal:pos]
+                literal = pos
+        if len(buf) > literal:
+            yield OP_DATA, buf[literal:]
+
+
+class DeltaEncoder:
+    # Turns matches() into the op stream; consecutive blocks become one COPY.
+    def __init__(self, block):
+        self.block = block
+        self.run = None
+        self.matched = 0
+        self.literal = 0
+
+    def encode(self, op):
+        out = b''
+        if op[0] == OP_COPY:
+            self.matched += op[2]
+            if self.run and self.run[0] + self.run[1] == op[1]:
+                self.run[1] += 1
+                return out
+            out = self.flush()
+            self.run = [op[1], 1]
+            return out
+        self.literal += len(op[1])
+        return self.flush() + DATA.pack(OP_DATA, len(op[1])) + op[1]
+
+    def flush(self):
+        if self.run is None:
+            return b''
+        out = COPY.pack(OP_COPY, *self.run)
+        self.run = None
+        return out
+
+
+def write_delta(path, block, table, fileobj, level=DELTA_LEVEL):
+    # Deflated op stream into fileobj. Returns the encoder (for its matched
+    # and literal byte counts) and the hash of the new file.
+    hasher = protocol.new_hash()
+    encoder = DeltaEncoder(block)
+    deflate = zlib.compressobj(level)
+    for op in matches(path, block, table, hasher):
+        data = encoder.encode(op)
+        if data:
+            fileobj.write(deflate.compress(data))
+    fileobj.write(deflate.compress(encoder.flush()))
+    fileobj.write(deflate.flush())
+    return encoder, hasher.hexdigest()
+
+
+class Patcher:
+    # Applies an op stream, fed in arbitrary pieces, to the basis file and
+    # writes the new version to out.
+    def __init__(self, basis, block, out, chunk=protocol.HASH_CHUNK):
+        self.basis = basis
+        self.block = block
+        self.out = out
+        self.chunk = chunk
+        self.pending = b''
+        self.literal = 0
+        self.written = 0
+
+    def feed(self, data):
+        pending = self.pending + data if self.pending else bytes(data)
+        pos = 0
+        while pos < len(pending):
+            if self.literal:
+                n = min(self.literal, len(pending) - pos)
+                self.write(pending[pos:pos + n])
+                self.literal -= n
+                pos += n
+            elif pending[pos:pos + 1] == OP_COPY:
+                if len(pending) - pos < COPY.size:
+                    break
+                _, index, count = COPY.unpack_from(pending, pos)
+                self.copy(index, count)
+                pos += COPY.size
+            elif pending[pos:pos + 1] == OP_DATA:
+                if len(pending) - pos < DATA.size:
+                    break
+                _, self.literal = DATA.unpack_from(pending, pos)
+                pos += DATA.size
+            else:
+                raise DeltaError(f"Bad delta op {pending[pos:pos + 1]!r}")
+        self.pending = pending[pos:]
+
+    def copy(self, index, count):
+        if self.basis is None:
+            raise DeltaError("Delta refers to a basis the client didn't send")
+        self.basis.seek(index * self.block)
+        remaining = count * self.block
+        while remaining > 0:
+            data = self.basis.read(min(remaining, self.chunk))
+            if not data:
+                if remaining >= self.block:
+                    raise DeltaError(f"Delta refers to block {index} past the end of the basis")
+                break
+            self.write(data)
+            remaining -= len(data)
+
+    def write(self, data):
+        self.out.write(data)
+        self.written += len(data)
+
+    def complete(self):
+        return not self.pending and not self.literal
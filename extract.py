@@ -0,0 +1,375 @@
+import os
+import bz2
+import lzma
+import zlib
+import queue
+import struct
+import tarfile
+import zipfile
+import threading
+import time
+
+from compressors import DATA_DESCRIPTOR, DATA_DESCRIPTOR64, LOCAL_HEADER
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extraction while an archive is still arriving. Received chunks go through
+# a bounded queue to a decompressing thread and its output through another
+# to a writing thread, so receiving, decompressing and writing overlap and
+# each extracted file is written once. When a queue is full the stage before
+# it waits, the receiving one included.
+RECEIVE_QUEUE = 16
+WRITE_QUEUE = 16
+OUT_CHUNK = 1024 * 1024
+READ_CHUNK = 256 * 1024
+
+ZIP_SIGNATURE = b'PK\x03\x04'
+ZIP_END = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP64_EXTRA = 0x0001
+FLAG_ENCRYPTED = 0x01
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+class ExtractError(Exception):
+    pass
+
+
+def supported(extension):
+    if extension in ('.zip', '.tar.xz'):
+        return True
+    return extension in ('.zst', '.tar.zst') and zstandard is not None
+
+
+class ZipLzma:
+    # An LZMA zip member: a 4-byte header and the LZMA1 properties, then a
+    # raw stream. zipfile's own decompressor has no max_length.
+    def __init__(self):
+        self.header = b''
+        self.inner = None
+        self.eof = False
+        self.needs_input = True
+        self.unused_data = b''
+
+    def decompress(self, data, max_length=-1):
+        if self.inner is None:
+            self.header += data
+            if len(self.header) < 4:
+                return b''
+            size, = struct.unpack('<H', self.header[2:4])
+            if len(self.header) < 4 + size:
+                return b''
+            self.inner = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[
+                lzma._decode_filter_properties(lzma.FILTER_LZMA1, self.header[4:4 + size])])
+            data = self.header[4 + size:]
+        out = self.inner.decompress(data, max_length)
+        self.eof = self.inner.eof
+        self.needs_input = self.inner.needs_input
+        self.unused_data = self.inner.unused_data
+        return out
+
+
+def member_decompressor(method):
+    if method == zipfile.ZIP_STORED:
+        return None
+    if method == zipfile.ZIP_DEFLATED:
+        return zlib.decompressobj(-15)
+    if method == zipfile.ZIP_BZIP2:
+        return bz2.BZ2Decompressor()
+    if method == zipfile.ZIP_LZMA:
+        return ZipLzma()
+    raise ExtractError(f"Unsupported zip compression method {method}")
+
+
+def inflate(d, data):
+    # The output for data in pieces of at most OUT_CHUNK, so a member that
+    # compressed a thousandfold doesn't land in memory at once.
+    out = d.decompress(data, OUT_CHUNK)
+    while True:
+        if out:
+            yield out
+        if d.eof:
+            return
+        if hasattr(d, 'unconsumed_tail'):
+            if not d.unconsumed_tail:
+                return
+            out = d.decompress(d.unconsumed_tail, OUT_CHUNK)
+        else:
+            if d.needs_input:
+                return
+            out = d.decompress(b'', OUT_CHUNK)
+
+
+class ChunkReader:
+    # File-like end of the receive queue for the decompressing thread.
+    def __init__(self, chunks, extractor):
+        self.chunks = chunks
+        self.extractor = extractor
+        self.buffer = b''
+        self.eof = False
+
+    def next_chunk(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        if self.eof:
+            return b''
+        started = time.perf_counter()
+        data = self.chunks.get()
+        self.extractor.waited += time.perf_counter() - started
+        if data is None:
+            self.eof = True
+            return b''
+        return data
+
+    def read_some(self, size=READ_CHUNK):
+        data = self.next_chunk()
+        if len(data) > size:
+            self.buffer = data[size:]
+            data = data[:size]
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = []
+            while True:
+                data = self.next_chunk()
+                if not data:
+                    return b''.join(parts)
+                parts.append(data)
+        parts = []
+        while size > 0:
+            data = self.read_some(size)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def read_exact(self, size):
+        data = self.read(size)
+        if len(data) < size:
+            raise ExtractError("Archive ended early")
+        return data
+
+    def unread(self, data):
+        if data:
+            self.buffer = data + self.buffer
+
+    def drain(self):
+        while self.next_chunk():
+            pass
+
+
+class Extractor:
+    # Extracts an archive fed to it a chunk at a time. With single, its one
+    # file is written to target; otherwise target is a directory and the
+    # archive's paths are kept under it. sizes are the sizes of the files in
+    # the order they come (ENTRY frames, or META for a single file); a zip
+    # streamed by the server gives no size for a stored member, so they are
+    # needed for those. decompress_time leaves out the time spent waiting on
+    # either queue.
+    def __init__(self, extension, target, single, sizes=None):
+        self.extension = extension
+        self.target = target
+        self.single = single
+        self.sizes = list(sizes or [])
+
+        self.chunks = queue.Queue(RECEIVE_QUEUE)
+        self.writes = queue.Queue(WRITE_QUEUE)
+        self.files = []
+        self.error = None
+        self.closed = False
+        self.waited = 0.0
+        self.decompress_time = 0.0
+        self.write_time = 0.0
+        self.threads = [threading.Thread(target=self.decompress, daemon=True),
+                        threading.Thread(target=self.write, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def feed(self, data):
+        # data must not change afterwards: it is read by another thread.
+        self.chunks.put(data)
+
+    def add_size(self, size):
+        self.sizes.append(size)
+
+    def close(self):
+        # Waits for everything fed so far to be on disk.
+        if not self.closed:
+            self.closed = True
+            self.chunks.put(None)
+            for thread in self.threads:
+                thread.join()
+        if self.error:
+            raise ExtractError(self.error)
+        return self.files
+
+    def decompress(self):
+        started = time.perf_counter()
+        reader = ChunkReader(self.chunks, self)
+        try:
+            if self.extension == '.zip':
+                self.extract_zip(reader)
+            elif self.extension == '.zst':
+                self.extract_stream(zstandard.ZstdDecompressor().stream_reader(reader, read_across_frames=True))
+            elif self.extension == '.tar.zst':
+                self.extract_tar(zstandard.ZstdDecompressor().stream_reader(reader, read_across_frames=True))
+            elif self.extension == '.tar.xz':
+                self.extract_tar(lzma.LZMAFile(reader))
+            else:
+                raise ExtractError(f"Can't extract {self.extension} archives")
+        except (ExtractError, OSError, EOFError, zlib.error, lzma.LZMAError, tarfile.TarError) as e:
+            self.error = self.error or str(e)
+        except Exception as e:
+            self.error = self.error or f"{type(e).__name__}: {e}"
+        finally:
+            # The receiving thread must never wait on a stage that is gone.
+            reader.drain()
+            self.decompress_time = time.perf_counter() - started - self.waited
+            self.writes.put(None)
+
+    def write(self):
+        f = None
+        while True:
+            item = self.writes.get()
+            if item is None:
+                break
+            if self.error:
+                continue
+            started = time.perf_counter()
+            try:
+                if isinstance(item, str):
+                    os.makedirs(os.path.dirname(item) or '.', exist_ok=True)
+                    f = open(item, 'wb')
+                    self.files.append(item)
+                elif item is False:
+                    f.close()
+                    f = None
+                else:
+                    f.write(item)
+            except OSError as e:
+                self.error = str(e)
+            self.write_time += time.perf_counter() - started
+        if f:
+            f.close()
+
+    def put(self, item):
+        started = time.perf_counter()
+        self.writes.put(item)
+        self.waited += time.perf_counter() - started
+
+    def member_path(self, name, index):
+        if self.single:
+            if index:
+                raise ExtractError("Expected a single file, the archive has more")
+            return self.target
+        root = os.path.realpath(self.target)
+        path = os.path.realpath(os.path.join(root, *name.replace('\\', '/').split('/')))
+        if os.path.commonpath([root, path]) != root or path == root:
+            raise ExtractError(f"Unsafe path in archive: {name}")
+        return path
+
+    def extract_zip(self, reader):
+        index = 0
+        while True:
+            signature = reader.read(4)
+            if not signature or signature in ZIP_END:
+                break
+            if signature != ZIP_SIGNATURE:
+                raise ExtractError("Not a zip archive")
+            (_, _, _, flags, method, _, _, crc, compressed_size, size,
+             name_size, extra_size) = LOCAL_HEADER.unpack(signature + reader.read_exact(LOCAL_HEADER.size - 4))
+            name = reader.read_exact(name_size).decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+            extra = reader.read_exact(extra_size)
+            if flags & FLAG_ENCRYPTED:
+                raise ExtractError(f"{name} is encrypted")
+            zip64 = False
+            pos = 0
+            while pos + 4 <= len(extra):
+                extra_id, extra_len = struct.unpack_from('<2H', extra, pos)
+                if extra_id == ZIP64_EXTRA:
+                    zip64 = True
+                    if size == 0xFFFFFFFF and extra_len >= 16:
+                        size, compressed_size = struct.unpack_from('<2Q', extra, pos + 4)
+                pos += 4 + extra_len
+            if name.endswith('/'):
+                if not self.single:
+                    os.makedirs(self.member_path(name, index), exist_ok=True)
+                continue
+
+            self.put(self.member_path(name, index))
+            d = member_decompressor(method)
+            actual_crc = 0
+            if d is None:
+                remaining = compressed_size
+                if flags & FLAG_DESCRIPTOR and not remaining:
+                    if index >= len(self.sizes):
+                        raise ExtractError(f"Size of stored {name} unknown")
+                    remaining = self.sizes[index]
+                while remaining:
+                    data = reader.read_some(min(remaining, READ_CHUNK))
+                    if not data:
+                        raise ExtractError("Archive ended early")
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    self.put(data)
+                    remaining -= len(data)
+            else:
+                while not d.eof:
+                    data = reader.read_some()
+                    if not data:
+                        raise ExtractError("Archive ended early")
+                    for out in inflate(d, data):
+                        actual_crc = zlib.crc32(out, actual_crc)
+                        self.put(out)
+                reader.unread(d.unused_data)
+            self.put(False)
+
+            if flags & FLAG_DESCRIPTOR:
+                descriptor = DATA_DESCRIPTOR64 if zip64 else DATA_DESCRIPTOR
+                head = reader.read_exact(4)
+                if head != DESCRIPTOR_SIGNATURE:
+                    # The signature is optional.
+                    reader.unread(head)
+                    head = DESCRIPTOR_SIGNATURE
+                _, crc, _, _ = descriptor.unpack(head + reader.read_exact(descriptor.size - 4))
+            if actual_crc != crc:
+                raise ExtractError(f"CRC error in {name}")
+            index += 1
+        if not index and not self.error:
+            raise ExtractError("Empty archive")
+
+    def extract_stream(self, stream):
+        self.put(self.member_path(None, 0))
+        while True:
+            data = stream.read(OUT_CHUNK)
+            if not data:
+                break
+            self.put(data)
+        self.put(False)
+
+    def extract_tar(self, stream):
+        # Only regular files and directories; links and devices are skipped.
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            index = 0
+            for member in tar:
+                if member.isdir():
+                    if not self.single:
+                        os.makedirs(self.member_path(member.name, index), exist_ok=True)
+                    continue
+                if not member.isfile():
+                    continue
+                self.put(self.member_path(member.name, index))
+                src = tar.extractfile(member)
+                while True:
+                    data = src.read(OUT_CHUNK)
+                    if not data:
+                        break
+                    self.put(data)
+                self.put(False)
+                index += 1
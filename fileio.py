@@ -0,0 +1,93 @@
+import os
+import mmap
+
+READ_CHUNK = 1024 * 1024
+# 'read' reads into a few reused buffers. 'mmap' maps the input one
+# MAP_WINDOW at a time and hands out slices of the mapping, so the
+# compressors read the page cache directly. That saves one copy (stored
+# archives build ~15% faster, see benchmarks/bench_io.py), but an input
+# truncated while mapped kills the whole server with SIGBUS.
+READ_MODE = 'read'
+MAP_WINDOW = 32 * 1024 * 1024
+# Inputs this big are dropped from the page cache behind the reader. They're
+# read once to be compressed and would only push out the cached archives
+# that are actually being served.
+DROP_BEHIND_SIZE = 256 * 1024 * 1024
+
+
+def advise(fd, offset, length, name):
+    # posix_fadvise where the platform has it (not Windows or macOS); it is
+    # only a hint, so failing is fine.
+    advice = getattr(os, name, None)
+    if advice is not None:
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def chunks(path, chunk=READ_CHUNK, buffers=1, mode=None, pace=None):
+    # Yields the file as memoryviews of at most `chunk` bytes, using memory
+    # bounded by the chunk size whatever the file size. A view stays valid
+    # until `buffers` more have been taken, so pass more than one buffer
+    # when views are handed to other threads. pace(size), if given, is
+    # called with the size of every chunk before it is handed out and may
+    # block to slow the reader down (see warmup.Pacer).
+    mode = mode or READ_MODE
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        advise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+        drop = size >= DROP_BEHIND_SIZE
+        if mode == 'mmap' and size:
+            views = mapped_chunks(fd, size, chunk, drop)
+        else:
+            views = read_chunks(f, chunk, buffers, drop)
+        if pace is None:
+            yield from views
+            return
+        for view in views:
+            pace(len(view))
+            yield view
+
+
+def mapped_chunks(fd, size, chunk, drop):
+    window = max(MAP_WINDOW // mmap.ALLOCATIONGRANULARITY, 1) * mmap.ALLOCATIONGRANULARITY
+    chunk = min(chunk, window)
+    offset = 0
+    while offset < size:
+        length = min(window, size - offset)
+        mapping = mmap.mmap(fd, length, access=mmap.ACCESS_READ, offset=offset)
+        if hasattr(mapping, 'madvise'):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapping)
+        for start in range(0, length, chunk):
+            yield view[start:start + chunk]
+        # Not closed here: the window is unmapped once the last slice of it
+        # is released, which may be after the next window is mapped.
+        del view, mapping
+        if drop and offset:
+            # Pages still mapped are kept anyway, hence one window behind.
+            advise(fd, offset - window, window, 'POSIX_FADV_DONTNEED')
+        offset += length
+    if drop:
+        advise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
+
+
+def read_chunks(f, chunk, buffers, drop):
+    ring = [memoryview(bytearray(chunk)) for _ in range(buffers)]
+    fd = f.fileno()
+    offset = 0
+    index = 0
+    while True:
+        buf = ring[index]
+        n = f.readinto(buf)
+        if not n:
+            break
+        yield buf[:n]
+        index = (index + 1) % buffers
+        offset += n
+        if drop and offset % MAP_WINDOW < n:
+            advise(fd, 0, offset, 'POSIX_FADV_DONTNEED')
+    if drop:
+        advise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
@@ -0,0 +1,101 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+DB_PATH = 'download_log.db'
+LOG_PAGE_SIZE = 200
+TOP_FILES = 50
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS download_log_timestamp ON download_log (timestamp)',
+    'CREATE INDEX IF NOT EXISTS download_log_filename ON download_log (filename)',
+    'CREATE INDEX IF NOT EXISTS download_log_client_ip ON download_log (client_ip)',
+    # For the archive store, which rewrites save_path when it removes a file.
+    'CREATE INDEX IF NOT EXISTS download_log_save_path ON download_log (save_path)',
+)
+
+COLUMNS = ('id, timestamp, client_ip, filename, original_size, compressed_size, '
+           'compression_ratio, codec, level, save_path')
+
+
+def create_indexes(cursor):
+    for sql in INDEXES:
+        cursor.execute(sql)
+
+
+def match_clause(column, text, clauses, params):
+    if any(c in text for c in '*?['):
+        clauses.append(f'{column} GLOB ?')
+        params.append(text)
+    else:
+        # A range rather than LIKE 'x%', so the index on the column is used.
+        clauses.append(f'{column} >= ? AND {column} < ?')
+        params.extend([text, text + '\U0010ffff'])
+
+
+def parse_date(text):
+    try:
+        return datetime.strptime(text, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"Invalid date (expected YYYY-MM-DD): {text}")
+
+
+class LogQuery:
+    # One filtered view of download_log. Every call opens its own
+    # connection, so pages and summaries can be fetched from worker threads.
+    # Timestamps are stored in UTC, and so are the date bounds.
+    def __init__(self, db_path=DB_PATH, filename='', ip='', date_from='', date_to=''):
+        self.db_path = db_path
+        clauses = []
+        self.params = []
+        if filename:
+            match_clause('filename', filename, clauses, self.params)
+        if ip:
+            match_clause('client_ip', ip, clauses, self.params)
+        if date_from:
+            clauses.append('timestamp >= ?')
+            self.params.append(parse_date(date_from).strftime('%Y-%m-%d'))
+        if date_to:
+            clauses.append('timestamp < ?')
+            self.params.append((parse_date(date_to) + timedelta(days=1)).strftime('%Y-%m-%d'))
+        self.clauses = clauses
+
+    def where(self, extra=None):
+        clauses = self.clauses + ([extra] if extra else [])
+        return ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+    def page(self, after=None, limit=LOG_PAGE_SIZE):
+        # Keyset pagination: the next page starts below the last
+        # (timestamp, id) already shown, so page 1000 costs the same as page 1.
+        params = list(self.params)
+        extra = None
+        if after:
+            extra = '(timestamp, id) < (?, ?)'
+            params.extend(after)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(f'''
+                SELECT {COLUMNS} FROM download_log{self.where(extra)}
+                ORDER BY timestamp DESC, id DESC LIMIT ?
+            ''', params + [limit]).fetchall()
+        finally:
+            conn.close()
+
+    def summary(self, top=TOP_FILES):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            count, original, compressed, mean_ratio = conn.execute(f'''
+                SELECT COUNT(*), COALESCE(SUM(original_size), 0), COALESCE(SUM(compressed_size), 0),
+                       AVG(compression_ratio)
+                FROM download_log{self.where()}
+            ''', self.params).fetchone()
+            files = conn.execute(f'''
+                SELECT filename, COUNT(*), SUM(compressed_size),
+                       SUM(original_size - compressed_size), AVG(compression_ratio)
+                FROM download_log{self.where()}
+                GROUP BY filename ORDER BY SUM(compressed_size) DESC LIMIT ?
+            ''', self.params + [top]).fetchall()
+        finally:
+            conn.close()
+        return {'count': count, 'original': original, 'compressed': compressed,
+                'saved': original - compressed, 'mean_ratio': mean_ratio or 0.0,
+                'files': files}
@@ -0,0 +1,111 @@
+import time
+import queue
+import logging
+import sqlite3
+import threading
+
+import metrics
+
+INSERT_SQL = '''
+    INSERT INTO download_log (client_ip, filename, original_size, compressed_size, compression_ratio, save_path, codec, level, archive_hash, predicted_time, transfer_time)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+UPDATE_PATH_SQL = 'UPDATE download_log SET save_path = ? WHERE save_path = ?'
+
+log = logging.getLogger('log_writer')
+
+
+class PathChange:
+    # Queued like a record: save_path `old` becomes `new` (None: deleted).
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+
+class LogWriter:
+    # Handler threads only put records on a queue. One writer thread owns
+    # the sqlite connection and inserts whatever has queued up in a single
+    # transaction every flush_interval seconds or every batch_size records.
+    def __init__(self, db_path, batch_size=500, flush_interval=1.0, synchronous='NORMAL', max_queue=100000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.stopping = object()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('log_records_dropped')
+            if isinstance(record, PathChange):
+                log.warning(f"[DB] Log queue full, save_path {record.old} not updated")
+            else:
+                log.warning(f"[DB] Log queue full, dropped record for {record[1]}")
+            return False
+
+    def update_path(self, old, new=None):
+        # Applied after the records queued before it, so a record of a
+        # download can't point at an archive that was removed afterwards.
+        return self.add(PathChange(old, new))
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        try:
+            stop = False
+            while not stop:
+                batch = []
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                    while True:
+                        if item is self.stopping:
+                            stop = True
+                            break
+                        batch.append(item)
+                        if len(batch) >= self.batch_size:
+                            break
+                        item = self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                if batch:
+                    self.write(conn, batch)
+        finally:
+            conn.close()
+
+    def write(self, conn, batch):
+        started = time.perf_counter()
+        # Runs of records and of path changes, in the order they were queued:
+        # a change must not touch a record of an archive rebuilt after it.
+        runs = []
+        for item in batch:
+            change = isinstance(item, PathChange)
+            if not runs or runs[-1][0] != change:
+                runs.append((change, []))
+            runs[-1][1].append((item.new, item.old) if change else item)
+        records = sum(len(items) for change, items in runs if not change)
+        changes = len(batch) - records
+        try:
+            with conn:
+                for change, items in runs:
+                    conn.executemany(UPDATE_PATH_SQL if change else INSERT_SQL, items)
+            self.written += records
+            metrics.inc('log_records', records)
+            log.debug(f"[DB] Wrote {records} records, {changes} path changes")
+        except sqlite3.Error as e:
+            log.error(f"[DB] {e}")
+        metrics.observe('db_write', time.perf_counter() - started)
+
+    def close(self):
+        # Everything queued before close() is written before it returns.
+        self.queue.put(self.stopping)
+        self.thread.join()
@@ -0,0 +1,37 @@
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(message)s'
+
+listener = None
+
+
+def setup_logging(level='INFO', path=None):
+    # Request threads only put records on a queue; one listener thread
+    # formats and writes them, so a slow terminal or disk never holds up a
+    # transfer. Records below level are dropped before they are queued.
+    global listener
+    if listener is None:
+        atexit.register(stop_logging)
+    else:
+        listener.stop()
+    handler = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(records)]
+    root.setLevel(level)
+    listener = QueueListener(records, handler)
+    listener.start()
+    return listener
+
+
+def stop_logging():
+    # Writes out whatever is still queued.
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'savefiles'
+# Seconds; wide enough for a LIST reply and a multi-GB compression alike.
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 30
+
+log = logging.getLogger('metrics')
+
+
+class Histogram:
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Interpolated within the bucket the rank falls in, like Prometheus'
+        # histogram_quantile().
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class Registry:
+    # Counters only go up, gauges are read from callbacks when a snapshot
+    # is taken, and every timed phase of a request has a histogram.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.phases = {}
+        self.started = time.time()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def read_gauges(self):
+        values = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                values[name] = read()
+            except Exception as e:
+                log.debug(f"[METRICS] gauge {name}: {e}")
+        return values
+
+    def snapshot(self):
+        gauges = self.read_gauges()
+        with self.lock:
+            return {'uptime': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'gauges': gauges,
+                    'phases': {phase: h.snapshot() for phase, h in self.phases.items()}}
+
+    def prometheus(self):
+        # Text exposition format 0.0.4.
+        gauges = self.read_gauges()
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                lines.append(f"{PREFIX}_{name}_total {value}")
+            name = f"{PREFIX}_phase_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for phase, h in sorted(self.phases.items()):
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{phase="{phase}",le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{phase="{phase}"}} {h.sum}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {h.count}')
+        for name, value in sorted(gauges.items()):
+            if value is not None:
+                lines.append(f"# TYPE {PREFIX}_{name} gauge")
+                lines.append(f"{PREFIX}_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    # Samples the stacks of every thread each interval. cProfile would only
+    # see the thread that enabled it, and its per-call overhead would skew
+    # the very timings being looked at; sampling costs a few percent at most.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.own = Counter()
+        self.total = Counter()
+        self.stacks = Counter()
+        self.started = None
+        self.seconds = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return False
+            self.reset()
+            self.started = time.monotonic()
+            self.running.set()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            log.info(f"[PROFILE] started, sampling every {self.interval * 1000:.0f} ms")
+            return True
+
+    def stop(self, top=PROFILE_TOP):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread:
+            self.running.clear()
+            thread.join()
+            self.seconds = time.monotonic() - self.started
+            log.info(f"[PROFILE] stopped after {self.seconds:.1f} s, {self.samples} samples")
+        return self.report(top)
+
+    def run(self):
+        me = threading.get_ident()
+        while self.running.is_set():
+            with self.lock:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    self.samples += 1
+                    self.own[stack[0]] += 1
+                    self.total.update(set(stack))
+                    self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def report(self, top=PROFILE_TOP):
+        # Shares of all samples; threads blocked in recv/wait show up too,
+        # which is where a request spends its time when it isn't computing.
+        with self.lock:
+            running = self.thread is not None
+            seconds = time.monotonic() - self.started if running else self.seconds
+            samples = self.samples or 1
+            return {'running': running, 'samples': self.samples, 'seconds': seconds,
+                    'top': [{'function': name, 'own': n / samples, 'total': self.total[name] / samples}
+                            for name, n in self.own.most_common(top)]}
+
+    def folded(self):
+        # One "frame;frame;frame count" line per stack, as flamegraph.pl reads.
+        with self.lock:
+            return ''.join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+registry = Registry()
+profiler = SamplingProfiler()
+
+
+def inc(name, amount=1):
+    registry.inc(name, amount)
+
+
+def observe(phase, seconds):
+    registry.observe(phase, seconds)
+
+
+def gauge(name, read):
+    registry.gauge(name, read)
+
+
+@contextmanager
+def timer(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(phase, time.perf_counter() - started)
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def prometheus():
+    return registry.prometheus()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/metrics':
+            self.reply(prometheus(), 'text/plain; version=0.0.4')
+        elif path == '/stats':
+            self.reply(json.dumps(snapshot(), indent=2), 'application/json')
+        elif path == '/profile/start':
+            profiler.start()
+            self.reply(json.dumps(profiler.report()), 'application/json')
+        elif path == '/profile/stop':
+            self.reply(json.dumps(profiler.stop(), indent=2), 'application/json')
+        elif path == '/profile/folded':
+            self.reply(profiler.folded(), 'text/plain')
+        else:
+            self.send_error(404)
+
+    def reply(self, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(f"[METRICS] {self.address_string()} {format % args}")
+
+
+def serve_http(host, port):
+    # /metrics for Prometheus, /stats as JSON and /profile/start, /stop and
+    # /folded to profile a running server.
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"[METRICS] http://{host}:{server.server_address[1]}/metrics")
+    return server
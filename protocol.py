@@ -0,0 +1,293 @@
+import json
+import hashlib
+import socket
+import struct
+import threading
+import time
+
+# Framed protocol. A client opens with MAGIC and a HELLO frame listing the
+# versions it speaks; the server answers HELLO with the version it picked.
+# Every frame is FRAME_HEADER (type, stream id, payload length) + payload.
+# Control payloads are JSON, DATA payloads are raw archive bytes.
+MAGIC = b'SVF\x00'
+PROTOCOL_VERSIONS = (1,)
+FRAME_HEADER = struct.Struct('!BII')
+MAX_CONTROL_FRAME = 16 * 1024 * 1024
+STREAM_CHUNK = 256 * 1024
+SENDFILE_CHUNK = 1024 * 1024
+RECV_CHUNK = 1024 * 1024
+BUSY_REPLY = b"BUSY"
+HASH_NAME = 'blake2b'
+HASH_CHUNK = 1024 * 1024
+# The send rate is measured over windows of LINK_WINDOW bytes and smoothed.
+# A window counts as link-bound when sends blocked for over LINK_BACKLOG of
+# it; a pause of LINK_IDLE seconds starts a new one.
+LINK_WINDOW = 1024 * 1024
+LINK_SMOOTHING = 0.3
+LINK_BACKLOG = 0.05
+LINK_IDLE = 1.0
+
+HELLO = 1
+LIST = 2
+FILES = 3
+DOWNLOAD = 4
+META = 5
+DATA = 6
+END = 7
+ERROR = 8
+BUSY = 9
+EXIT = 10
+VERIFY = 11
+BUNDLE = 12
+ENTRY = 13
+STATS = 14
+PROFILE = 15
+DELTA = 16
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_control(ftype, stream_id, fields):
+    payload = json.dumps(fields).encode('utf-8')
+    return FRAME_HEADER.pack(ftype, stream_id, len(payload)) + payload
+
+
+def hello_frame(streams=1):
+    return MAGIC + encode_control(HELLO, 0, {'versions': list(PROTOCOL_VERSIONS), 'streams': streams})
+
+
+def new_hash():
+    # Every archive is checked end to end with this; its hexdigest is what
+    # META/END carry as 'hash' and what download_log stores.
+    return hashlib.blake2b()
+
+
+def hash_file(path, size=None):
+    # Hash of the first `size` bytes of a file (all of it by default).
+    h = new_hash()
+    buf = memoryview(bytearray(HASH_CHUNK))
+    with open(path, 'rb') as f:
+        remaining = size
+        while remaining is None or remaining > 0:
+            n = f.readinto(buf if remaining is None else buf[:min(remaining, HASH_CHUNK)])
+            if not n:
+                break
+            h.update(buf[:n])
+            if remaining is not None:
+                remaining -= n
+    return h
+
+
+def tune_socket(sock, sndbuf=None, rcvbuf=None):
+    # None keeps the OS default. On Linux that also keeps buffer
+    # auto-tuning, which a fixed SO_SNDBUF/SO_RCVBUF switches off.
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+
+class FrameConnection:
+    def __init__(self, sock, recv_chunk=RECV_CHUNK):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.recv_chunk = recv_chunk
+        self.recv_buffer = None
+        self.received = 0
+        self.link_rate = None
+        self.window_start = None
+        self.window_bytes = 0
+        self.window_time = 0.0
+        self.last_sent = 0.0
+        # Set by the server to share its send bandwidth, see scheduler.py.
+        self.scheduler = None
+        self.flow = None
+        # Frame headers are tiny separate writes; Nagle would hold them back.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send_raw(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def pace(self, size):
+        # Waiting for the scheduler counts as send time, like a full socket
+        # buffer: either way the link (or this client's share of it) is the
+        # limit.
+        if self.scheduler:
+            self.scheduler.send(self.flow, size)
+
+    def send_frame(self, ftype, stream_id, payload=b''):
+        started = time.perf_counter()
+        if ftype == DATA:
+            self.pace(len(payload))
+        with self.send_lock:
+            self.sock.sendall(FRAME_HEADER.pack(ftype, stream_id, len(payload)))
+            if payload:
+                self.sock.sendall(payload)
+            self.note_sent(len(payload), time.perf_counter() - started)
+
+    def note_sent(self, size, seconds):
+        # sendall returns once the kernel has taken the data, so it only
+        # blocks while the socket buffer is full. If that happened a fair
+        # part of the time, the link was the limit and bytes over wall time
+        # is its rate (shared by the streams of this connection). If not,
+        # the link kept up and bytes over blocked time is a rate far above
+        # anything being produced. Called under send_lock.
+        now = time.perf_counter()
+        if self.window_start is None or now - seconds - self.last_sent > LINK_IDLE:
+            self.window_start = now - seconds
+            self.window_bytes = 0
+            self.window_time = 0.0
+        self.last_sent = now
+        self.window_bytes += size
+        self.window_time += seconds
+        if self.window_bytes >= LINK_WINDOW:
+            wall = now - self.window_start
+            if self.window_time > LINK_BACKLOG * wall:
+                rate = self.window_bytes / wall
+            else:
+                rate = self.window_bytes / max(self.window_time, 1e-6)
+            # Smoothed as time per byte, so one huge reading from a link
+            # that kept up doesn't swamp the ones after it.
+            if self.link_rate is None:
+                self.link_rate = rate
+            else:
+                self.link_rate = 1 / (1 / self.link_rate + LINK_SMOOTHING * (1 / rate - 1 / self.link_rate))
+            self.window_start = now
+            self.window_bytes = 0
+            self.window_time = 0.0
+
+    def send_control(self, ftype, stream_id, **fields):
+        self.send_raw(encode_control(ftype, stream_id, fields))
+
+    def send_file(self, stream_id, f, offset, count, chunk=SENDFILE_CHUNK):
+        # DATA frames whose bodies go out through zero-copy sendfile.
+        while count > 0:
+            size = min(count, chunk)
+            started = time.perf_counter()
+            self.pace(size)
+            with self.send_lock:
+                self.sock.sendall(FRAME_HEADER.pack(DATA, stream_id, size))
+                self.sock.sendfile(f, offset, size)
+                self.note_sent(size, time.perf_counter() - started)
+            offset += size
+            count -= size
+
+    def recv_exact(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        while got < size:
+            n = self.sock.recv_into(view[got:], size - got)
+            if n == 0:
+                raise ConnectionError("Connection closed")
+            got += n
+        self.received += size
+        return bytes(buf)
+
+    def recv_view(self, size):
+        # Up to `size` bytes, received into one buffer that the next call
+        # reuses: nothing is allocated per chunk, so the caller has to
+        # consume the view (e.g. write it to a file) before reading again.
+        if self.recv_buffer is None:
+            self.recv_buffer = memoryview(bytearray(self.recv_chunk))
+        n = self.sock.recv_into(self.recv_buffer, min(size, self.recv_chunk))
+        if n == 0:
+            raise ConnectionError("Connection closed")
+        self.received += n
+        return self.recv_buffer[:n]
+
+    def discard(self, size):
+        while size > 0:
+            size -= len(self.recv_view(size))
+
+    def recv_header(self):
+        return FRAME_HEADER.unpack(self.recv_exact(FRAME_HEADER.size))
+
+    def recv_frame(self):
+        ftype, stream_id, size = self.recv_header()
+        if ftype != DATA and size > MAX_CONTROL_FRAME:
+            raise ProtocolError(f"Control frame too large: {size}")
+        return ftype, stream_id, self.recv_exact(size) if size else b''
+
+    def recv_control(self):
+        ftype, stream_id, payload = self.recv_frame()
+        if ftype == DATA:
+            raise ProtocolError("Unexpected DATA frame")
+        return ftype, stream_id, json.loads(payload) if payload else {}
+
+    def recv_hello(self):
+        # A server with no free connection slots answers a bare b"BUSY"
+        # instead of HELLO.
+        head = self.recv_exact(len(BUSY_REPLY))
+        if head == BUSY_REPLY:
+            return None
+        ftype, stream_id, size = FRAME_HEADER.unpack(head + self.recv_exact(FRAME_HEADER.size - len(head)))
+        fields = json.loads(self.recv_exact(size)) if size else {}
+        if ftype == ERROR:
+            raise ProtocolError(fields.get('message', "Handshake failed"))
+        if ftype != HELLO:
+            raise ProtocolError(f"Expected HELLO, got frame type {ftype}")
+        return fields
+
+
+class HashWriter:
+    # Write-through file wrapper that hashes everything written to it.
+    def __init__(self, f):
+        self.f = f
+        self.hash = new_hash()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+class FrameWriter:
+    # File-like sink for the compressors: output is buffered up to
+    # STREAM_CHUNK, hashed and sent as DATA frames, optionally copied into tee.
+    # If the client goes away the copy into tee still completes, so the
+    # archive is not wasted and a resumed download can pick it up.
+    def __init__(self, fc, stream_id, tee=None, chunk=STREAM_CHUNK):
+        self.fc = fc
+        self.stream_id = stream_id
+        self.tee = tee
+        self.chunk = chunk
+        self.buffer = bytearray()
+        self.total = 0
+        self.error = None
+        self.hash = new_hash()
+        # Time spent blocked on the socket, so it can be told apart from
+        # the compressor's own time.
+        self.send_time = 0.0
+
+    def write(self, data):
+        self.buffer += data
+        self.total += len(data)
+        if len(self.buffer) >= self.chunk:
+            self.flush()
+        return len(data)
+
+    def link_rate(self):
+        # For the adaptive codec; None until enough has been sent to tell.
+        return self.fc.link_rate
+
+    def flush(self):
+        if self.buffer:
+            self.hash.update(self.buffer)
+            if self.error is None:
+                started = time.perf_counter()
+                try:
+                    self.fc.send_frame(DATA, self.stream_id, self.buffer)
+                except OSError as e:
+                    self.error = e
+                self.send_time += time.perf_counter() - started
+            if self.tee:
+                self.tee.write(self.buffer)
+            elif self.error:
+                raise self.error
+            self.buffer = bytearray()
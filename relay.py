@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+
+import metrics
+import protocol
+from transfer import BUSY_MESSAGE, DEFAULT_STREAMS, Reply, ServerBusyError, Session
+
+log = logging.getLogger('relay')
+
+
+class RelayError(Exception):
+    pass
+
+
+class Fill(Reply):
+    # A DOWNLOAD reply from the origin, written straight to `path`.
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.meta = None
+        self.file = None
+        self.hash = protocol.new_hash()
+        self.received = 0
+
+    def on_meta(self, fields):
+        self.meta = fields
+        self.file = open(self.path, 'wb')
+
+    def on_data(self, conn, size):
+        while size > 0:
+            view = conn.recv_view(size)
+            self.hash.update(view)
+            self.file.write(view)
+            self.received += len(view)
+            size -= len(view)
+
+    def on_end(self, fields):
+        self.file.close()
+        super().on_end(fields)
+
+    def fail(self, message, keep=True):
+        if self.file:
+            self.file.close()
+        super().fail(message, keep)
+
+
+class Upstream:
+    # The origin a relay gets its archives from: one Session, opened on
+    # first use and again whenever the previous one has dropped. Checks
+    # (VERIFY replies: the hash of the archive a DOWNLOAD would get) are
+    # reused for check_interval seconds, so a popular file costs the origin
+    # one round trip per interval rather than one per client. If the origin
+    # can't be reached, the last check is used however old it is, so cached
+    # archives are still served.
+    def __init__(self, host, port, streams=DEFAULT_STREAMS, check_interval=5.0):
+        self.host = host
+        self.port = port
+        self.streams = streams
+        self.check_interval = check_interval
+
+        self.session = None
+        self.checks = {}
+        self.fetches = 0
+        self.fetched_bytes = 0
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None or self.session.closed:
+                try:
+                    self.session = Session(self.host, self.port, self.streams)
+                except ServerBusyError:
+                    raise
+                except OSError as e:
+                    raise ConnectionError(f"Origin {self.host}:{self.port}: {e}")
+                log.info(f"[RELAY] Connected to origin {self.host}:{self.port}")
+            return self.session
+
+    def ask(self, ftype, new_reply, **fields):
+        # One request, sent again on a new connection if the first one
+        # dropped (all requests to the origin are safe to repeat).
+        for _ in range(2):
+            session = self.get_session()
+            reply = new_reply()
+            try:
+                session.send_request(ftype, reply, **fields)
+            except OSError:
+                continue
+            reply.done.wait()
+            if reply.error is None:
+                return reply
+            if reply.error == BUSY_MESSAGE:
+                raise ServerBusyError(reply.error)
+            if not session.closed:
+                raise RelayError(reply.error)
+        raise ConnectionError(f"Origin {self.host}:{self.port}: connection lost")
+
+    def check(self, name, codec):
+        key = (name, codec)
+        with self.lock:
+            known = self.checks.get(key)
+        if known and time.monotonic() - known[1] < self.check_interval:
+            return known[0]
+        try:
+            fields = self.ask(protocol.VERIFY, Reply, name=name, codec=codec).fields
+        except ConnectionError as e:
+            if known is None:
+                raise
+            log.warning(f"[RELAY] {e}; serving {name} as last checked")
+            return known[0]
+        with self.lock:
+            if len(self.checks) > 10000:
+                self.checks.clear()
+            self.checks[key] = (fields, time.monotonic())
+        return fields
+
+    def forget(self, name, codec):
+        with self.lock:
+            self.checks.pop((name, codec), None)
+
+    def fetch(self, name, codec, path):
+        # Returns the origin's META and END for the archive now in path.
+        fill = self.ask(protocol.DOWNLOAD, lambda: Fill(path), name=name, codec=codec)
+        if fill.hash.hexdigest() != fill.fields.get('hash'):
+            raise RelayError(f"Checksum error fetching {name} from the origin")
+        with self.lock:
+            self.fetches += 1
+            self.fetched_bytes += fill.received
+        metrics.inc('relay_fetches')
+        metrics.inc('relay_bytes_in', fill.received)
+        return fill.meta, fill.fields
+
+    def list_files(self, **query):
+        reply = self.ask(protocol.LIST, Reply, **query)
+        return reply.files, reply.fields
+
+    def stats(self):
+        with self.lock:
+            return {'fetches': self.fetches, 'fetched_bytes': self.fetched_bytes, 'checks': len(self.checks)}
@@ -0,0 +1,200 @@
+import time
+import heapq
+import threading
+from collections import deque
+
+import metrics
+
+# Bytes a flow may send per round of deficit round robin. DATA frames are at
+# most SENDFILE_CHUNK, so a bulk flow gets a few frames out per round and a
+# small download waits behind about one of them.
+QUANTUM = 256 * 1024
+# Seconds of unused rate a token bucket saves up, so a flow that was idle
+# can send a short burst at once.
+BURST = 0.25
+
+
+class TokenBucket:
+    # Tokens are bytes, refilled at `rate` per second up to `burst` seconds'
+    # worth. A send may take the bucket below zero; the next one then waits
+    # until it is refilled, so the rate holds on average whatever the sizes.
+    def __init__(self, rate, burst=BURST):
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.capacity)
+        self.updated = now
+
+    def wait_time(self):
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Flow:
+    def __init__(self, key, rate=None):
+        self.key = key
+        self.waiting = deque()
+        self.deficit = 0
+        self.bucket = TokenBucket(rate) if rate else None
+        self.senders = 0
+
+
+class SendScheduler:
+    # Shares the server's send bandwidth between clients. Every DATA frame
+    # asks for its size before it goes out; frames of different flows (one
+    # per client IP, however many connections it opens) are let through by
+    # deficit round robin, at most `rate` bytes/s altogether and `flow_rate`
+    # bytes/s per flow. None means no limit. Without a global rate there is
+    # nothing to queue for: the scheduler only has a link to share when the
+    # rate is set a little below that link's capacity, so the queue builds
+    # up here rather than in a router.
+    def __init__(self, rate=None, flow_rate=None, quantum=QUANTUM):
+        self.rate = rate
+        self.flow_rate = flow_rate
+        self.quantum = quantum
+        self.bucket = TokenBucket(rate) if rate else None
+        self.flows = {}
+        self.active = deque()
+        self.cond = threading.Condition()
+        self.granted = 0
+        self.waits = 0
+
+    def enabled(self):
+        return self.rate is not None or self.flow_rate is not None
+
+    def open(self, key):
+        # A flow lives while any connection of its client does, so a client
+        # can't get a fresh bucket by reconnecting.
+        with self.cond:
+            flow = self.flows.get(key)
+            if flow is None:
+                flow = self.flows[key] = Flow(key, self.flow_rate)
+            flow.senders += 1
+            return flow
+
+    def close(self, flow):
+        with self.cond:
+            flow.senders -= 1
+            if not flow.senders and not flow.waiting:
+                self.flows.pop(flow.key, None)
+
+    def send(self, flow, size):
+        # Blocks until `size` bytes of flow may go out.
+        if flow is None or not self.enabled():
+            return
+        started = time.monotonic()
+        ticket = [size, False]
+        with self.cond:
+            if not flow.waiting:
+                self.active.append(flow)
+            flow.waiting.append(ticket)
+            while True:
+                pause = self.dispatch(time.monotonic())
+                if ticket[1]:
+                    break
+                self.cond.wait(pause)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.waits += 1
+            metrics.observe('pacing', waited)
+
+    def dispatch(self, now):
+        # Grants tickets in DRR order while the buckets allow it. Returns how
+        # long until the next one could be granted (None: until a grant or a
+        # new ticket changes things). Called under cond.
+        if self.bucket:
+            self.bucket.refill(now)
+        granted = False
+        blocked = 0
+        pause = None
+        while self.active and blocked < len(self.active):
+            if self.bucket and self.bucket.tokens < 0:
+                pause = self.bucket.wait_time()
+                break
+            flow = self.active[0]
+            if flow.bucket:
+                flow.bucket.refill(now)
+                if flow.bucket.tokens < 0:
+                    # Over its own limit: the others go first meanwhile.
+                    wait = flow.bucket.wait_time()
+                    pause = wait if pause is None else min(pause, wait)
+                    self.active.rotate(-1)
+                    blocked += 1
+                    continue
+            ticket = flow.waiting[0]
+            if flow.deficit < ticket[0]:
+                flow.deficit += self.quantum
+                self.active.rotate(-1)
+                continue
+            flow.deficit -= ticket[0]
+            if self.bucket:
+                self.bucket.tokens -= ticket[0]
+            if flow.bucket:
+                flow.bucket.tokens -= ticket[0]
+            flow.waiting.popleft()
+            ticket[1] = True
+            granted = True
+            blocked = 0
+            self.granted += ticket[0]
+            if not flow.waiting:
+                # An idle flow doesn't keep its deficit, as in DRR.
+                flow.deficit = 0
+                self.active.popleft()
+                if not flow.senders:
+                    self.flows.pop(flow.key, None)
+        if granted:
+            self.cond.notify_all()
+        return pause
+
+    def stats(self):
+        with self.cond:
+            return {'flows': len(self.flows), 'queued': sum(len(flow.waiting) for flow in self.active),
+                    'granted': self.granted, 'waits': self.waits}
+
+
+class PrioritySlots:
+    # A semaphore whose free slots go to the smallest waiting job first, so
+    # a short compression doesn't queue behind a multi-GB one. Waiting ages
+    # a job by `aging` bytes per second, so big jobs still get their turn
+    # under a steady stream of small ones.
+    def __init__(self, count, aging=None):
+        self.free = count
+        self.aging = aging
+        self.heap = []
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size=0, timeout=None):
+        now = time.monotonic()
+        deadline = None if timeout is None else now + timeout
+        with self.cond:
+            if self.free and not self.heap:
+                self.free -= 1
+                return True
+            self.seq += 1
+            # Aging by waiting time is a fixed offset per job: size minus
+            # aging * (now - queued_at) orders jobs as size + aging * queued_at.
+            waiter = [size + (self.aging or 0) * now, self.seq, False]
+            heapq.heappush(self.heap, waiter)
+            while not waiter[2]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.heap.remove(waiter)
+                    heapq.heapify(self.heap)
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def release(self):
+        with self.cond:
+            if self.heap:
+                heapq.heappop(self.heap)[2] = True
+                self.cond.notify_all()
+            else:
+                self.free += 1
+
+    def waiting(self):
+        with self.cond:
+            return len(self.heap)
@@ -1,21 +1,252 @@
 import socket
 import threading
 import os
-import zipfile
+import sys
+import json
+import base64
+import time
+import atexit
+import logging
 import sqlite3
-from datetime import datetime
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import bundles
+import compressors
+import delta
+import fileio
+import metrics
+import relay
+from archive_cache import ArchiveCache, cache_key
+from archive_store import ArchiveStore
+from catalog import Catalog, FILES_PER_FRAME, PAGE_SIZE
+from log_query import create_indexes
+from log_writer import LogWriter
+from logsetup import setup_logging
+from warmup import Precompressor
+import protocol
+from protocol import BUSY_REPLY, FrameConnection, FrameWriter, HashWriter, tune_socket
+from scheduler import PrioritySlots, SendScheduler
+from transfer import ServerBusyError
 
 HOST = 'localhost'
 PORT = 12345
 INPUT_DIR = 'D:\\repos\\Save_files\\input'
 OUTPUT_DIR = 'D:\\repos\\Save_files\\output'
+CACHE_DIR = os.path.join(OUTPUT_DIR, 'cache')
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+CACHE_MAX_AGE = 24 * 60 * 60
+# Archives of older versions of an input file kept in the cache.
+CACHE_KEEP_VERSIONS = 1
+# Retention for the `name_YYYYmmdd_HHMMSS.ext` archives the server saved
+# directly in OUTPUT_DIR (those download_log has a save_path for; a client's
+# own files there are left alone), enforced every STORE_GC_INTERVAL seconds
+# by a background pass that also hardlinks identical copies together (see
+# archive_store.py).
+# None turns a limit off; STORE_GC_INTERVAL = None turns the pass off.
+OUTPUT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+OUTPUT_MAX_AGE = 30 * 24 * 60 * 60
+OUTPUT_KEEP_VERSIONS = 3
+STORE_GC_INTERVAL = 600
+DEFAULT_CODEC = 'deflate'
+# Relay mode: with UPSTREAM_HOST set, this server has no files of its own.
+# It lists the origin's, fetches each archive from the origin once (however
+# many clients ask for it at the same time) and serves it from CACHE_DIR,
+# where the cache limits above apply. An origin's answer to "which archive
+# is current" is reused for UPSTREAM_CHECK_INTERVAL seconds. Relays can be
+# chained; bundles and deltas are only served by the origin.
+UPSTREAM_HOST = None
+UPSTREAM_PORT = 12345
+UPSTREAM_STREAMS = 4
+UPSTREAM_CHECK_INTERVAL = 5.0
+
+LISTEN_BACKLOG = 128
+MAX_CONNECTIONS = 64
+MAX_COMPRESSIONS = os.cpu_count() or 1
+ACCEPT_WAIT = 2.0
+# Clients waiting for a connection slot at once; any more get BUSY at once.
+MAX_WAITING = LISTEN_BACKLOG
+COMPRESSION_WAIT = 10.0
+# Free compression slots go to the smallest waiting file first; a file
+# waiting a second counts as COMPRESSION_AGING bytes smaller, so big ones
+# aren't starved by a stream of small ones.
+COMPRESSION_AGING = 1024 * 1024 * 1024
+IDLE_TIMEOUT = 300
+MAX_STREAMS = 4
+CATALOG_POLL_INTERVAL = 2.0
+MAX_LIST_PAGE = 10000
+
+# Transfer tuning, see benchmarks/bench_transfer.py. Socket buffers of None
+# keep the OS defaults (and auto-tuning); accepted sockets inherit them.
+SENDFILE_CHUNK = protocol.SENDFILE_CHUNK
+STREAM_CHUNK = protocol.STREAM_CHUNK
+SOCKET_SNDBUF = None
+SOCKET_RCVBUF = None
+# Send bandwidth in bytes/s for all clients together and for each client IP,
+# shared fairly between clients (see scheduler.py). None: no limit. Without
+# SEND_RATE the kernel and TCP decide who gets the link; set it a little
+# below the uplink so a bulk download can't crowd out everyone else's.
+SEND_RATE = None
+CLIENT_SEND_RATE = None
+
+DB_PATH = 'download_log.db'
+# Download records are written in batches by one thread: at most
+# LOG_FLUSH_INTERVAL seconds or LOG_BATCH_SIZE records are lost on a crash.
+# LOG_SYNCHRONOUS = 'FULL' also survives power loss, at the cost of an fsync
+# per batch.
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 1.0
+LOG_SYNCHRONOUS = 'NORMAL'
+
+# Background precompression of new and changed input files. WARMUP_WORKERS = 0
+# turns it off. Each worker compresses on one thread, pauses (mid-file too)
+# while a live request is compressing, reads at most WARMUP_MAX_RATE bytes/s
+# (None: no limit) and stops filling the cache past WARMUP_CACHE_SHARE of
+# CACHE_MAX_BYTES so it doesn't evict archives that are actually being
+# downloaded.
+WARMUP_WORKERS = 1
+WARMUP_CODECS = ('auto',)
+WARMUP_MAX_RATE = 50 * 1024 * 1024
+WARMUP_CACHE_SHARE = 0.5
+
+# Leveled logging through a queue, see logsetup.py. DEBUG adds a line per
+# connection, cache lookup and log batch. LOG_FILE = None logs to stdout.
+LOG_LEVEL = 'INFO'
+LOG_FILE = None
+# Prometheus text at http://METRICS_HOST:METRICS_PORT/metrics (None: off).
+# The STATS command works either way; PROFILE is only accepted from
+# ADMIN_HOSTS.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+ADMIN_HOSTS = ('127.0.0.1', '::1')
 
 os.makedirs(INPUT_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+archive_cache = None
+archive_store = None
+upstream = None
+catalog = None
+log_writer = None
+precompressor = None
+raw_hashes = {}
+raw_hashes_lock = threading.Lock()
+# Last measured send rate per client IP, so the adaptive codec has a guess
+# before a new connection has sent enough to measure its own.
+link_rates = {}
+send_scheduler = None
+connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+compression_slots = PrioritySlots(MAX_COMPRESSIONS, COMPRESSION_AGING)
+live_compressions = 0
+live_lock = threading.Lock()
+active_connections = 0
+waiting_connections = 0
+log = logging.getLogger('server')
+
+class ServerBusy(Exception):
+    pass
+
+# What the socket of a client that went away (cancelled, resumed on a new
+# connection, lost its link) raises. Not a server error: it is logged
+# quietly and counted as a disconnect. A relay's ConnectionError about its
+# origin is none of these.
+CLIENT_GONE = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+def acquire_compression(size=0):
+    global live_compressions
+    with metrics.timer('compression_wait'):
+        acquired = compression_slots.acquire(size, COMPRESSION_WAIT)
+    if not acquired:
+        metrics.inc('busy')
+        raise ServerBusy()
+    with live_lock:
+        live_compressions += 1
+
+def release_compression():
+    global live_compressions
+    with live_lock:
+        live_compressions -= 1
+    compression_slots.release()
+
+def get_cache():
+    global archive_cache
+    if archive_cache is None:
+        archive_cache = ArchiveCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_MAX_AGE, CACHE_KEEP_VERSIONS, forget_archive)
+    return archive_cache
+
+def get_scheduler():
+    global send_scheduler
+    if send_scheduler is None:
+        send_scheduler = SendScheduler(SEND_RATE, CLIENT_SEND_RATE)
+    return send_scheduler
+
+def get_upstream():
+    global upstream
+    if upstream is None:
+        upstream = relay.Upstream(UPSTREAM_HOST, UPSTREAM_PORT, UPSTREAM_STREAMS, UPSTREAM_CHECK_INTERVAL)
+    return upstream
+
+def get_store():
+    global archive_store
+    if archive_store is None:
+        archive_store = ArchiveStore(OUTPUT_DIR, OUTPUT_MAX_BYTES, OUTPUT_MAX_AGE, OUTPUT_KEEP_VERSIONS,
+                                     STORE_GC_INTERVAL, forget_archive, DB_PATH)
+    return archive_store
+
+def forget_archive(path):
+    # download_log keeps a save_path only while the archive still exists.
+    get_log_writer().update_path(path, None)
+
+def source_meta(filename, st):
+    return {'name': filename, 'source': f"{st.st_size}:{st.st_mtime_ns}"}
+
+def get_catalog():
+    global catalog
+    if catalog is None:
+        catalog = Catalog(INPUT_DIR, CATALOG_POLL_INTERVAL)
+    return catalog
+
+def get_log_writer():
+    global log_writer
+    if log_writer is None:
+        log_writer = LogWriter(DB_PATH, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_SYNCHRONOUS)
+        atexit.register(close_log_writer)
+    return log_writer
+
+def close_log_writer():
+    global log_writer
+    if log_writer is not None:
+        log_writer.close()
+        log.info(f"[DB] Log writer stopped ({log_writer.written} records written)")
+        log_writer = None
+
+def get_precompressor():
+    global precompressor
+    if precompressor is None:
+        precompressor = Precompressor(precompress, warmup_allowed, DB_PATH, WARMUP_WORKERS, WARMUP_MAX_RATE)
+        get_catalog().subscribe(precompressor.on_changed)
+    return precompressor
+
+def precompress(filename, pace=None):
+    for spec in WARMUP_CODECS:
+        # What a download would get depends on its link; nothing to prepare.
+        if compressors.per_link(spec):
+            continue
+        if create_zip(filename, spec, background=True, pace=pace)[0]:
+            log.info(f"[WARMUP] {filename} ({spec})")
+
+def warmup_allowed():
+    return live_compressions == 0 and get_cache().total_bytes < CACHE_MAX_BYTES * WARMUP_CACHE_SHARE
+
+def note_archive(filename, st, codec, level, compressed_size, compression_ratio):
+    get_catalog().record_archive(filename, st.st_size, st.st_mtime_ns, codec, level,
+                                 compressed_size, compression_ratio)
+
 def create_database():
-    conn = sqlite3.connect('download_log.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    # WAL lets the log viewer read while the writer thread appends.
+    cursor.execute('PRAGMA journal_mode=WAL')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS download_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -28,146 +259,917 @@ def create_database():
             save_path TEXT
         )
     ''')
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(download_log)')]
+    if 'codec' not in columns:
+        cursor.execute('ALTER TABLE download_log ADD COLUMN codec TEXT')
+    if 'level' not in columns:
+        cursor.execute('ALTER TABLE download_log ADD COLUMN level INTEGER')
+    if 'archive_hash' not in columns:
+        cursor.execute('ALTER TABLE download_log ADD COLUMN archive_hash TEXT')
+    # Seconds from request to END; predicted_time is the adaptive codec's
+    # estimate of it, made when it picked the first level.
+    if 'predicted_time' not in columns:
+        cursor.execute('ALTER TABLE download_log ADD COLUMN predicted_time REAL')
+    if 'transfer_time' not in columns:
+        cursor.execute('ALTER TABLE download_log ADD COLUMN transfer_time REAL')
+    create_indexes(cursor)
     conn.commit()
     conn.close()
-    print("[DB] Database table created")
+    log.info("[DB] Database table created")
+
+def add_to_database(client_ip, filename, original_size, compressed_size, compression_ratio, save_path, codec=None, level=None, archive_hash=None, predicted_time=None, transfer_time=None):
+    return get_log_writer().add((client_ip, filename, original_size, compressed_size, compression_ratio,
+                                 save_path, codec, level, archive_hash, predicted_time, transfer_time))
+
+def archive_hash(key, entry):
+    # Archives hashed while they were built carry the hash in their cache
+    # meta; older ones are hashed once here and the result is kept.
+    digest = entry['meta'].get('hash')
+    if digest is None:
+        with metrics.timer('read'):
+            digest = protocol.hash_file(entry['path']).hexdigest()
+        get_cache().update_meta(key, hash=digest)
+    return digest
+
+def raw_archive_id(filename, st):
+    return f"raw:{filename}:{st.st_size}:{st.st_mtime_ns}"
 
-def add_to_database(client_ip, filename, original_size, compressed_size, compression_ratio, save_path):
+def raw_hash(filepath, raw_id):
+    with raw_hashes_lock:
+        digest = raw_hashes.get(raw_id)
+    if digest is None:
+        with metrics.timer('read'):
+            digest = protocol.hash_file(filepath).hexdigest()
+        with raw_hashes_lock:
+            if len(raw_hashes) > 10000:
+                raw_hashes.clear()
+            raw_hashes[raw_id] = digest
+    return digest
+
+def list_files():
+    if UPSTREAM_HOST:
+        return relay_list_files()
     try:
-        conn = sqlite3.connect('download_log.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO download_log (client_ip, filename, original_size, compressed_size, compression_ratio, save_path)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (client_ip, filename, original_size, compressed_size, compression_ratio, save_path))
-        conn.commit()
-        conn.close()
-        print(f"[DB] Added record for {filename}")
-        return True
+        total, page = get_catalog().query(limit=sys.maxsize)
+        return [(entry['name'], entry['size']) for entry in page]
     except Exception as e:
-        print(f"[DB ERROR] {e}")
-        return False
+        log.error(f"[LIST] {e}")
+        return []
 
-def get_files():
-    files = []
+def send_listing(fc, stream_id, request):
+    if UPSTREAM_HOST:
+        relay_listing(fc, stream_id, request)
+        return
     try:
-        for filename in os.listdir(INPUT_DIR):
-            filepath = os.path.join(INPUT_DIR, filename)
-            if os.path.isfile(filepath):
-                if not filename.endswith('.zip'):
-                    size = os.path.getsize(filepath)
-                    files.append(f"{filename}|{size}")
-        return ";".join(files)
-    except Exception as e:
-        print(f"[ERROR] {e}")
-        return ""
+        limit = min(int(request.get('limit', PAGE_SIZE)), MAX_LIST_PAGE)
+        offset = max(int(request.get('offset', 0)), 0)
+        total, page = get_catalog().query(request.get('prefix', ''), request.get('pattern'),
+                                          request.get('sort', 'name'), bool(request.get('reverse')),
+                                          offset, limit)
+    except (ValueError, TypeError) as e:
+        fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        return
+
+    files = []
+    for entry in page:
+        item = {'name': entry['name'], 'size': entry['size'], 'mtime': entry['mtime_ns'] // 1000000000}
+        if 'archive' in entry:
+            item.update(entry['archive'])
+        files.append(item)
+    for i in range(0, len(files), FILES_PER_FRAME):
+        fc.send_control(protocol.FILES, stream_id, files=files[i:i + FILES_PER_FRAME])
+    fc.send_control(protocol.END, stream_id, total=total, offset=offset, count=len(files))
+
+def get_files():
+    return ";".join(f"{filename}|{size}" for filename, size in list_files())
 
-def create_zip(filename):
+def create_zip(filename, spec=DEFAULT_CODEC, background=False, pace=None):
+    if UPSTREAM_HOST:
+        return relay_archive(filename, spec)
     try:
         filepath = os.path.join(INPUT_DIR, filename)
         if not os.path.exists(filepath):
-            return None, None, None, None
+            return None, None, None, None, None, None, None
 
-        original_size = os.path.getsize(filepath)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        zip_name = f"{filename}_{timestamp}.zip"
-        zip_path = os.path.join(OUTPUT_DIR, zip_name)
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(filepath, filename)
-        
-        compressed_size = os.path.getsize(zip_path)
-        
-        if original_size > 0:
-            compression_ratio = (1 - compressed_size / original_size) * 100
-        else:
-            compression_ratio = 0.0
+        st = os.stat(filepath)
+        original_size = st.st_size
+        engine, level = compressors.resolve(spec, filepath)
+        key = cache_key(filepath, filename, f"{engine.name}:{level}", engine.extension)
+
+        def build(tmp_path):
+            # Warm-up doesn't hold a compression slot, so live requests
+            # never wait for one because of it. It compresses on one thread
+            # at the pace it is given, and stops whenever a live compression
+            # is running, unless a request is waiting for this very archive.
+            if not background:
+                acquire_compression(original_size)
+                workers = build_pace = None
+            else:
+                workers = 1
+                build_pace = pace and (lambda size: cache.wanted(key) or pace(size))
+            try:
+                with open(tmp_path, 'wb') as f, metrics.timer('compress'):
+                    writer = HashWriter(f)
+                    adaptive = engine.write(filepath, filename, writer, level, workers, build_pace)
+            finally:
+                if not background:
+                    release_compression()
+            meta = dict(source_meta(filename, st), original_size=original_size, hash=writer.hash.hexdigest())
+            if adaptive:
+                meta['level'] = adaptive['level']
+            return meta
+
+        cache = get_cache()
+        entry, hit = cache.get_or_create(key, build)
+        zip_path = entry['path']
+        compressed_size = entry['size']
+        level = entry['meta'].get('level', level)
+
+        log.debug(f"[CACHE] {'hit' if hit else 'miss'} {filename} {engine.name}:{compressors.level_text(level)}")
+
+        compression_ratio = compressors.ratio(original_size, compressed_size)
+        note_archive(filename, st, engine.name, level, compressed_size, compression_ratio)
         
-        return zip_path, original_size, compressed_size, compression_ratio
+        return (zip_path, original_size, compressed_size, compression_ratio, engine.name, level,
+                archive_hash(key, entry))
         
+    except ServerBusy:
+        raise
+    except Exception as e:
+        log.error(f"[COMPRESS] {filename}: {e}")
+        return None, None, None, None, None, None, None
+
+def open_archive(filename, spec=DEFAULT_CODEC):
+    # Like create_zip, plus the archive opened before anything is sent, so
+    # the cache can't evict it while the client gets ready. If it was
+    # evicted already, it is built once more.
+    for _ in range(2):
+        result = create_zip(filename, spec)
+        if result[0] is None:
+            break
+        try:
+            return result, open(result[0], 'rb')
+        except FileNotFoundError:
+            pass
+    return result, None
+
+def stream_download(fc, stream_id, filename, spec=DEFAULT_CODEC, offset=0, archive_id=None):
+    # A client resuming a broken transfer sends the archive_id from META and
+    # the number of bytes it already has. The rest is sent only if that very
+    # archive is still around; otherwise META says offset 0 and it restarts.
+    # A miss's archive_id is its cache key from the start, and the build goes
+    # on after its client drops, so a resume that comes in meanwhile waits
+    # for it and carries on from offset instead of compressing again.
+    if UPSTREAM_HOST:
+        return relay_download(fc, stream_id, filename, spec, offset, archive_id)
+    filepath = os.path.join(INPUT_DIR, filename)
+    if not os.path.isfile(filepath):
+        fc.send_control(protocol.ERROR, stream_id, message="File error")
+        return None
+
+    st = os.stat(filepath)
+    original_size = st.st_size
+
+    if spec == "raw":
+        raw_id = raw_archive_id(filename, st)
+        digest = raw_hash(filepath, raw_id)
+        start = offset if archive_id == raw_id and 0 <= offset <= original_size else 0
+        fc.send_control(protocol.META, stream_id, original_size=original_size, codec='raw', level=None,
+                        extension='', archive_id=raw_id, offset=start, compressed_size=original_size,
+                        hash=digest)
+        with open(filepath, 'rb') as f, metrics.timer('send'):
+            fileio.advise(f.fileno(), start, 0, 'POSIX_FADV_SEQUENTIAL')
+            fc.send_file(stream_id, f, start, original_size - start, SENDFILE_CHUNK)
+        metrics.inc('bytes_out', original_size - start)
+        fc.send_control(protocol.END, stream_id, compressed_size=original_size, ratio=0.0,
+                        compress_time=0.0, cached=False, hash=digest)
+        return filepath, original_size, original_size, 0.0, 'raw', None, digest, None
+
+    try:
+        engine, level = compressors.resolve(spec, filepath)
+    except ValueError as e:
+        fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        return None
+
+    cache = get_cache()
+    key = cache_key(filepath, filename, f"{engine.name}:{level}", engine.extension)
+    # An adaptive archive is compressed for this client's link, so it is
+    # neither taken from the cache nor put there, and can't be resumed.
+    cacheable = not engine.per_link
+    meta = {'original_size': original_size, 'codec': engine.name,
+            'level': level, 'extension': engine.extension, 'archive_id': key if cacheable else None}
+    # If warm-up or another request is building this very archive, waiting
+    # for it is cheaper than compressing the file a second time, and it is
+    # what a resume of a transfer that broke off mid-build needs.
+    entry = None
+    while cacheable:
+        cache.wait(key)
+        entry = cache.get(key)
+        if entry:
+            # Once open, the archive can be evicted without affecting this send.
+            try:
+                f = open(entry['path'], 'rb')
+                break
+            except FileNotFoundError:
+                continue
+        if cache.claim(key):
+            break
+    predicted_time = None
+
+    if entry:
+        log.debug(f"[CACHE] hit {filename}")
+        zip_path = entry['path']
+        compressed_size = entry['size']
+        start = offset if archive_id == key and 0 <= offset <= compressed_size else 0
+        with f:
+            digest = archive_hash(key, entry)
+            fc.send_control(protocol.META, stream_id, offset=start, compressed_size=compressed_size,
+                            hash=digest, **meta)
+            with metrics.timer('send'):
+                # sendfile reads the page cache straight into the socket;
+                # the hint makes the kernel read ahead further.
+                fileio.advise(f.fileno(), start, 0, 'POSIX_FADV_SEQUENTIAL')
+                fc.send_file(stream_id, f, start, compressed_size - start, SENDFILE_CHUNK)
+        metrics.inc('bytes_out', compressed_size - start)
+        compress_time = 0.0
+        cached = True
+        # An adaptive archive is logged with the level it mostly got.
+        level = entry['meta'].get('level', level)
+    else:
+        try:
+            acquire_compression(original_size)
+        except ServerBusy:
+            if cacheable:
+                cache.release(key)
+            fc.send_control(protocol.BUSY, stream_id)
+            return None
+
+        # Compressed output goes to the socket as it is produced and is
+        # copied into the cache so the next request costs no CPU. If the
+        # client drops, compression still finishes so it can resume.
+        log.debug(f"[CACHE] miss {filename}")
+        tmp_path = os.path.join(cache.cache_dir, f"{key}.{threading.get_ident()}.tmp")
+        try:
+            fc.send_control(protocol.META, stream_id, offset=0,
+                            estimated_size=compressors.estimate_size(engine, level, filepath), **meta)
+            started = time.monotonic()
+            with open(tmp_path, 'wb') if cacheable else contextlib.nullcontext() as tee:
+                writer = FrameWriter(fc, stream_id, tee, STREAM_CHUNK)
+                adaptive = engine.write(filepath, filename, writer, level)
+                writer.flush()
+            compress_time = time.monotonic() - started
+            cached = False
+            metrics.observe('compress', compress_time - writer.send_time)
+            metrics.observe('send', writer.send_time)
+            digest = writer.hash.hexdigest()
+            meta_fields = dict(source_meta(filename, st), original_size=original_size, hash=digest)
+            if adaptive:
+                level = meta_fields['level'] = adaptive['level']
+                predicted_time = adaptive['predicted_time']
+                log.debug(f"[ADAPTIVE] {filename}: levels {adaptive['levels']}, "
+                          f"predicted {predicted_time} s, took {compress_time:.2f} s")
+            if cacheable:
+                entry = cache.put(key, tmp_path, meta_fields)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            release_compression()
+            if cacheable:
+                cache.release(key)
+        if writer.error:
+            raise writer.error
+        zip_path = entry['path'] if entry else None
+        compressed_size = writer.total
+        metrics.inc('bytes_out', compressed_size)
+
+    compression_ratio = compressors.ratio(original_size, compressed_size)
+    note_archive(filename, st, engine.name, level, compressed_size, compression_ratio)
+
+    fc.send_control(protocol.END, stream_id, compressed_size=compressed_size, ratio=compression_ratio,
+                    compress_time=compress_time, cached=cached, hash=digest, level=level,
+                    predicted_time=predicted_time)
+    return zip_path, original_size, compressed_size, compression_ratio, engine.name, level, digest, predicted_time
+
+def send_paced(conn, f, size, addr):
+    # Legacy downloads take their turn with the framed ones, a
+    # SENDFILE_CHUNK at a time.
+    scheduler = get_scheduler()
+    if not scheduler.enabled():
+        conn.sendfile(f)
+        return
+    flow = scheduler.open(addr[0])
+    try:
+        offset = 0
+        while offset < size:
+            count = min(size - offset, SENDFILE_CHUNK)
+            scheduler.send(flow, count)
+            conn.sendfile(f, offset, count)
+            offset += count
+    finally:
+        scheduler.close(flow)
+
+def relay_entry(filename, spec):
+    # The cached copy of the archive the origin currently has for
+    # filename/spec, fetched first if need be. Keyed by the archive's hash,
+    # so concurrent requests for it share one fetch and a new version of
+    # the file is a new key. (None, None, False) if the origin has no such
+    # file or can't be reached.
+    origin = get_upstream()
+    try:
+        fields = origin.check(filename, spec)
+        digest = fields['hash']
+        engine = compressors.ENGINES.get(fields['codec'])
+        key = f"{filename}_{digest[:16]}{engine.extension if engine else ''}"
+
+        def build(tmp_path):
+            meta, end = origin.fetch(filename, spec, tmp_path)
+            if end['hash'] != digest:
+                # Changed on the origin since the check; the next check
+                # picks up the new version.
+                origin.forget(filename, spec)
+                raise relay.RelayError(f"{filename} changed on the origin, try again")
+            return {'name': f"{filename}|{spec}", 'source': digest, 'original_size': meta['original_size'],
+                    'codec': meta['codec'], 'level': end.get('level', meta['level']),
+                    'extension': meta['extension'], 'hash': digest}
+
+        entry, hit = get_cache().get_or_create(key, build)
+    except ServerBusyError:
+        metrics.inc('busy')
+        raise ServerBusy()
+    except relay.RelayError as e:
+        log.debug(f"[RELAY] {filename}: {e}")
+        return None, None, False
+    except OSError as e:
+        log.warning(f"[RELAY] {filename}: {e}")
+        return None, None, False
+    log.debug(f"[RELAY] {'hit' if hit else 'fetched'} {filename} {spec}")
+    return key, entry, hit
+
+def relay_archive(filename, spec):
+    key, entry, hit = relay_entry(filename, spec)
+    if entry is None:
+        return None, None, None, None, None, None, None
+    meta = entry['meta']
+    return (entry['path'], meta['original_size'], entry['size'],
+            compressors.ratio(meta['original_size'], entry['size']), meta['codec'], meta['level'], meta['hash'])
+
+def relay_download(fc, stream_id, filename, spec, offset, archive_id):
+    # A cache hit as in stream_download, only the archive comes from the
+    # origin. Resuming works against the relay's own copy.
+    f = None
+    try:
+        for _ in range(2):
+            key, entry, hit = relay_entry(filename, spec)
+            if entry is None:
+                break
+            try:
+                f = open(entry['path'], 'rb')
+                break
+            except FileNotFoundError:
+                pass
+    except ServerBusy:
+        fc.send_control(protocol.BUSY, stream_id)
+        return None
+    if f is None:
+        fc.send_control(protocol.ERROR, stream_id, message="File error")
+        return None
+
+    meta = entry['meta']
+    compressed_size = entry['size']
+    start = offset if archive_id == key and 0 <= offset <= compressed_size else 0
+    with f:
+        fc.send_control(protocol.META, stream_id, original_size=meta['original_size'], codec=meta['codec'],
+                        level=meta['level'], extension=meta['extension'], archive_id=key, offset=start,
+                        compressed_size=compressed_size, hash=meta['hash'])
+        with metrics.timer('send'):
+            fileio.advise(f.fileno(), start, 0, 'POSIX_FADV_SEQUENTIAL')
+            fc.send_file(stream_id, f, start, compressed_size - start, SENDFILE_CHUNK)
+    metrics.inc('bytes_out', compressed_size - start)
+    compression_ratio = compressors.ratio(meta['original_size'], compressed_size)
+    fc.send_control(protocol.END, stream_id, compressed_size=compressed_size, ratio=compression_ratio,
+                    compress_time=0.0, cached=hit, hash=meta['hash'], level=meta['level'])
+    return (entry['path'], meta['original_size'], compressed_size, compression_ratio, meta['codec'],
+            meta['level'], meta['hash'], None)
+
+def relay_listing(fc, stream_id, request):
+    query = {k: request[k] for k in ('prefix', 'pattern', 'sort', 'reverse', 'offset', 'limit') if k in request}
+    try:
+        files, fields = get_upstream().list_files(**query)
+    except (relay.RelayError, ServerBusyError, OSError) as e:
+        fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        return
+    for i in range(0, len(files), FILES_PER_FRAME):
+        fc.send_control(protocol.FILES, stream_id, files=files[i:i + FILES_PER_FRAME])
+    fc.send_control(protocol.END, stream_id, **fields)
+
+def relay_list_files():
+    files = []
+    try:
+        while True:
+            page, fields = get_upstream().list_files(offset=len(files), limit=MAX_LIST_PAGE)
+            files.extend((item['name'], item['size']) for item in page)
+            if not page or len(files) >= fields['total']:
+                return files
+    except (relay.RelayError, ServerBusyError, OSError) as e:
+        log.error(f"[LIST] {e}")
+        return files
+
+def read_opener(conn):
+    # Framed clients open with protocol.MAGIC; anything else is the legacy
+    # text protocol, whose commands are never a prefix of it. Reads (rather
+    # than peeks, which would spin on a partial opener) a byte at a time up
+    # to the first one that rules MAGIC out, so no more of a legacy command
+    # is taken than that, and returns what it read: MAGIC, the start of the
+    # first legacy command, or b'' if the client closed first.
+    head = b''
+    while len(head) < len(protocol.MAGIC) and protocol.MAGIC.startswith(head):
+        data = conn.recv(1)
+        if not data:
+            break
+        head += data
+    return head
+
+def serve_download(fc, stream_id, request, addr):
+    filename = request.get('name', '')
+    metrics.inc('downloads')
+    try:
+        started = time.perf_counter()
+        with metrics.timer('download'):
+            result = stream_download(fc, stream_id, filename, request.get('codec') or DEFAULT_CODEC,
+                                     int(request.get('offset', 0)), request.get('archive_id'))
+        transfer_time = time.perf_counter() - started
+        if result:
+            zip_path, original_size, compressed_size, compression_ratio, codec, level, digest, predicted_time = result
+            add_to_database(addr[0], filename, original_size, compressed_size, compression_ratio, zip_path,
+                            codec, level, digest, predicted_time, transfer_time)
+    except CLIENT_GONE as e:
+        metrics.inc('disconnects')
+        log.info(f"[DOWNLOAD] {filename}: client went away ({e})")
+    except Exception as e:
+        metrics.inc('errors')
+        log.error(f"[DOWNLOAD] {filename}: {e}")
+        # Without a reply the client would wait on this stream forever.
+        try:
+            fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        except OSError:
+            pass
+
+def serve_bundle(fc, stream_id, request, addr):
+    # One archive of several files: a list of names, a glob and/or a
+    # directory under INPUT_DIR. An ENTRY frame announces each file as it is
+    # added. Bundles are streamed but neither cached nor resumable.
+    if UPSTREAM_HOST:
+        fc.send_control(protocol.ERROR, stream_id, message="Bundles are only served by the origin")
+        return
+    files = request.get('files')
+    pattern = request.get('pattern')
+    directory = request.get('directory')
+    mode = request.get('mode', 'zip')
+    spec = request.get('codec') or 'auto'
+    try:
+        entries = bundles.select(INPUT_DIR, files, pattern, directory)
+        codec, level, extension = bundles.resolve(mode, spec)
+    except (bundles.BundleError, ValueError) as e:
+        fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        return
+
+    label = bundles.describe(files, pattern, directory)
+    metrics.inc('bundles')
+    original_size = sum(size for path, arcname, size in entries)
+    try:
+        acquire_compression(original_size)
+    except ServerBusy:
+        fc.send_control(protocol.BUSY, stream_id)
+        return
+
+    def on_entry(index, arcname, size):
+        fc.send_control(protocol.ENTRY, stream_id, index=index, name=arcname, size=size)
+
+    try:
+        log.info(f"[BUNDLE] {label}: {len(entries)} files, {codec}")
+        fc.send_control(protocol.META, stream_id, original_size=original_size, codec=codec, level=level,
+                        extension=extension, archive_id=None, offset=0, entries=len(entries))
+        started = time.monotonic()
+        writer = FrameWriter(fc, stream_id, chunk=STREAM_CHUNK)
+        bundles.write(entries, writer, mode, spec, codec, level, on_entry)
+        writer.flush()
+        compress_time = time.monotonic() - started
+        metrics.observe('compress', compress_time - writer.send_time)
+        metrics.observe('send', writer.send_time)
+    except CLIENT_GONE as e:
+        metrics.inc('disconnects')
+        log.info(f"[BUNDLE] {label}: client went away ({e})")
+        return
+    except Exception as e:
+        metrics.inc('errors')
+        log.error(f"[BUNDLE] {label}: {e}")
+        try:
+            fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        except OSError:
+            pass
+        return
+    finally:
+        release_compression()
+
+    compressed_size = writer.total
+    metrics.inc('bytes_out', compressed_size)
+    compression_ratio = compressors.ratio(original_size, compressed_size)
+    digest = writer.hash.hexdigest()
+    fc.send_control(protocol.END, stream_id, compressed_size=compressed_size, ratio=compression_ratio,
+                    compress_time=compress_time, cached=False, hash=digest, entries=len(entries))
+    add_to_database(addr[0], label, original_size, compressed_size, compression_ratio, None, codec, level, digest)
+
+def serve_delta(fc, stream_id, request, addr):
+    # The client sends block signatures of the copy it already has; only
+    # what isn't in those blocks is sent, see delta.py. The client rebuilds
+    # the file itself, so nothing is cached here.
+    if UPSTREAM_HOST:
+        fc.send_control(protocol.ERROR, stream_id, message="Deltas are only served by the origin")
+        return
+    filename = request.get('name', '')
+    filepath = os.path.join(INPUT_DIR, filename)
+    metrics.inc('deltas')
+    try:
+        block = int(request.get('block_size', 0))
+        signatures = base64.b64decode(request.get('signatures', ''), validate=True)
+        if not delta.BLOCK_MIN <= block <= delta.BLOCK_MAX:
+            raise delta.DeltaError(f"Bad block size {block}")
+        table = delta.signature_table(signatures)
+    except (ValueError, TypeError, delta.DeltaError) as e:
+        fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        return
+    if not os.path.isfile(filepath):
+        fc.send_control(protocol.ERROR, stream_id, message="File error")
+        return
+    original_size = os.path.getsize(filepath)
+    try:
+        acquire_compression(original_size)
+    except ServerBusy:
+        fc.send_control(protocol.BUSY, stream_id)
+        return
+
+    signature_size = len(request.get('signatures', ''))
+    try:
+        fc.send_control(protocol.META, stream_id, original_size=original_size, codec='delta',
+                        level=delta.DELTA_LEVEL, extension='', archive_id=None, offset=0, block_size=block,
+                        basis_blocks=len(signatures) // delta.SIGNATURE.size)
+        started = time.monotonic()
+        writer = FrameWriter(fc, stream_id, chunk=STREAM_CHUNK)
+        encoder, digest = delta.write_delta(filepath, block, table, writer)
+        writer.flush()
+        compress_time = time.monotonic() - started
+        metrics.observe('compress', compress_time - writer.send_time)
+        metrics.observe('send', writer.send_time)
+    except CLIENT_GONE as e:
+        metrics.inc('disconnects')
+        log.info(f"[DELTA] {filename}: client went away ({e})")
+        return
+    except Exception as e:
+        metrics.inc('errors')
+        log.error(f"[DELTA] {filename}: {e}")
+        try:
+            fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        except OSError:
+            pass
+        return
+    finally:
+        release_compression()
+
+    # What the client saves is the signatures it sent plus the delta, both
+    # against the whole file.
+    metrics.inc('bytes_out', writer.total)
+    compressed_size = writer.total + signature_size
+    compression_ratio = compressors.ratio(original_size, compressed_size)
+    log.info(f"[DELTA] {filename}: {encoder.matched} bytes reused, {encoder.literal} sent, "
+             f"{compressed_size} transferred")
+    fc.send_control(protocol.END, stream_id, compressed_size=compressed_size, ratio=compression_ratio,
+                    compress_time=compress_time, cached=False, hash=digest, delta_size=writer.total,
+                    signature_size=signature_size, matched=encoder.matched, literal=encoder.literal)
+    add_to_database(addr[0], filename, original_size, compressed_size, compression_ratio, None, 'delta',
+                    delta.DELTA_LEVEL, digest)
+
+def serve_verify(fc, stream_id, request):
+    # The hash of the archive a DOWNLOAD with the same name and codec would
+    # get, so a client can check a copy it already has without downloading.
+    filename = request.get('name', '')
+    spec = request.get('codec') or DEFAULT_CODEC
+    filepath = os.path.join(INPUT_DIR, filename)
+    try:
+        # A relay asks its origin, through create_zip, raw archives included.
+        if not UPSTREAM_HOST and not os.path.isfile(filepath):
+            fc.send_control(protocol.ERROR, stream_id, message="File error")
+            return
+        if compressors.per_link(spec):
+            fc.send_control(protocol.ERROR, stream_id,
+                            message=f"{spec} archives are made for the link they go over and have no fixed hash")
+            return
+        if spec == 'raw' and not UPSTREAM_HOST:
+            st = os.stat(filepath)
+            raw_id = raw_archive_id(filename, st)
+            fc.send_control(protocol.END, stream_id, hash=raw_hash(filepath, raw_id), compressed_size=st.st_size,
+                            codec='raw', level=None, archive_id=raw_id)
+            return
+        zip_path, original_size, compressed_size, compression_ratio, codec, level, digest = create_zip(filename, spec)
+        if zip_path is None:
+            fc.send_control(protocol.ERROR, stream_id, message="File error")
+            return
+        fc.send_control(protocol.END, stream_id, hash=digest, compressed_size=compressed_size,
+                        codec=codec, level=level, archive_id=os.path.basename(zip_path))
+    except ServerBusy:
+        fc.send_control(protocol.BUSY, stream_id)
     except Exception as e:
-        print(f"[ERROR] {e}")
-        return None, None, None, None
+        metrics.inc('errors')
+        log.error(f"[VERIFY] {filename}: {e}")
+        # Without a reply the client would wait on this stream forever.
+        try:
+            fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        except OSError:
+            pass
+
+def serve_profile(fc, stream_id, request, addr):
+    # Switches the sampling profiler on or off at runtime; 'stop' answers
+    # with the functions that showed up most.
+    if addr[0] not in ADMIN_HOSTS:
+        fc.send_control(protocol.ERROR, stream_id, message="Profiling is only allowed locally")
+        return
+    action = request.get('action', 'status')
+    try:
+        top = int(request.get('top', metrics.PROFILE_TOP))
+    except (ValueError, TypeError) as e:
+        fc.send_control(protocol.ERROR, stream_id, message=str(e))
+        return
+    if action == 'start':
+        metrics.profiler.start()
+        report = metrics.profiler.report(top)
+    elif action == 'stop':
+        report = metrics.profiler.stop(top)
+    else:
+        report = metrics.profiler.report(top)
+    fc.send_control(protocol.END, stream_id, **report)
+
+def run_queued(queued_at, handler, *args):
+    metrics.observe('queue', time.perf_counter() - queued_at)
+    handler(*args)
+
+def submit(pool, handler, *args):
+    # The queue phase is how long a request waits for a free stream worker.
+    return pool.submit(run_queued, time.perf_counter(), handler, *args)
+
+def handle_framed(conn, addr):
+    fc = FrameConnection(conn)
+    ftype, _, hello = fc.recv_control()
+    common = set(hello.get('versions', [])) & set(protocol.PROTOCOL_VERSIONS) if ftype == protocol.HELLO else set()
+    if not common:
+        fc.send_control(protocol.ERROR, 0, message="Unsupported protocol version")
+        return
+    streams = max(1, min(int(hello.get('streams', 1)), MAX_STREAMS))
+    fc.send_control(protocol.HELLO, 0, version=max(common), streams=streams)
+
+    # Downloads on one connection run side by side, up to the number of
+    # streams agreed in the handshake; their frames interleave on the socket.
+    pool = ThreadPoolExecutor(max_workers=streams)
+    received = fc.received
+    fc.link_rate = link_rates.get(addr[0])
+    fc.scheduler = get_scheduler()
+    fc.flow = fc.scheduler.open(addr[0])
+    try:
+        while True:
+            try:
+                ftype, stream_id, request = fc.recv_control()
+            except ConnectionError:
+                break
+            metrics.inc('bytes_in', fc.received - received)
+            received = fc.received
+
+            if ftype == protocol.LIST:
+                metrics.inc('lists')
+                with metrics.timer('list'):
+                    send_listing(fc, stream_id, request)
+
+            elif ftype == protocol.DOWNLOAD:
+                submit(pool, serve_download, fc, stream_id, request, addr)
+
+            elif ftype == protocol.DELTA:
+                submit(pool, serve_delta, fc, stream_id, request, addr)
+
+            elif ftype == protocol.VERIFY:
+                metrics.inc('verifies')
+                submit(pool, serve_verify, fc, stream_id, request)
+
+            elif ftype == protocol.BUNDLE:
+                submit(pool, serve_bundle, fc, stream_id, request, addr)
+
+            elif ftype == protocol.STATS:
+                fc.send_control(protocol.END, stream_id, **metrics.snapshot())
+
+            elif ftype == protocol.PROFILE:
+                serve_profile(fc, stream_id, request, addr)
+
+            elif ftype == protocol.EXIT:
+                break
+
+            else:
+                fc.send_control(protocol.ERROR, stream_id, message=f"Unknown frame type {ftype}")
+    finally:
+        pool.shutdown(wait=True)
+        fc.scheduler.close(fc.flow)
+        if fc.link_rate is not None:
+            if len(link_rates) > 10000:
+                link_rates.clear()
+            link_rates[addr[0]] = fc.link_rate
 
 def handle_client(conn, addr):
-    print(f"[CONNECT] {addr[0]}:{addr[1]}")
+    log.debug(f"[CONNECT] {addr[0]}:{addr[1]}")
+    conn.settimeout(IDLE_TIMEOUT)
     
     try:
+        head = read_opener(conn)
+        if head == protocol.MAGIC:
+            handle_framed(conn, addr)
+            return
+
         while True:
-            data = conn.recv(1024).decode('utf-8')
+            data = (head + conn.recv(1024)).decode('utf-8')
+            head = b''
             if not data:
                 break
+            metrics.inc('bytes_in', len(data))
 
             if data == "LIST":
-                files = get_files()
-                conn.send(files.encode('utf-8'))
+                metrics.inc('lists')
+                with metrics.timer('list'):
+                    files = get_files()
+                    conn.send(files.encode('utf-8'))
+
+            elif data == "STATS":
+                conn.sendall(json.dumps(metrics.snapshot()).encode('utf-8'))
 
             elif data.startswith("DOWNLOAD"):
-                _, filename = data.split("|")
-                zip_path, original_size, compressed_size, compression_ratio = create_zip(filename)
-                
-                if zip_path:
-                    info = f"SUCCESS|{original_size}|{compressed_size}|{compression_ratio:.2f}"
-                    conn.send(info.encode('utf-8'))
-                    
-                    response = conn.recv(1024).decode('utf-8')
-                    if response == "READY":
-                        with open(zip_path, 'rb') as f:
-                            file_data = f.read()
-                        file_size = len(file_data)
-                        
-                        conn.send(str(file_size).encode('utf-8'))
-                        ack = conn.recv(1024).decode('utf-8')
-                        
-                        if ack == "SIZE_RECEIVED":
-                            sent = 0
-                            chunk = 8192
-                            for i in range(0, file_size, chunk):
-                                part = file_data[i:i + chunk]
-                                conn.send(part)
-                                sent += len(part)
-                            
-                            conn.send(b"FILE_END")
-                            add_to_database(addr[0], filename, original_size, compressed_size, compression_ratio, zip_path)
+                metrics.inc('downloads')
+                parts = data.split("|")
+                filename = parts[1]
+                spec = parts[2] if len(parts) > 2 else DEFAULT_CODEC
+                try:
+                    result, f = open_archive(filename, spec)
+                except ServerBusy:
+                    conn.send(BUSY_REPLY)
+                    continue
+                zip_path, original_size, compressed_size, compression_ratio, codec, level, digest = result
+
+                if f:
+                    with f:
+                        info = f"SUCCESS|{original_size}|{compressed_size}|{compression_ratio:.2f}|{codec}|{compressors.level_text(level)}"
+                        conn.send(info.encode('utf-8'))
+
+                        response = conn.recv(1024).decode('utf-8')
+                        if response == "READY":
+                            file_size = os.fstat(f.fileno()).st_size
+
+                            conn.send(str(file_size).encode('utf-8'))
+                            ack = conn.recv(1024).decode('utf-8')
+
+                            if ack == "SIZE_RECEIVED":
+                                with metrics.timer('send'):
+                                    send_paced(conn, f, file_size, addr)
+                                metrics.inc('bytes_out', file_size)
+                                conn.send(b"FILE_END")
+                                add_to_database(addr[0], filename, original_size, compressed_size, compression_ratio, zip_path, codec, level, digest)
                 else:
                     conn.send("ERROR|File error".encode('utf-8'))
 
             elif data == "EXIT":
                 break
 
+    except (ConnectionError, socket.timeout) as e:
+        metrics.inc('disconnects')
+        log.debug(f"[CONNECTION] {addr[0]}: {e}")
     except Exception as e:
-        print(f"[ERROR] {e}")
+        metrics.inc('errors')
+        log.error(f"[CONNECTION] {addr[0]}: {e}")
     finally:
         conn.close()
-        print(f"[DISCONNECT] {addr[0]}")
+        log.debug(f"[DISCONNECT] {addr[0]}")
+
+def turn_away(conn, addr):
+    metrics.inc('busy')
+    log.warning(f"[BUSY] {addr[0]}:{addr[1]}")
+    try:
+        conn.send(BUSY_REPLY)
+    except OSError:
+        pass
+    conn.close()
+
+def admit(pool, conn, addr, accepted_at):
+    # Waits for a connection slot on a thread of its own, so the accept
+    # loop goes on taking (and, when too many wait, refusing) clients.
+    global waiting_connections
+    try:
+        if connection_slots.acquire(timeout=ACCEPT_WAIT):
+            pool.submit(serve_connection, conn, addr, accepted_at)
+        else:
+            turn_away(conn, addr)
+    finally:
+        with live_lock:
+            waiting_connections -= 1
+
+def serve_connection(conn, addr, accepted_at):
+    global active_connections
+    metrics.observe('connection_queue', time.perf_counter() - accepted_at)
+    with live_lock:
+        active_connections += 1
+    try:
+        handle_client(conn, addr)
+    finally:
+        with live_lock:
+            active_connections -= 1
+        connection_slots.release()
+
+def register_gauges():
+    metrics.gauge('active_connections', lambda: active_connections)
+    metrics.gauge('waiting_connections', lambda: waiting_connections)
+    metrics.gauge('compressions_in_flight', lambda: live_compressions)
+    metrics.gauge('compressions_queued', compression_slots.waiting)
+    for name in ('flows', 'queued'):
+        metrics.gauge(f'send_{name}', lambda name=name: get_scheduler().stats()[name])
+    for name in ('entries', 'bytes', 'hits', 'misses', 'evictions', 'hit_rate'):
+        metrics.gauge(f'cache_{name}', lambda name=name: get_cache().stats()[name])
+    metrics.gauge('catalog_files', lambda: len(get_catalog().entries))
+    metrics.gauge('log_queue', lambda: log_writer.queue.qsize() if log_writer else 0)
+    metrics.gauge('warmup_pending', lambda: precompressor.stats()['pending'] if precompressor else 0)
+    for name in ('files', 'bytes', 'removed', 'linked'):
+        metrics.gauge(f'store_{name}', lambda name=name: archive_store.stats()[name] if archive_store else 0)
+    metrics.gauge('relay_checks', lambda: upstream.stats()['checks'] if upstream else 0)
+    metrics.gauge('profiling', lambda: int(metrics.profiler.thread is not None))
 
 def start_server():
+    global waiting_connections
+    setup_logging(LOG_LEVEL, LOG_FILE)
     create_database()
-    
+    register_gauges()
+
     try:
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tune_socket(server, SOCKET_SNDBUF, SOCKET_RCVBUF)
         server.bind((HOST, PORT))
-        server.listen(5)
-        print(f"[SERVER] {HOST}:{PORT}")
-        print(f"[INPUT] {INPUT_DIR}")
-        print(f"[OUTPUT] {OUTPUT_DIR}")
-
-        files = os.listdir(INPUT_DIR)
-        if files:
-            print("[FILES] Available:")
-            for f in files:
-                path = os.path.join(INPUT_DIR, f)
-                if os.path.isfile(path) and not f.endswith('.zip'):
-                    size = os.path.getsize(path)
-                    print(f"  {f} ({size} bytes)")
+        server.listen(LISTEN_BACKLOG)
+        log.info(f"[SERVER] {HOST}:{PORT}")
+        if UPSTREAM_HOST:
+            log.info(f"[RELAY] Origin {UPSTREAM_HOST}:{UPSTREAM_PORT}")
+        else:
+            log.info(f"[INPUT] {INPUT_DIR}")
+        log.info(f"[OUTPUT] {OUTPUT_DIR}")
+        log.info(f"[CACHE] {CACHE_DIR} ({get_cache().stats()['entries']} archives)")
+        if get_scheduler().enabled():
+            log.info(f"[SCHEDULER] {SEND_RATE or 'unlimited'} bytes/s in all, "
+                     f"{CLIENT_SEND_RATE or 'unlimited'} per client")
+        if METRICS_PORT is not None:
+            metrics.serve_http(METRICS_HOST, METRICS_PORT)
 
+        if STORE_GC_INTERVAL:
+            get_store().start()
+        if not UPSTREAM_HOST:
+            if WARMUP_WORKERS:
+                # Subscribed before the first scan, so every file already in
+                # INPUT_DIR is queued too.
+                get_precompressor().start()
+            get_catalog().start()
+            total, files = get_catalog().query(limit=20)
+            if files:
+                log.info("[FILES] Available:")
+                for entry in files:
+                    log.info(f"  {entry['name']} ({entry['size']} bytes)")
+                if total > len(files):
+                    log.info(f"  ... and {total - len(files)} more")
+
+        # A fixed pool serves at most MAX_CONNECTIONS clients. When it is full
+        # a client waits up to ACCEPT_WAIT for a slot, off the accept thread,
+        # and is then turned away with an explicit BUSY; past MAX_WAITING
+        # waiting clients the BUSY comes at once. The accept loop itself
+        # never blocks on a slot, so a burst gets its answers in parallel.
+        pool = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS)
         while True:
             conn, addr = server.accept()
-            thread = threading.Thread(target=handle_client, args=(conn, addr))
-            thread.start()
+            accepted_at = time.perf_counter()
+            metrics.inc('connections')
+            if connection_slots.acquire(blocking=False):
+                pool.submit(serve_connection, conn, addr, accepted_at)
+                continue
+            with live_lock:
+                wait = waiting_connections < MAX_WAITING
+                if wait:
+                    waiting_connections += 1
+            if not wait:
+                turn_away(conn, addr)
+                continue
+            threading.Thread(target=admit, args=(pool, conn, addr, accepted_at), daemon=True).start()
 
     except Exception as e:
-        print(f"[ERROR] {e}")
+        log.error(f"[SERVER] {e}")
+    finally:
+        close_log_writer()
 
 if __name__ == "__main__":
     start_server()
\ No newline at end of file
@@ -0,0 +1,742 @@
+import os
+import re
+import json
+import zlib
+import base64
+import shutil
+import socket
+import zipfile
+import threading
+import time
+from datetime import datetime
+
+import delta
+import protocol
+from extract import ExtractError, Extractor, supported
+from protocol import FrameConnection, HashWriter, encode_control, hash_file, hello_frame, new_hash, tune_socket
+
+DEFAULT_STREAMS = 4
+RESUME_JOURNAL = 'resume.json'
+BUSY_MESSAGE = "Server is busy, try again later"
+
+# The .part files of the downloads running in this process. Two downloads of
+# the same name and codec into one directory would share theirs, so the
+# second is refused until the first has finished.
+active_parts = set()
+active_lock = threading.Lock()
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class Reply:
+    def __init__(self):
+        self.fields = None
+        self.files = []
+        self.error = None
+        self.done = threading.Event()
+
+    def on_meta(self, fields):
+        pass
+
+    def on_entry(self, fields):
+        pass
+
+    def on_files(self, fields):
+        self.files.extend(fields['files'])
+
+    def on_end(self, fields):
+        self.fields = fields
+        self.finish()
+
+    def fail(self, message, keep=True):
+        self.error = message
+        self.finish()
+
+    def finish(self):
+        self.done.set()
+
+
+class ResumeJournal:
+    # Maps "name|codec" to the archive a .part file in the same directory
+    # belongs to. The offset to resume from is the size of the .part file.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.save()
+
+    def remove(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Transfer:
+    # With extract, an archive format extract.py knows is unpacked while it
+    # arrives, into {name}_{time} (the file itself, or a directory for a
+    # bundle); the archive is not kept and can't be resumed. Anything else
+    # is saved as it comes.
+    single = True
+
+    def __init__(self, name, codec, save_dir, on_progress=None, on_finish=None, journal=None, extract=False):
+        self.name = name
+        self.codec = codec
+        self.save_dir = save_dir
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.journal = journal
+
+        self.key = f"{name}|{codec}"
+        self.part_path = os.path.join(save_dir, f"{name}.{codec.replace(':', '-')}.part")
+        self.save_path = self.part_path
+        self.file = None
+        self.meta = None
+        self.end = None
+        self.error = None
+        self.received = 0
+        self.resumed_from = 0
+        self.hash = None
+        self.done = threading.Event()
+        self.extract = extract
+        self.extractor = None
+        self.extract_path = os.path.join(save_dir, f"{name}.{codec.replace(':', '-')}.extract")
+        self.decompress_time = None
+        with active_lock:
+            self.claimed = os.path.abspath(self.part_path) not in active_parts
+            if self.claimed:
+                active_parts.add(os.path.abspath(self.part_path))
+
+        self.offset = 0
+        self.archive_id = None
+        entry = journal.get(self.key) if journal and not extract and self.claimed else None
+        if entry and os.path.exists(self.part_path):
+            self.archive_id = entry['archive_id']
+            self.offset = os.path.getsize(self.part_path)
+
+    def request(self):
+        return {'name': self.name, 'codec': self.codec,
+                'offset': self.offset, 'archive_id': self.archive_id}
+
+    def on_meta(self, fields):
+        self.meta = fields
+        if self.extract and supported(fields['extension']):
+            remove_path(self.extract_path)
+            self.hash = new_hash()
+            self.extractor = Extractor(fields['extension'], self.extract_path, self.single,
+                                       [fields['original_size']] if self.single else [])
+            return
+        start = fields.get('offset', 0)
+        if start and start == self.offset and fields['archive_id'] == self.archive_id:
+            # The bytes already on disk are hashed once here; everything
+            # after them is hashed as it arrives.
+            self.hash = hash_file(self.part_path, start)
+            self.file = open(self.part_path, 'r+b')
+            self.file.seek(start)
+            self.file.truncate()
+        else:
+            start = 0
+            self.hash = new_hash()
+            self.file = open(self.part_path, 'wb')
+        self.resumed_from = start
+        self.received = start
+        if self.journal:
+            self.journal.set(self.key, {'archive_id': fields['archive_id']})
+
+    def on_entry(self, fields):
+        pass
+
+    def on_data(self, conn, size):
+        while size > 0:
+            view = conn.recv_view(size)
+            self.hash.update(view)
+            if self.extractor:
+                # The view's buffer is reused by the next receive.
+                self.extractor.feed(bytes(view))
+            else:
+                self.file.write(view)
+            self.received += len(view)
+            size -= len(view)
+        if self.on_progress:
+            self.on_progress(self)
+
+    def on_end(self, fields):
+        if self.extractor:
+            self.end_extract(fields)
+            return
+        self.file.close()
+        self.end = fields
+        actual = os.path.getsize(self.part_path)
+        if actual != fields['compressed_size']:
+            self.fail(f"Size error: expected {fields['compressed_size']}, got {actual}", keep=False)
+            return
+        if fields.get('hash') and self.hash.hexdigest() != fields['hash']:
+            self.fail("Checksum error: the received archive is corrupt", keep=False)
+            return
+        time_str = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.save_path = os.path.join(self.save_dir, f"{self.name}_{time_str}{self.meta['extension']}")
+        os.replace(self.part_path, self.save_path)
+        if self.journal:
+            self.journal.remove(self.key)
+        self.finish()
+
+    def end_extract(self, fields):
+        self.end = fields
+        if self.received != fields['compressed_size']:
+            self.fail(f"Size error: expected {fields['compressed_size']}, got {self.received}")
+            return
+        try:
+            self.extractor.close()
+        except ExtractError as e:
+            self.fail(f"Extract error: {e}")
+            return
+        if fields.get('hash') and self.hash.hexdigest() != fields['hash']:
+            self.fail("Checksum error: the received archive is corrupt")
+            return
+        self.decompress_time = self.extractor.decompress_time
+        time_str = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.save_path = base = os.path.join(self.save_dir, f"{self.name}_{time_str}")
+        # A file replaces an older one of the same name, as archives do; a
+        # directory can't, so a second bundle in the same second gets a suffix.
+        n = 1
+        while os.path.isdir(self.save_path):
+            self.save_path = f"{base}_{n}"
+            n += 1
+        os.replace(self.extract_path, self.save_path)
+        self.finish()
+
+    def fail(self, message, keep=True):
+        # A dropped connection keeps the .part file for a later resume; a
+        # refusal or a corrupt result throws it away. Half-extracted files
+        # always go.
+        if self.extractor:
+            try:
+                self.extractor.close()
+            except ExtractError:
+                pass
+            remove_path(self.extract_path)
+        if self.file:
+            self.file.close()
+        # A refused download leaves the files of the one it clashed with alone.
+        if not keep and self.claimed:
+            try:
+                os.remove(self.part_path)
+            except OSError:
+                pass
+            if self.journal:
+                self.journal.remove(self.key)
+        self.error = message
+        self.finish()
+
+    def release(self):
+        if self.claimed:
+            with active_lock:
+                active_parts.discard(os.path.abspath(self.part_path))
+            self.claimed = False
+
+    def finish(self):
+        self.release()
+        self.done.set()
+        if self.on_finish:
+            self.on_finish(self)
+
+    def wait(self):
+        self.done.wait()
+        return self.error is None
+
+    def fraction(self):
+        # Until END the archive size is known only on cache hits; on a miss
+        # it is the server's estimate from a compressed sample.
+        if self.done.is_set():
+            return 1.0
+        if self.meta is None:
+            return 0.0
+        total = self.meta.get('compressed_size') or self.meta.get('estimated_size') or self.meta['original_size']
+        return min(self.received / total, 0.99) if total else 0.0
+
+
+class BundleTransfer(Transfer):
+    # One archive of several server files. Progress comes from the ENTRY
+    # frames: the share of input bytes in the entries started so far.
+    single = False
+
+    def __init__(self, label, codec, save_dir, on_progress=None, on_finish=None, on_entry=None, extract=False):
+        safe = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in label).strip('._') or 'bundle'
+        super().__init__(safe, codec, save_dir, on_progress, on_finish, extract=extract)
+        self.label = label
+        self.entry = None
+        self.entries_started = 0
+        self.bytes_started = 0
+        self.entry_callback = on_entry
+
+    def fail(self, message, keep=True):
+        # Bundles can't be resumed, so a partial one is never worth keeping.
+        super().fail(message, keep=False)
+
+    def on_entry(self, fields):
+        if self.extractor:
+            self.extractor.add_size(fields['size'])
+        if self.entry:
+            self.bytes_started += self.entry['size']
+        self.entry = fields
+        self.entries_started += 1
+        if self.entry_callback:
+            self.entry_callback(self)
+
+    def fraction(self):
+        if self.done.is_set():
+            return 1.0
+        if not self.meta or not self.entry:
+            return 0.0
+        total = self.meta['original_size']
+        return min(self.bytes_started / total, 0.99) if total else 0.0
+
+
+def find_basis(save_dir, name):
+    # The newest earlier download of name in save_dir: saved as is, or a zip
+    # whose member is extracted next to it. Returns (path, extracted).
+    saved = re.compile(re.escape(name) + r'_\d{8}_\d{6}(\.zip)?$')
+    try:
+        with os.scandir(save_dir) as it:
+            copies = [entry for entry in it if saved.match(entry.name) and entry.is_file()]
+    except OSError:
+        return None, False
+    for entry in sorted(copies, key=lambda e: e.stat().st_mtime, reverse=True):
+        if not entry.name.endswith('.zip'):
+            return entry.path, False
+        basis_path = os.path.join(save_dir, f"{name}.delta.basis")
+        try:
+            with zipfile.ZipFile(entry.path) as zipf, zipf.open(name) as src, open(basis_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, protocol.HASH_CHUNK)
+            return basis_path, True
+        except (OSError, KeyError, zipfile.BadZipFile, NotImplementedError):
+            continue
+    return None, False
+
+
+class DeltaTransfer(Transfer):
+    # Rebuilds the server's current version of a file from the newest local
+    # copy (the basis) and the changed blocks, see delta.py. With no basis
+    # the whole file comes as one deflated literal. Not resumable.
+    def __init__(self, name, save_dir, on_progress=None, on_finish=None):
+        super().__init__(name, 'delta', save_dir, on_progress, on_finish)
+        self.basis_path, self.extracted = find_basis(save_dir, name) if self.claimed else (None, False)
+        self.basis = None
+        self.patcher = None
+        self.inflate = None
+        self.broken = None
+        try:
+            self.block = delta.block_size(os.path.getsize(self.basis_path) if self.basis_path else 0)
+            self.signatures = delta.signatures(self.basis_path, self.block) if self.basis_path else b''
+        except Exception:
+            self.release()
+            raise
+
+    def request(self):
+        return {'name': self.name, 'block_size': self.block,
+                'signatures': base64.b64encode(self.signatures).decode('ascii')}
+
+    def on_meta(self, fields):
+        self.meta = fields
+        self.hash = None
+        self.file = open(self.part_path, 'wb')
+        if self.basis_path:
+            self.basis = open(self.basis_path, 'rb')
+        self.inflate = zlib.decompressobj()
+        self.patcher = delta.Patcher(self.basis, self.block, HashWriter(self.file))
+
+    def on_data(self, conn, size):
+        # A bad delta fails the transfer at END; the rest of it is skipped
+        # so the other streams on the connection carry on.
+        if self.broken:
+            conn.discard(size)
+            return
+        while size > 0:
+            view = conn.recv_view(size)
+            self.received += len(view)
+            size -= len(view)
+            try:
+                data = self.inflate.decompress(view, protocol.RECV_CHUNK)
+                while data:
+                    self.patcher.feed(data)
+                    data = self.inflate.decompress(self.inflate.unconsumed_tail, protocol.RECV_CHUNK)
+            except (zlib.error, delta.DeltaError) as e:
+                self.broken = str(e)
+                conn.discard(size)
+                return
+        if self.on_progress:
+            self.on_progress(self)
+
+    def on_end(self, fields):
+        self.end = fields
+        if not self.broken and not (self.inflate.eof and self.patcher.complete()):
+            self.broken = "Delta ended early"
+        self.file.close()
+        if self.broken:
+            self.fail(f"Delta error: {self.broken}", keep=False)
+            return
+        if self.patcher.written != self.meta['original_size']:
+            self.fail(f"Size error: expected {self.meta['original_size']}, got {self.patcher.written}", keep=False)
+            return
+        if self.patcher.out.hash.hexdigest() != fields['hash']:
+            self.fail("Checksum error: the rebuilt file differs from the server's", keep=False)
+            return
+        time_str = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.save_path = os.path.join(self.save_dir, f"{self.name}_{time_str}")
+        os.replace(self.part_path, self.save_path)
+        self.finish()
+
+    def fail(self, message, keep=True):
+        super().fail(message, keep=False)
+
+    def finish(self):
+        if self.basis:
+            self.basis.close()
+        if self.extracted:
+            try:
+                os.remove(self.basis_path)
+            except OSError:
+                pass
+        super().finish()
+
+    def fraction(self):
+        if self.done.is_set():
+            return 1.0
+        if self.patcher is None:
+            return 0.0
+        total = self.meta['original_size']
+        return min(self.patcher.written / total, 0.99) if total else 0.0
+
+
+class BatchProgress:
+    # Progress of a batch of transfers for a UI to poll at its own pace.
+    # The reader thread only bumps counters on the Transfer objects, so no
+    # work is done per chunk on behalf of the display.
+    def __init__(self):
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last = (self.started, 0)
+        self.rate = 0.0
+        self.closed = False
+
+    def add(self, transfer):
+        with self.lock:
+            self.transfers.append(transfer)
+
+    def close(self):
+        # The batch is over; a poller should stop drawing progress.
+        self.closed = True
+
+    def snapshot(self, count=None):
+        with self.lock:
+            transfers = list(self.transfers)
+            count = max(count or 0, len(transfers))
+            received = sum(max(t.received - t.resumed_from, 0) for t in transfers)
+
+            # Throughput is smoothed over the polls so it doesn't jump about.
+            now = time.monotonic()
+            last_time, last_received = self.last
+            if now > last_time:
+                current = (received - last_received) / (now - last_time)
+                self.rate = current if self.rate == 0.0 else 0.7 * self.rate + 0.3 * current
+            self.last = (now, received)
+            rate = self.rate
+
+        fraction = sum(t.fraction() for t in transfers) / count if count else 0.0
+        elapsed = now - self.started
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+        return {
+            'fraction': fraction,
+            'received': received,
+            'rate': rate,
+            'elapsed': elapsed,
+            'eta': eta,
+            'finished': sum(1 for t in transfers if t.done.is_set()),
+            'count': count,
+            'compress_time': sum(t.end.get('compress_time', 0.0) for t in transfers if t.end),
+            'active': [t for t in transfers if t.meta is not None and not t.done.is_set()],
+        }
+
+
+class Session:
+    # One persistent framed connection. Requests get their own stream id,
+    # up to `streams` downloads are in flight at once and a reader thread
+    # routes every incoming frame to the request it belongs to.
+    def __init__(self, host, port, streams=DEFAULT_STREAMS, timeout=10, rcvbuf=None, recv_chunk=protocol.RECV_CHUNK):
+        sock = socket.create_connection((host, port), timeout=timeout)
+        tune_socket(sock, rcvbuf=rcvbuf)
+        self.conn = FrameConnection(sock, recv_chunk)
+        self.conn.send_raw(hello_frame(streams))
+        hello = self.conn.recv_hello()
+        if hello is None:
+            sock.close()
+            raise ServerBusyError(BUSY_MESSAGE)
+        sock.settimeout(None)
+
+        self.streams = hello.get('streams', 1)
+        self.slots = threading.Semaphore(self.streams)
+        self.pending = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.closed = False
+        self.journals = {}
+
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def read_loop(self):
+        error = "Connection closed"
+        try:
+            while True:
+                ftype, stream_id, size = self.conn.recv_header()
+                handler = self.pending.get(stream_id)
+
+                if ftype == protocol.DATA:
+                    if handler is None:
+                        self.conn.discard(size)
+                        continue
+                    started = self.conn.received
+                    if not self.call(stream_id, handler, handler.on_data, self.conn, size):
+                        # Whatever of the frame the handler didn't read, so
+                        # the next header is where it should be.
+                        self.conn.discard(size - (self.conn.received - started))
+                    continue
+
+                fields = json.loads(self.conn.recv_exact(size)) if size else {}
+                if handler is None:
+                    continue
+                if ftype == protocol.META:
+                    self.call(stream_id, handler, handler.on_meta, fields)
+                elif ftype == protocol.FILES:
+                    self.call(stream_id, handler, handler.on_files, fields)
+                elif ftype == protocol.ENTRY:
+                    self.call(stream_id, handler, handler.on_entry, fields)
+                elif ftype == protocol.END:
+                    self.pop(stream_id)
+                    self.call(stream_id, handler, handler.on_end, fields)
+                elif ftype == protocol.BUSY:
+                    self.pop(stream_id)
+                    self.call(stream_id, handler, handler.fail, BUSY_MESSAGE)
+                else:
+                    self.pop(stream_id)
+                    self.call(stream_id, handler, handler.fail,
+                              fields.get('message', f"Unexpected frame type {ftype}"), False)
+        except Exception as e:
+            if not self.closed:
+                error = str(e)
+        finally:
+            self.closed = True
+            with self.lock:
+                handlers = list(self.pending.values())
+                self.pending.clear()
+            for handler in handlers:
+                self.abandon(handler, error, keep=True)
+
+    def call(self, stream_id, handler, callback, *args):
+        # A handler that raises fails on its own; the reader and the other
+        # streams of the connection carry on.
+        try:
+            callback(*args)
+            return True
+        except Exception as e:
+            self.pop(stream_id)
+            self.abandon(handler, f"{type(e).__name__}: {e}", keep=False)
+            return False
+
+    def abandon(self, handler, message, keep):
+        if handler.done.is_set():
+            return
+        try:
+            handler.fail(message, keep)
+        except Exception:
+            pass
+        # Whatever went wrong inside fail, nobody may be left waiting and
+        # the handler's stream slot has to come back.
+        if not handler.done.is_set():
+            handler.error = handler.error or message
+            try:
+                handler.finish()
+            except Exception:
+                handler.done.set()
+
+    def pop(self, stream_id):
+        with self.lock:
+            return self.pending.pop(stream_id, None)
+
+    def send_request(self, ftype, handler, **fields):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            stream_id = self.next_id
+            self.next_id += 1
+            self.pending[stream_id] = handler
+        try:
+            self.conn.send_raw(encode_control(ftype, stream_id, fields))
+        except OSError:
+            self.pop(stream_id)
+            raise
+        return stream_id
+
+    def list_files(self, **query):
+        # query: prefix, pattern, sort, reverse, offset, limit.
+        # Returns one page of files and the total number of matches.
+        reply = Reply()
+        self.send_request(protocol.LIST, reply, **query)
+        reply.done.wait()
+        if reply.error:
+            raise Exception(reply.error)
+        return reply.files, reply.fields['total']
+
+    def checksum(self, name, codec):
+        # Size and hash of the archive the server would send for name/codec.
+        reply = Reply()
+        self.send_request(protocol.VERIFY, reply, name=name, codec=codec)
+        reply.done.wait()
+        if reply.error:
+            raise Exception(reply.error)
+        return reply.fields
+
+    def stats(self):
+        # The server's counters, gauges and per-phase timings (metrics.py).
+        reply = Reply()
+        self.send_request(protocol.STATS, reply)
+        reply.done.wait()
+        if reply.error:
+            raise Exception(reply.error)
+        return reply.fields
+
+    def profile(self, action, top=30):
+        # action: 'start', 'stop' or 'status'. Only accepted on the server's
+        # own machine.
+        reply = Reply()
+        self.send_request(protocol.PROFILE, reply, action=action, top=top)
+        reply.done.wait()
+        if reply.error:
+            raise Exception(reply.error)
+        return reply.fields
+
+    def verify_file(self, path, name, codec):
+        # Checks a local copy against the server without downloading it.
+        # Returns (ok, message).
+        fields = self.checksum(name, codec)
+        size = os.path.getsize(path)
+        if size != fields['compressed_size']:
+            return False, f"Size differs: local {size}, server {fields['compressed_size']}"
+        if hash_file(path).hexdigest() != fields['hash']:
+            return False, "Checksum differs from the server's archive"
+        return True, f"Matches the server's archive ({protocol.HASH_NAME} {fields['hash'][:16]}...)"
+
+    def download(self, name, codec, save_dir, on_progress=None, on_finish=None, extract=False):
+        # Blocks while all streams are busy, so a batch is pipelined with
+        # at most `streams` transfers overlapping.
+        def finished(transfer):
+            self.slots.release()
+            if on_finish:
+                on_finish(transfer)
+
+        if codec == 'delta':
+            return self.download_delta(name, save_dir, on_progress, on_finish)
+
+        with self.lock:
+            journal = self.journals.get(save_dir)
+            if journal is None:
+                journal = self.journals[save_dir] = ResumeJournal(os.path.join(save_dir, RESUME_JOURNAL))
+
+        transfer = Transfer(name, codec, save_dir, on_progress, finished, journal, extract)
+        self.slots.acquire()
+        try:
+            self.check_claimed(transfer)
+            self.send_request(protocol.DOWNLOAD, transfer, **transfer.request())
+        except Exception as e:
+            transfer.fail(str(e))
+        return transfer
+
+    def download_delta(self, name, save_dir, on_progress=None, on_finish=None):
+        # Hashes the local basis first, which takes a while for a big file.
+        def finished(transfer):
+            self.slots.release()
+            if on_finish:
+                on_finish(transfer)
+
+        transfer = DeltaTransfer(name, save_dir, on_progress, finished)
+        self.slots.acquire()
+        try:
+            self.check_claimed(transfer)
+            self.send_request(protocol.DELTA, transfer, **transfer.request())
+        except Exception as e:
+            transfer.fail(str(e))
+        return transfer
+
+    def download_bundle(self, save_dir, files=None, pattern=None, directory=None, mode='zip', codec='auto',
+                        on_progress=None, on_finish=None, on_entry=None, extract=False):
+        # mode 'zip' compresses every entry on its own (codec per entry);
+        # 'solid' is one tar stream compressed with zstd or xz.
+        def finished(transfer):
+            self.slots.release()
+            if on_finish:
+                on_finish(transfer)
+
+        label = directory or pattern or (files[0] if files and len(files) == 1 else f"{len(files or [])}_files")
+        transfer = BundleTransfer(label, codec, save_dir, on_progress, finished, on_entry, extract)
+        self.slots.acquire()
+        try:
+            self.check_claimed(transfer)
+            self.send_request(protocol.BUNDLE, transfer, files=files, pattern=pattern, directory=directory,
+                              mode=mode, codec=codec)
+        except Exception as e:
+            transfer.fail(str(e))
+        return transfer
+
+    def check_claimed(self, transfer):
+        if not transfer.claimed:
+            raise Exception(f"{transfer.name} ({transfer.codec}) is already downloading into {transfer.save_dir}")
+
+    def download_many(self, names, codec, save_dir, on_progress=None, on_finish=None):
+        transfers = [self.download(name, codec, save_dir, on_progress, on_finish) for name in names]
+        for transfer in transfers:
+            transfer.wait()
+        return transfers
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.conn.send_control(protocol.EXIT, 0)
+        except OSError:
+            pass
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.sock.close()
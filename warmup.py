@@ -0,0 +1,133 @@
+import time
+import heapq
+import logging
+import sqlite3
+import threading
+
+COUNTS_REFRESH = 60.0
+
+log = logging.getLogger('warmup')
+
+
+class Pacer:
+    # Called by the compressor with the size of each chunk of input before
+    # it goes on (see fileio.chunks). Holds reading to max_rate bytes/s and
+    # stops it for as long as should_run() says the server needs the room.
+    def __init__(self, should_run, max_rate=None, idle_wait=1.0):
+        self.should_run = should_run
+        self.max_rate = max_rate
+        self.idle_wait = idle_wait
+        self.started = time.monotonic()
+        self.read = 0
+        self.paused = 0.0
+
+    def __call__(self, size):
+        if not self.should_run():
+            paused = time.monotonic()
+            while not self.should_run():
+                time.sleep(self.idle_wait)
+            # The rate starts over, so the pause isn't made up for in a burst.
+            self.paused += time.monotonic() - paused
+            self.started = time.monotonic()
+            self.read = 0
+        self.read += size
+        if self.max_rate:
+            ahead = self.read / self.max_rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class Precompressor:
+    # Compresses new and changed files ahead of demand. Files downloaded most
+    # often in the last history_days go first, the newest files after that.
+    # compress(name, pace) is given a Pacer, so a worker never reads more
+    # than max_rate bytes of input per second and backs off, mid-file too,
+    # whenever should_run() says the server has no room.
+    def __init__(self, compress, should_run, db_path, workers=1, max_rate=None, history_days=7, idle_wait=1.0):
+        self.compress = compress
+        self.should_run = should_run
+        self.db_path = db_path
+        self.workers = workers
+        self.max_rate = max_rate
+        self.history_days = history_days
+        self.idle_wait = idle_wait
+
+        self.heap = []
+        self.queued = {}
+        self.seq = 0
+        self.counts = {}
+        self.counts_time = None
+        self.done = 0
+        self.failed = 0
+        self.paused = 0.0
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        if not self.threads:
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def download_counts(self):
+        now = time.monotonic()
+        if self.counts_time is None or now - self.counts_time > COUNTS_REFRESH:
+            self.counts_time = now
+            try:
+                conn = sqlite3.connect(self.db_path)
+                try:
+                    self.counts = dict(conn.execute('''
+                        SELECT filename, COUNT(*) FROM download_log
+                        WHERE timestamp >= datetime('now', ?) GROUP BY filename
+                    ''', (f'-{self.history_days} days',)).fetchall())
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                log.error(f"[WARMUP] {e}")
+        return self.counts
+
+    def on_changed(self, entries):
+        counts = self.download_counts()
+        with self.cond:
+            for entry in entries:
+                name = entry['name']
+                version = (entry['size'], entry['mtime_ns'])
+                if self.queued.get(name) == version:
+                    continue
+                self.queued[name] = version
+                self.seq += 1
+                heapq.heappush(self.heap, (-counts.get(name, 0), -entry['mtime_ns'], self.seq, name, version))
+            self.cond.notify_all()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                _, _, _, name, version = heapq.heappop(self.heap)
+                if self.queued.get(name) != version:
+                    # A newer version of the file is queued behind this one.
+                    continue
+
+            while not self.should_run():
+                time.sleep(self.idle_wait)
+
+            pace = Pacer(self.should_run, self.max_rate, self.idle_wait)
+            try:
+                self.compress(name, pace)
+                ok = True
+            except Exception as e:
+                ok = False
+                log.error(f"[WARMUP] {name}: {e}")
+            with self.cond:
+                if ok:
+                    self.done += 1
+                else:
+                    self.failed += 1
+                self.paused += pace.paused
+
+    def stats(self):
+        with self.cond:
+            return {'pending': len(self.heap), 'done': self.done, 'failed': self.failed,
+                    'paused': round(self.paused, 1)}